@@ -1,30 +1,51 @@
 import logging
-import re
 import time
 
 from werkzeug.exceptions import HTTPException
 
 from flask import Flask
+from flask import Request
 from flask import abort
 from flask import g
 from flask import request
 
-from app.helpers.utils import get_registered_method
+from app.helpers.cors import origin_policy
+from app.helpers.metrics import STAGE_DURATION
+from app.helpers.metrics import add_gauge
+from app.helpers.metrics import inc_counter
+from app.helpers.metrics import observe
+from app.helpers.response_log import LazyResponseExtra
+from app.helpers.response_log import is_response_sampled
 from app.helpers.utils import make_error_msg
-from app.settings import ALLOWED_DOMAINS_PATTERN
 from app.settings import CACHE_CONTROL
 from app.settings import CACHE_CONTROL_4XX
+from app.settings import CORS_MAX_AGE
 
 logger = logging.getLogger(__name__)
 logger_routes = logging.getLogger('app.routes')
 
+
+class TimedRequest(Request):
+    '''Request recording the parsing time of its form data (multipart_parse stage)'''
+
+    def _load_form_data(self):
+        if 'form' in self.__dict__:
+            return
+        started = time.perf_counter()
+        try:
+            super()._load_form_data()
+        finally:
+            observe(STAGE_DURATION, time.perf_counter() - started, stage='multipart_parse')
+
+
 # Standard Flask application initialisation
 
 app = Flask(__name__)
+app.request_class = TimedRequest
 
 
 def is_domain_allowed(domain):
-    return re.match(ALLOWED_DOMAINS_PATTERN, domain) is not None
+    return origin_policy.is_allowed(domain)
 
 
 # Add quick log of the routes used to all request.
@@ -34,13 +55,21 @@ def is_domain_allowed(domain):
 def log_route():
     g.setdefault('request_started', time.time())
     logger_routes.debug('%s %s', request.method, request.path)
+    add_gauge('kml_http_requests_in_flight', 1)
+    g.in_flight = True
+
+
+@app.teardown_request
+def end_in_flight(error=None):  # pylint: disable=unused-argument
+    if g.pop('in_flight', False):
+        add_gauge('kml_http_requests_in_flight', -1)
 
 
 # Add CORS Headers to all request
 @app.after_request
 def add_cors_header(response):
-    # Do not add CORS header to internal /checker endpoint.
-    if request.endpoint == 'checker':
+    # Do not add CORS header to internal /checker and /metrics endpoints.
+    if request.endpoint in ['checker', 'metrics']:
         return response
 
     response.headers['Access-Control-Allow-Origin'] = request.host_url
@@ -50,21 +79,30 @@ def add_cors_header(response):
 
     # Always add the allowed methods.
     response.headers.set(
-        'Access-Control-Allow-Methods', ', '.join(get_registered_method(app, request.url_rule))
+        'Access-Control-Allow-Methods', origin_policy.allowed_methods(app, request.url_rule)
     )
     response.headers.set('Access-Control-Allow-Headers', '*')
+    if (
+        request.method == 'OPTIONS' and 'Access-Control-Request-Method' in request.headers and
+        response.status_code < 400
+    ):
+        # Let the browsers cache the preflight response instead of preflighting every write
+        response.headers.set('Access-Control-Max-Age', CORS_MAX_AGE)
     return response
 
 
 @app.after_request
 def add_cache_control_header(response):
-    # For /checker route we let the frontend proxy decide how to cache it.
-    if request.method == 'GET' and request.endpoint != 'checker':
+    # For /checker and /metrics routes we let the frontend proxy decide how to cache them, the kml
+    # files have their own cache control.
+    if request.method == 'GET' and request.endpoint not in ['checker', 'metrics', 'get_kml_file']:
         if response.status_code >= 400:
             response.headers.set('Cache-Control', CACHE_CONTROL_4XX)
         else:
-            response.headers.set('Cache-Control', CACHE_CONTROL)
-            if 'no-cache' in CACHE_CONTROL:
+            # The metadata responses have their own cache control, see make_metadata_response()
+            if 'Cache-Control' not in response.headers:
+                response.headers.set('Cache-Control', CACHE_CONTROL)
+            if 'no-cache' in response.headers['Cache-Control']:
                 response.headers.set('Expire', 0)
     return response
 
@@ -77,6 +115,12 @@ def validate_origin():
     # Sec-Fetch-Site header is set to `same-origin` by most of the browser except by Safari !
     # The best protection would be to use the Sec-Fetch-Site and Origin header, however this is
     # not supported by Safari. Therefore we added a fallback to the Referer header for Safari.
+    if request.endpoint == 'get_kml_file':
+        # The kml files are public, like when they are directly served by S3
+        return
+    if request.endpoint == 'metrics':
+        # Scraped by Prometheus without any of these headers, the route must not be public
+        return
     sec_fetch_site = request.headers.get('Sec-Fetch-Site', None)
     origin = request.headers.get('Origin', None)
     referrer = request.headers.get('Referer', None)
@@ -105,24 +149,44 @@ def validate_origin():
 
 @app.after_request
 def log_response(response):
+    # The response extras are only built if the record is emitted, see response_log.py
+    if not logger_routes.isEnabledFor(logging.INFO) or not is_response_sampled(response):
+        return response
     logger_routes.info(
         "%s %s - %s",
         request.method,
         request.path,
         response.status,
         extra={
-            'response':
-                {
-                    "status_code": response.status_code,
-                    "headers": dict(response.headers.items()),
-                    "json": response.json
-                },
-            "duration": time.time() - g.get('request_started', time.time())
+            'response': LazyResponseExtra(response),
+            "duration": time.time() - g.get('request_started', time.time()),
+            "kml_processing": g.get('kml_processing', {})
         }
     )
     return response
 
 
+@app.after_request
+def record_metrics(response):
+    endpoint = request.endpoint or 'none'
+    inc_counter(
+        'kml_http_requests_total',
+        endpoint=endpoint,
+        method=request.method,
+        status=response.status_code
+    )
+    observe(
+        'kml_http_request_duration_seconds',
+        time.time() - g.get('request_started', time.time()),
+        endpoint=endpoint
+    )
+    if request.content_length:
+        inc_counter('kml_http_request_bytes_total', request.content_length, endpoint=endpoint)
+    if not response.is_streamed and response.content_length:
+        inc_counter('kml_http_response_bytes_total', response.content_length, endpoint=endpoint)
+    return response
+
+
 # Register error handler to make sure that every error returns a json answer
 @app.errorhandler(Exception)
 def handle_exception(err):
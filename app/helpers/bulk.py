@@ -0,0 +1,311 @@
+'''Bulk export and import of the KML collection
+
+The export scans the DynamoDB table with a parallel segmented Scan and downloads the S3 objects of
+the items (kml file and sidecars) with a pool of threads into a local archive directory:
+
+    <archive>/
+        export-checkpoint.json          progress of the export
+        import-checkpoint.json          progress of the import
+        items/segment-0000.jsonl        one DynamoDB item per line, in the DynamoDB JSON format
+        files/<file_key>[.br|.zst]      the S3 objects as stored
+
+The import uploads the files of an archive with a pool of threads and writes its items with
+BatchWriteItem, e.g. into a fresh table and bucket. The progress of both operations is saved in a
+checkpoint after each page (export) or batch (import) of items, an interrupted operation is resumed
+from there when run again.
+
+The boto3 clients are thread safe and used by all threads. The items are kept in the low level
+DynamoDB JSON format (e.g. {"length": {"N": "1234"}}) which is lossless.
+'''
+import json
+import logging
+import os
+import random
+import time
+from concurrent import futures
+from pathlib import Path
+from threading import Lock
+
+import boto3
+from boto3.dynamodb.types import TypeDeserializer
+
+from botocore.client import Config
+from botocore.exceptions import ClientError
+
+from app.helpers.compression import sidecar_key
+from app.settings import KML_FILE_CACHE_CONTROL
+from app.settings import KML_FILE_CONTENT_ENCODING
+from app.settings import KML_FILE_CONTENT_TYPE
+
+logger = logging.getLogger(__name__)
+
+# Max number of items of a BatchWriteItem request
+BATCH_WRITE_SIZE = 25
+BATCH_WRITE_MAX_RETRIES = 8
+BATCH_WRITE_BACKOFF = 0.05
+
+_deserializer = TypeDeserializer()
+
+
+def get_clients(s3_region, s3_endpoint_url, db_region, db_endpoint_url, max_connections):
+    '''Returns the S3 and DynamoDB clients, with a connection pool for max_connections threads'''
+    config = Config(max_pool_connections=max_connections, retries={'mode': 'adaptive'})
+    s3 = boto3.client(  # pylint: disable=invalid-name
+        's3',
+        endpoint_url=s3_endpoint_url,
+        region_name=s3_region,
+        config=config.merge(Config(signature_version='s3v4'))
+    )
+    dynamodb = boto3.client(
+        'dynamodb', endpoint_url=db_endpoint_url, region_name=db_region, config=config
+    )
+    return s3, dynamodb
+
+
+def get_file_keys(item):
+    '''Returns the S3 keys and content encodings of the objects of a DynamoDB JSON item
+
+    The kml file is the first object, see get_storage_key() for the deduplicated files.
+    '''
+    file_key = item['blob_key']['S'] if 'blob_key' in item else item['file_key']['S']
+    keys = [(file_key, KML_FILE_CONTENT_ENCODING)]
+    for encoding in _deserializer.deserialize(item['sidecars']) if 'sidecars' in item else []:
+        keys.append((sidecar_key(file_key, encoding), encoding))
+    return keys
+
+
+class Checkpoint:
+    '''Progress of an operation by segment, saved on each update'''
+
+    def __init__(self, path):
+        self.path = Path(path)
+        self._lock = Lock()
+        self._segments = {}
+        if self.path.exists():
+            self._segments = json.loads(self.path.read_text(encoding='utf-8'))
+
+    def get(self, segment):
+        with self._lock:
+            return dict(self._segments.get(str(segment), {}))
+
+    def update(self, segment, **values):
+        with self._lock:
+            self._segments.setdefault(str(segment), {}).update(values)
+            tmp_path = self.path.with_suffix('.tmp')
+            tmp_path.write_text(json.dumps(self._segments, indent=1), encoding='utf-8')
+            os.replace(tmp_path, self.path)
+
+
+class Throughput:
+    '''Counters of an operation, printed at most every interval seconds'''
+
+    def __init__(self, operation, interval=10, out=print):
+        self.operation = operation
+        self.interval = interval
+        self.items = 0
+        self.files = 0
+        self.missing_files = 0
+        self.bytes = 0
+        self._out = out
+        self._started = time.monotonic()
+        self._printed = self._started
+        self._lock = Lock()
+
+    def add(self, items=0, files=0, missing_files=0, size=0):
+        with self._lock:
+            self.items += items
+            self.files += files
+            self.missing_files += missing_files
+            self.bytes += size
+            now = time.monotonic()
+            if now - self._printed >= self.interval:
+                self._printed = now
+                self._out(self.report())
+
+    def report(self):
+        elapsed = max(time.monotonic() - self._started, 1e-6)
+        report = (
+            f'{self.operation}: {self.items} items, {self.files} files, '
+            f'{self.bytes / 1024 / 1024:.1f} MB in {elapsed:.1f} s: '
+            f'{self.items / elapsed:.1f} items/s, {self.bytes / 1024 / 1024 / elapsed:.2f} MB/s'
+        )
+        if self.missing_files:
+            report += f', {self.missing_files} missing files'
+        return report
+
+
+class _BulkOperation:
+
+    operation = None
+
+    def __init__(self, s3, dynamodb, table, bucket, archive, transfers, report_interval):
+        self.s3 = s3  # pylint: disable=invalid-name
+        self.dynamodb = dynamodb
+        self.table = table
+        self.bucket = bucket
+        self.archive = Path(archive)
+        self.items_dir = self.archive / 'items'
+        self.files_dir = self.archive / 'files'
+        self.throughput = Throughput(self.operation, report_interval)
+        self.transfers = transfers
+        # Transfer pool of the current run, an operation can be run again (e.g. to resume it)
+        self._transfers = None
+
+    def _transfer_files(self, func, items):
+        '''Run func for each file of the items in the transfer pool and wait for them'''
+        # The deduplicated files can be shared by several items
+        files = dict(file for item in items for file in get_file_keys(item))
+        tasks = [self._transfers.submit(func, key, encoding) for key, encoding in files.items()]
+        for task in tasks:
+            task.result()
+
+    def _run_segments(self, func, segments, workers):
+        with futures.ThreadPoolExecutor(
+            max_workers=self.transfers, thread_name_prefix='s3-transfer'
+        ) as self._transfers:
+            with futures.ThreadPoolExecutor(max_workers=workers) as executor:
+                for task in [executor.submit(func, segment) for segment in segments]:
+                    task.result()
+        return self.throughput
+
+
+class BulkExporter(_BulkOperation):
+    '''Export the table items and their S3 objects into an archive directory'''
+
+    operation = 'export'
+
+    def __init__(self, *args, segments=8, page_size=None, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.segments = segments
+        self.page_size = page_size
+        self.checkpoint = Checkpoint(self.archive / 'export-checkpoint.json')
+
+    def run(self):
+        # The checkpoints of the segments are only valid for the same number of segments
+        total_segments = self.checkpoint.get('scan').get('total_segments', self.segments)
+        if total_segments != self.segments:
+            raise ValueError(
+                f'The export to resume has been started with {total_segments} segments'
+            )
+        self.checkpoint.update('scan', total_segments=self.segments)
+        self.items_dir.mkdir(parents=True, exist_ok=True)
+        self.files_dir.mkdir(parents=True, exist_ok=True)
+        return self._run_segments(self._export_segment, range(self.segments), self.segments)
+
+    def _download(self, key, encoding):  # pylint: disable=unused-argument
+        try:
+            data = self.s3.get_object(Bucket=self.bucket, Key=key)['Body'].read()
+        except ClientError as error:
+            if error.response['Error']['Code'] != 'NoSuchKey':
+                raise
+            logger.warning('S3 object %s not found, exporting its item without it', key)
+            self.throughput.add(missing_files=1)
+            return
+        path = self.files_dir / key
+        path.parent.mkdir(parents=True, exist_ok=True)
+        path.write_bytes(data)
+        self.throughput.add(files=1, size=len(data))
+
+    def _export_segment(self, segment):
+        state = self.checkpoint.get(segment)
+        if state.get('done', False):
+            return
+        scan_kwargs = {'TableName': self.table, 'Segment': segment, 'TotalSegments': self.segments}
+        if self.page_size:
+            scan_kwargs['Limit'] = self.page_size
+        last_key = state.get('last_key', None)
+        with open(self.items_dir / f'segment-{segment:04d}.jsonl', 'ab') as fd:
+            # Drop the items written after the last checkpoint, they are scanned again
+            fd.truncate(state.get('offset', 0))
+            while True:
+                if last_key:
+                    scan_kwargs['ExclusiveStartKey'] = last_key
+                page = self.dynamodb.scan(**scan_kwargs)
+                items = page.get('Items', [])
+                self._transfer_files(self._download, items)
+                for item in items:
+                    fd.write(json.dumps(item).encode('utf-8') + b'\n')
+                fd.flush()
+                last_key = page.get('LastEvaluatedKey', None)
+                self.checkpoint.update(
+                    segment, offset=fd.tell(), last_key=last_key, done=last_key is None
+                )
+                self.throughput.add(items=len(items))
+                if last_key is None:
+                    return
+
+
+class BulkImporter(_BulkOperation):
+    '''Import the items and S3 objects of an archive directory into a table and bucket'''
+
+    operation = 'import'
+
+    def __init__(self, *args, workers=8, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.workers = workers
+        self.checkpoint = Checkpoint(self.archive / 'import-checkpoint.json')
+
+    def run(self):
+        segments = sorted(path.name for path in self.items_dir.glob('segment-*.jsonl'))
+        return self._run_segments(self._import_segment, segments, self.workers)
+
+    def _upload(self, key, encoding):
+        path = self.files_dir / key
+        if not path.exists():
+            logger.warning('File %s not in archive, importing its item without it', key)
+            self.throughput.add(missing_files=1)
+            return
+        data = path.read_bytes()
+        self.s3.put_object(
+            Body=data,
+            Bucket=self.bucket,
+            Key=key,
+            ContentType=KML_FILE_CONTENT_TYPE,
+            ContentEncoding=encoding,
+            CacheControl=KML_FILE_CACHE_CONTROL
+        )
+        self.throughput.add(files=1, size=len(data))
+
+    def _write_items(self, items):
+        requests = [{'PutRequest': {'Item': item}} for item in items]
+        retries = 0
+        while requests:
+            response = self.dynamodb.batch_write_item(RequestItems={self.table: requests})
+            requests = response.get('UnprocessedItems', {}).get(self.table, [])
+            if requests:
+                if retries >= BATCH_WRITE_MAX_RETRIES:
+                    raise RuntimeError(
+                        f'{len(requests)} items still unprocessed after {retries} retries'
+                    )
+                time.sleep(BATCH_WRITE_BACKOFF * 2**retries * random.uniform(0.5, 1.5))
+                retries += 1
+
+    def _import_batch(self, items):
+        # BatchWriteItem rejects duplicated keys, an item can be twice in a resumed export
+        items = list({item['kml_id']['S']: item for item in items}.values())
+        for item in items:
+            item['bucket'] = {'S': self.bucket}
+        # The files are uploaded first, an imported item always has its file
+        self._transfer_files(self._upload, items)
+        self._write_items(items)
+        self.throughput.add(items=len(items))
+
+    def _import_segment(self, segment):
+        state = self.checkpoint.get(segment)
+        if state.get('done', False):
+            return
+        imported = state.get('lines', 0)
+        batch = []
+        line_number = 0
+        with open(self.items_dir / segment, 'r', encoding='utf-8') as fd:
+            for line_number, line in enumerate(fd, start=1):
+                if line_number <= imported:
+                    continue
+                batch.append(json.loads(line))
+                if len(batch) == BATCH_WRITE_SIZE:
+                    self._import_batch(batch)
+                    self.checkpoint.update(segment, lines=line_number)
+                    batch = []
+        if batch:
+            self._import_batch(batch)
+        self.checkpoint.update(segment, lines=line_number, done=True)
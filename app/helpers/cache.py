@@ -0,0 +1,92 @@
+'''In-process cache of the KML metadata
+
+Viewers of a shared map repeatedly request the same metadata, the DynamoDB handler keeps the
+recently read items in a LRU cache of the worker process. The cache entries expire after a TTL,
+the entries of a worker are invalidated when the item is written by this worker, but the other
+workers only see the change once their entry expired. Unknown keys (404) are cached with a shorter
+TTL.
+'''
+import logging
+import time
+from collections import OrderedDict
+from copy import deepcopy
+from threading import Lock
+
+logger = logging.getLogger(__name__)
+
+MISS = object()
+
+
+class MetadataCache:
+    '''LRU cache with expiration
+
+    The values are copied on set and get, the callers can therefore modify them. A value of None
+    denotes an unknown key and is kept for negative_ttl seconds instead of ttl.
+
+    In order to not cache a value read before a concurrent invalidation, the value must be set
+    with the version returned by get_version() before reading it from the backend.
+
+    A size of 0 disables the cache.
+    '''
+
+    def __init__(self, size, ttl, negative_ttl, clock=time.monotonic):
+        self.size = size
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self.hits = 0
+        self.misses = 0
+        self._clock = clock
+        self._entries = OrderedDict()
+        self._version = 0
+        self._lock = Lock()
+
+    def get_version(self):
+        return self._version
+
+    def get(self, key):
+        '''Returns the cached value or MISS'''
+        if self.size <= 0:
+            return MISS
+        with self._lock:
+            entry = self._entries.get(key, None)
+            if entry is not None and entry[0] > self._clock():
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return deepcopy(entry[1])
+            if entry is not None:
+                del self._entries[key]
+            self.misses += 1
+        return MISS
+
+    def set(self, key, value, version):
+        if self.size <= 0:
+            return
+        ttl = self.negative_ttl if value is None else self.ttl
+        with self._lock:
+            if version != self._version:
+                logger.debug('Metadata %s invalidated while reading it, not caching it', key)
+                return
+            self._entries[key] = (self._clock() + ttl, deepcopy(value))
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.size:
+                self._entries.popitem(last=False)
+
+    def invalidate(self, *keys):
+        with self._lock:
+            self._version += 1
+            for key in keys:
+                self._entries.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._version += 1
+            self._entries.clear()
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            'size': len(self._entries),
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_ratio': self.hits / lookups if lookups else 0.0,
+        }
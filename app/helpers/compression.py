@@ -0,0 +1,162 @@
+'''Compression of the stored KML files
+
+The KML files are always stored gzipped, S3 serves them as is with `Content-Encoding: gzip`. The
+gzip stream can be produced by zlib or, when installed, by one of the faster zlib-ng or ISA-L
+(isal) implementations.
+
+Precomputed brotli and/or zstd variants (sidecars) can additionally be stored next to the gzipped
+file under `<file_key>.br` and `<file_key>.zst`, for the clients that accept them (e.g. selected by
+the CDN based on the Accept-Encoding header). They require the brotli, respectively zstandard
+package.
+'''
+import logging
+import zlib
+
+from app.settings import KML_BROTLI_QUALITY
+from app.settings import KML_GZIP_BACKEND
+from app.settings import KML_GZIP_COMPRESSION_LEVEL
+from app.settings import KML_SIDECAR_ENCODINGS
+from app.settings import KML_ZSTD_LEVEL
+
+try:
+    from isal import isal_zlib
+except ImportError:
+    isal_zlib = None
+
+try:
+    from zlib_ng import zlib_ng
+except ImportError:
+    zlib_ng = None
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+logger = logging.getLogger(__name__)
+
+GZIP_WBITS = 16 + zlib.MAX_WBITS
+
+SIDECAR_EXTENSIONS = {'br': 'br', 'zstd': 'zst'}
+
+
+def _zlib_compressobj(level):
+    return zlib.compressobj(level, zlib.DEFLATED, GZIP_WBITS)
+
+
+def _zlib_ng_compressobj(level):
+    return zlib_ng.compressobj(level, zlib_ng.DEFLATED, GZIP_WBITS)
+
+
+def _isal_compressobj(level):
+    # ISA-L only has the levels 0 to 3, map the zlib levels 0 to 9 on them
+    return isal_zlib.compressobj(min(3, (level + 2) // 3), isal_zlib.DEFLATED, GZIP_WBITS)
+
+
+GZIP_BACKENDS = {
+    'isal': (isal_zlib, _isal_compressobj),
+    'zlib-ng': (zlib_ng, _zlib_ng_compressobj),
+    'zlib': (zlib, _zlib_compressobj),
+}
+
+
+def get_gzip_backend(name):
+    '''Returns the name and the compressobj factory of the gzip backend
+
+    `auto` selects the first installed backend of GZIP_BACKENDS.
+    '''
+    if name == 'auto':
+        name = next(backend for backend, (module, _) in GZIP_BACKENDS.items() if module)
+    if name not in GZIP_BACKENDS:
+        raise ValueError(
+            f'Invalid KML_GZIP_BACKEND {name}, must be one of auto, {", ".join(GZIP_BACKENDS)}'
+        )
+    module, compressobj = GZIP_BACKENDS[name]
+    if module is None:
+        raise ValueError(f'KML_GZIP_BACKEND {name} is not installed')
+    return name, compressobj
+
+
+class _BrotliCompressor:
+
+    def __init__(self):
+        self._compressor = brotli.Compressor(mode=brotli.MODE_TEXT, quality=KML_BROTLI_QUALITY)
+
+    def compress(self, data):
+        return self._compressor.process(data)
+
+    def flush(self):
+        return self._compressor.finish()
+
+
+def _zstd_compressobj():
+    return zstandard.ZstdCompressor(level=KML_ZSTD_LEVEL).compressobj()
+
+
+SIDECAR_COMPRESSORS = {
+    'br': (brotli, 'brotli', _BrotliCompressor),
+    'zstd': (zstandard, 'zstandard', _zstd_compressobj),
+}
+
+
+def check_sidecar_encodings(encodings):
+    for encoding in encodings:
+        if encoding not in SIDECAR_COMPRESSORS:
+            raise ValueError(
+                f'Invalid KML_SIDECAR_ENCODINGS {encoding}, must be one of '
+                f'{", ".join(SIDECAR_COMPRESSORS)}'
+            )
+        module, package, _ = SIDECAR_COMPRESSORS[encoding]
+        if module is None:
+            raise ValueError(f'KML_SIDECAR_ENCODINGS {encoding} requires the {package} package')
+    return encodings
+
+
+# Fail on startup on invalid settings
+GZIP_BACKEND, _gzip_compressobj = get_gzip_backend(KML_GZIP_BACKEND)
+SIDECAR_ENCODINGS = check_sidecar_encodings(KML_SIDECAR_ENCODINGS)
+logger.debug('KML compression: gzip backend=%s, sidecars=%s', GZIP_BACKEND, SIDECAR_ENCODINGS)
+
+
+def sidecar_key(file_key, encoding):
+    return f'{file_key}.{SIDECAR_EXTENSIONS[encoding]}'
+
+
+def gzip_compress(data, level=KML_GZIP_COMPRESSION_LEVEL):
+    compressor = _gzip_compressobj(level)
+    return compressor.compress(data) + compressor.flush()
+
+
+class KmlCompressor:
+    '''Streaming compression of a KML to gzip and to the sidecar encodings
+
+    Usage:
+
+        compressor = KmlCompressor()
+        compressor.compress(data)
+        ...
+        compressed = compressor.flush()  # {'gzip': b'...', 'br': b'...'}
+    '''
+
+    def __init__(self, level=KML_GZIP_COMPRESSION_LEVEL, gzip=True, sidecars=None):
+        self._compressors = {'gzip': _gzip_compressobj(level)} if gzip else {}
+        for encoding in SIDECAR_ENCODINGS if sidecars is None else sidecars:
+            self._compressors[encoding] = SIDECAR_COMPRESSORS[encoding][2]()
+        self._output = {encoding: [] for encoding in self._compressors}
+
+    def compress(self, data):
+        for encoding, compressor in self._compressors.items():
+            self._output[encoding].append(compressor.compress(data))
+
+    def flush(self):
+        '''Returns the compressed data by content encoding'''
+        compressed = {}
+        for encoding, compressor in self._compressors.items():
+            self._output[encoding].append(compressor.flush())
+            compressed[encoding] = b''.join(self._output[encoding])
+        return compressed
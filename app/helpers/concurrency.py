@@ -0,0 +1,77 @@
+'''Concurrent execution of the independent backend operations of a request
+
+The S3 and DynamoDB operations of a request are I/O bound and independent of each other, running
+them concurrently makes the request latency approach the slowest operation instead of their sum.
+In gevent workers the threading module is monkey patched, the operations then run in greenlets of
+the worker, otherwise in short lived native threads.
+'''
+import contextvars
+import logging
+from threading import Thread
+
+logger = logging.getLogger(__name__)
+
+
+class Outcome:
+    '''Result or error of an operation run by run_concurrently()'''
+
+    __slots__ = ('value', 'error')
+
+    def __init__(self):
+        self.value = None
+        self.error = None
+
+    @property
+    def ok(self):  # pylint: disable=invalid-name
+        return self.error is None
+
+    def get(self):
+        '''Returns the value of the operation or raises its error'''
+        if self.error is not None:
+            raise self.error
+        return self.value
+
+
+def _run(func, outcome):
+    try:
+        outcome.value = func()
+    except Exception as error:  # pylint: disable=broad-except
+        outcome.error = error
+
+
+def run_concurrently(*funcs):
+    '''Run the functions concurrently and wait for all of them
+
+    The last function runs in the calling thread. Contrary to concurrent.futures no exception is
+    raised, each returned Outcome holds either the value or the error of its function. This allows
+    the caller to compensate the operations that succeeded when another one failed.
+
+    Returns:
+        List of Outcome, in the order of the functions
+    '''
+    outcomes = [Outcome() for _ in funcs]
+    threads = []
+    for func, outcome in zip(funcs[:-1], outcomes):
+        # The context is copied in order to have the flask app and request contexts in the thread
+        thread = Thread(target=contextvars.copy_context().run, args=(_run, func, outcome))
+        thread.start()
+        threads.append(thread)
+    _run(funcs[-1], outcomes[-1])
+    for thread in threads:
+        thread.join()
+    return outcomes
+
+
+def raise_first_error(outcomes):
+    for outcome in outcomes:
+        outcome.get()
+
+
+def compensate(description, func, *args):
+    '''Run a compensation operation, its failure is only logged in order to not hide the error
+    that triggered it'''
+    logger.warning('Compensating failed operation: %s', description)
+    try:
+        func(*args)
+    except Exception as error:  # pylint: disable=broad-except
+        logger.exception('Compensation failed: %s: %s', description, error)
@@ -0,0 +1,46 @@
+'''Origin policy of the service
+
+The allowed origins pattern is compiled once and the decision for an origin is memoized, the same
+few origins (and Referer of the Safari clients) are checked by validate_origin() and
+add_cors_header() on every request. The Access-Control-Allow-Methods header value of each url rule
+is computed once, on first use, from the url map of the application.
+'''
+import re
+from functools import lru_cache
+
+from app.settings import ALLOWED_DOMAINS_PATTERN
+
+# Max number of origins and referrers whose decision is memoized per worker, the Referer header
+# varies with the page of the client.
+ORIGIN_MEMO_SIZE = 1024
+
+# Methods of a werkzeug.routing.Rule without methods property
+ALL_METHODS = ['GET', 'HEAD', 'OPTIONS', 'POST', 'PUT', 'DELETE']
+
+
+class OriginPolicy:
+    '''Allowed origins and methods of the CORS headers'''
+
+    def __init__(self, pattern, memo_size=ORIGIN_MEMO_SIZE):
+        self._pattern = re.compile(pattern)
+        self.is_allowed = lru_cache(maxsize=memo_size)(self._is_allowed)
+        # rule -> Access-Control-Allow-Methods value, built on first use once all routes are
+        # registered (Flask doesn't allow registering routes after the first request).
+        self._methods = None
+
+    def _is_allowed(self, origin):
+        return self._pattern.match(origin) is not None
+
+    def allowed_methods(self, app, url_rule):
+        '''Returns the Access-Control-Allow-Methods value of an url rule (None on a 404)'''
+        if self._methods is None:
+            methods = {}
+            for rule in app.url_map.iter_rules():
+                methods.setdefault(rule.rule, set()).update(rule.methods or ALL_METHODS)
+            self._methods = {rule: ', '.join(sorted(value)) for rule, value in methods.items()}
+        if url_rule is None:
+            return ''
+        return self._methods.get(url_rule.rule, '')
+
+
+origin_policy = OriginPolicy(ALLOWED_DOMAINS_PATTERN)
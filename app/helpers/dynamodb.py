@@ -1,49 +1,132 @@
 import logging
+import random
+import time
+from threading import Lock
 
 from flask import abort
-from flask import g
 
 from boto3 import resource
 from boto3.dynamodb.conditions import Key
 
 from botocore.client import Config
+from botocore.exceptions import BotoCoreError
+from botocore.exceptions import ClientError
 from botocore.exceptions import EndpointConnectionError
 
+from app.helpers.cache import MISS
+from app.helpers.cache import MetadataCache
+from app.helpers.metrics import get_pool_connections
+from app.helpers.metrics import instrument_client
+from app.helpers.metrics import register_collector
 from app.settings import AWS_DB_ENDPOINT_URL
 from app.settings import AWS_DB_REGION_NAME
 from app.settings import AWS_DB_TABLE_NAME
+from app.settings import AWS_MAX_POOL_CONNECTIONS
 from app.settings import AWS_S3_BUCKET_NAME
+from app.settings import AWS_TCP_KEEPALIVE
+from app.settings import KML_BATCH_MAX_RETRIES
 from app.settings import KML_FILE_CONTENT_ENCODING
 from app.settings import KML_FILE_CONTENT_TYPE
+from app.settings import KML_METADATA_CACHE_NEGATIVE_TTL
+from app.settings import KML_METADATA_CACHE_SIZE
+from app.settings import KML_METADATA_CACHE_TTL
 
 logger = logging.getLogger(__name__)
 
+# The DynamoDB handler is shared by all requests (greenlets) of a worker process, see
+# app.helpers.s3.get_storage()
+_db = None
+_db_lock = Lock()
+
+
+def collect_db_metrics():
+    db = _db
+    if db is None:
+        return []
+    return [
+        *get_pool_connections(db.dynamodb.meta.client, 'dynamodb'),
+        ('counter', 'kml_metadata_cache_lookups_total', {
+            'result': 'hit'
+        }, db.cache.hits),
+        ('counter', 'kml_metadata_cache_lookups_total', {
+            'result': 'miss'
+        }, db.cache.misses),
+    ]
+
+
+register_collector(collect_db_metrics)
+
 
 def get_dynamodb_resource(region, endpoint_url):
-    return resource('dynamodb', endpoint_url=endpoint_url, config=Config(region_name=region))
+    return resource(
+        'dynamodb',
+        endpoint_url=endpoint_url,
+        config=Config(
+            region_name=region,
+            max_pool_connections=AWS_MAX_POOL_CONNECTIONS,
+            tcp_keepalive=AWS_TCP_KEEPALIVE
+        )
+    )
 
 
 def get_db():
-    if 'db' not in g:
-        g.db = DynamoDBFilesHandler(
-            table_name=AWS_DB_TABLE_NAME,
-            bucket_name=AWS_S3_BUCKET_NAME,
-            table_region=AWS_DB_REGION_NAME,
-            endpoint_url=AWS_DB_ENDPOINT_URL
-        )
-    return g.db
+    '''Returns the worker DynamoDB handler, creating it on first use'''
+    global _db  # pylint: disable=global-statement
+    if _db is None:
+        with _db_lock:
+            if _db is None:
+                _db = DynamoDBFilesHandler(
+                    table_name=AWS_DB_TABLE_NAME,
+                    bucket_name=AWS_S3_BUCKET_NAME,
+                    table_region=AWS_DB_REGION_NAME,
+                    endpoint_url=AWS_DB_ENDPOINT_URL
+                )
+    return _db
+
+
+def init_db():
+    '''Eagerly create the worker DynamoDB handler (e.g. on gunicorn worker start)'''
+    get_db()
+
+
+def close_db():
+    '''Close the worker DynamoDB handler and its connection pool'''
+    global _db  # pylint: disable=global-statement
+    with _db_lock:
+        if _db is not None:
+            _db.close()
+        _db = None
 
 
 class DynamoDBFilesHandler:
 
     def __init__(self, table_name, bucket_name, endpoint_url, table_region):
         self.dynamodb = get_dynamodb_resource(table_region, endpoint_url)
+        instrument_client(self.dynamodb.meta.client, 'dynamodb')
         self.table = self.dynamodb.Table(table_name)
         self.bucket_name = bucket_name
         self.endpoint = endpoint_url
+        self.cache = MetadataCache(
+            KML_METADATA_CACHE_SIZE, KML_METADATA_CACHE_TTL, KML_METADATA_CACHE_NEGATIVE_TTL
+        )
+
+    def close(self):
+        logger.debug('Closing DynamoDB client')
+        self.dynamodb.meta.client.close()
 
     def save_item(
-        self, kml_id, kml_admin_id, file_key, file_length, timestamp, author, author_version, empty
+        self,
+        kml_id,
+        kml_admin_id,
+        file_key,
+        file_length,
+        timestamp,
+        author,
+        author_version,
+        empty,
+        sidecars=None,
+        blob_key=None,
+        content_hash=None
     ):
         logger.debug('Saving dynamodb item with primary key %s', kml_id)
         db_item = {
@@ -58,22 +141,44 @@ class DynamoDBFilesHandler:
             'encoding': KML_FILE_CONTENT_ENCODING,
             'content_type': KML_FILE_CONTENT_TYPE,
             'author': author,
-            'author_version': author_version
+            'author_version': author_version,
+            'version': 1
         }
+        if content_hash:
+            # sha256 of the sanitized kml, used to detect the updates that don't change the file
+            db_item['content_hash'] = content_hash
+        if sidecars:
+            # content encodings of the precomputed variants stored next to the gzipped file
+            db_item['sidecars'] = sidecars
+        if blob_key:
+            # content addressed key of the file, shared by identical kmls, see get_storage_key()
+            db_item['blob_key'] = blob_key
         try:
             self.table.put_item(Item=db_item)
         except EndpointConnectionError as error:
             logger.exception('Failed to connect to DynamoDB: %s', error)
             abort(502, 'Backend DB connection error, please consult logs')
+        finally:
+            self.cache.invalidate(('kml_id', kml_id), ('admin_id', kml_admin_id))
         return db_item
 
-    def get_item(self, kml_id):
-        logger.debug('Get dynamodb item with primary key %s', kml_id)
-        try:
-            item = self.table.get_item(Key={'kml_id': kml_id}).get('Item', None)
-        except EndpointConnectionError as error:
-            logger.exception('Failed to connect to DynamoDB: %s', error)
-            abort(502, 'Backend DB connection error, please consult logs')
+    def get_item(self, kml_id, cached=True):
+        '''Returns the item of the kml_id, aborts with 404 if not found
+
+        Args:
+            cached: if False the item is read from the DB, this must be used before writing it
+        '''
+        key = ('kml_id', kml_id)
+        item = self.cache.get(key) if cached else MISS
+        if item is MISS:
+            version = self.cache.get_version()
+            logger.debug('Get dynamodb item with primary key %s', kml_id)
+            try:
+                item = self.table.get_item(Key={'kml_id': kml_id}).get('Item', None)
+            except EndpointConnectionError as error:
+                logger.exception('Failed to connect to DynamoDB: %s', error)
+                abort(502, 'Backend DB connection error, please consult logs')
+            self.cache.set(key, item, version)
 
         if item is None:
             logger.error("Could not find the following kml id in the database: %s", kml_id)
@@ -82,6 +187,16 @@ class DynamoDBFilesHandler:
         return item
 
     def get_item_by_admin_id(self, admin_id):
+        # The admin_id of a kml never changes, the cache maps it to the kml_id whose item is cached
+        # (and invalidated) separately.
+        key = ('admin_id', admin_id)
+        kml_id = self.cache.get(key)
+        if kml_id not in (MISS, None):
+            item = self.cache.get(('kml_id', kml_id))
+            if item not in (MISS, None):
+                return item
+
+        version = self.cache.get_version()
         logger.debug('Get dynamodb item with admin_id %s', admin_id)
         try:
             items = self.table.query(
@@ -96,6 +211,7 @@ class DynamoDBFilesHandler:
             logger.error(
                 "Could not find the following kml admin_id %s in the database: %s", admin_id, items
             )
+            self.cache.set(key, None, version)
             abort(404, f"Could not find {admin_id} within the database.")
 
         if len(items) > 1:
@@ -105,34 +221,182 @@ class DynamoDBFilesHandler:
                 extra={'kml_items': items}
             )
 
+        self.cache.set(key, items[0]['kml_id'], version)
+        self.cache.set(('kml_id', items[0]['kml_id']), items[0], version)
         return items[0]
 
-    def update_item(self, kml_id, db_item, file_length, timestamp, empty, author_version=None):
-        logger.debug('Updating dynamodb item with primary key %s', kml_id)
-        db_item['updated'] = timestamp
-        db_item['empty'] = empty
-        db_item['length'] = file_length
-        attribute_updates = {
-            'updated': {
-                'Value': timestamp, 'Action': 'PUT'
-            },
-            'empty': {
-                'Value': empty, 'Action': 'PUT'
-            },
-            'length': {
-                'Value': file_length, 'Action': 'PUT'
-            }
-        }
+    def batch_get_items(self, kml_ids):
+        '''Get the items of several kml_ids, see BatchGet'''
+        return BatchGet(self, kml_ids)
+
+    def update_item(
+        self,
+        kml_id,
+        admin_id,
+        version,
+        file_length,
+        timestamp,
+        empty,
+        author_version=None,
+        sidecars=None,
+        blob_key=None,
+        content_hash=None,
+        conflict_status=409,
+        upload_lease=None
+    ):
+        '''Update the item with a conditional write and increment its version
+
+        The write only succeeds if the item exists, its admin_id matches, it has not been
+        modified since it has been read in the given version and no other update holds its upload
+        lease.
+
+        Args:
+            version: expected version of the item, items written before the versioning have the
+                version 0
+            blob_key: content addressed key of the file, removed from the item if None
+            content_hash: hash of the sanitized kml
+            conflict_status: status code when the version doesn't match; 412 when the version has
+                been given by the client (If-Match), 409 when it has been read by the request
+            upload_lease: expiration timestamp of the lease taken by the update until its file has
+                been uploaded (see release_upload_lease()), the later updates are rejected with 409
+                until then. A file overwritten in place must not be uploaded by an update that has
+                been overtaken by a later one.
+
+        Returns:
+            tuple(previous item, updated item)
+        '''
+        logger.debug('Updating dynamodb item with primary key %s version %s', kml_id, version)
+        updates = {'updated': timestamp, 'empty': empty, 'length': file_length}
         if author_version is not None:
-            attribute_updates['author_version'] = {'Value': author_version, 'Action': 'PUT'}
-            db_item['author_version'] = author_version
+            updates['author_version'] = author_version
+        if sidecars:
+            updates['sidecars'] = sidecars
+        if blob_key:
+            updates['blob_key'] = blob_key
+        if content_hash:
+            updates['content_hash'] = content_hash
+        if upload_lease:
+            updates['upload_lease'] = upload_lease
+        removes = [name for name in ['sidecars', 'blob_key', 'upload_lease'] if name not in updates]
+        names = {
+            f'#{name}': name
+            for name in {*updates, *removes, 'kml_id', 'admin_id', 'version', 'upload_lease'}
+        }
+        values = {f':{name}': value for name, value in updates.items()}
+        values.update({':admin_id': admin_id, ':one': 1, ':now': timestamp})
+        expression = f'SET {", ".join(f"#{name} = :{name}" for name in updates)} ADD #version :one'
+        if removes:
+            expression += f' REMOVE {", ".join(f"#{name}" for name in removes)}'
+        condition = 'attribute_exists(#kml_id) AND #admin_id = :admin_id AND ' \
+            '(attribute_not_exists(#upload_lease) OR #upload_lease < :now) AND '
+        if version:
+            condition += '#version = :version'
+            values[':version'] = version
+        else:
+            condition += 'attribute_not_exists(#version)'
         try:
-            self.table.update_item(Key={'kml_id': kml_id}, AttributeUpdates=attribute_updates)
+            previous_item = self.table.update_item(
+                Key={'kml_id': kml_id},
+                UpdateExpression=expression,
+                ConditionExpression=condition,
+                ExpressionAttributeNames=names,
+                ExpressionAttributeValues=values,
+                ReturnValues='ALL_OLD'
+            )['Attributes']
         except EndpointConnectionError as error:
             logger.exception('Failed to connect to DynamoDB: %s', error)
             abort(502, 'Backend DB connection error, please consult logs')
+        except ClientError as error:
+            if error.response['Error']['Code'] != 'ConditionalCheckFailedException':
+                raise
+            self._abort_update_rejected(kml_id, admin_id, version, conflict_status, timestamp)
+        finally:
+            self.cache.invalidate(('kml_id', kml_id))
 
-        return db_item
+        db_item = {**previous_item, **updates, 'version': version + 1}
+        for name in removes:
+            db_item.pop(name, None)
+        return previous_item, db_item
+
+    def _abort_update_rejected(self, kml_id, admin_id, version, conflict_status, timestamp):
+        item = self.get_item(kml_id, cached=False)
+        if item['admin_id'] != admin_id:
+            logger.error(
+                'Permission denied for kml %s, admin_id=%s, request.form.admin_id=%s',
+                kml_id,
+                item['admin_id'],
+                admin_id
+            )
+            abort(403, "Permission denied")
+        if item.get('version', 0) == version and item.get('upload_lease', '') >= timestamp:
+            logger.error('Kml %s file is being uploaded by a previous update', kml_id)
+            abort(409, 'The kml is being updated concurrently, please retry')
+        logger.error(
+            'Kml %s has been modified, expected version %s, current version %s',
+            kml_id,
+            version,
+            item.get('version', 0)
+        )
+        if conflict_status == 412:
+            abort(412, 'The kml has been modified, its ETag does not match anymore')
+        abort(conflict_status, 'The kml has been modified concurrently, please retry')
+
+    def release_upload_lease(self, kml_id, version):
+        '''Release the upload lease taken by the update of the item to this version'''
+        try:
+            self.table.update_item(
+                Key={'kml_id': kml_id},
+                UpdateExpression='REMOVE #upload_lease',
+                ConditionExpression='#version = :version',
+                ExpressionAttributeNames={
+                    '#upload_lease': 'upload_lease', '#version': 'version'
+                },
+                ExpressionAttributeValues={':version': version}
+            )
+        except EndpointConnectionError as error:
+            # The lease expires anyway
+            logger.error('Failed to release the upload lease of kml %s: %s', kml_id, error)
+        except ClientError as error:
+            if error.response['Error']['Code'] != 'ConditionalCheckFailedException':
+                raise
+            logger.warning('Kml %s has been modified since version %s', kml_id, version)
+        finally:
+            self.cache.invalidate(('kml_id', kml_id))
+
+    def restore_item(self, db_item, version=None):
+        '''Write back an item as it was before a failed update or delete
+
+        Args:
+            version: if given the item is only restored if it still has this version, in order
+                to not overwrite a later update
+        '''
+        logger.debug('Restoring dynamodb item with primary key %s', db_item['kml_id'])
+        kwargs = {}
+        if version is not None:
+            kwargs = {
+                'ConditionExpression': '#version = :version',
+                'ExpressionAttributeNames': {
+                    '#version': 'version'
+                },
+                'ExpressionAttributeValues': {
+                    ':version': version
+                }
+            }
+        try:
+            self.table.put_item(Item=db_item, **kwargs)
+        except EndpointConnectionError as error:
+            logger.exception('Failed to connect to DynamoDB: %s', error)
+            abort(502, 'Backend DB connection error, please consult logs')
+        except ClientError as error:
+            if error.response['Error']['Code'] != 'ConditionalCheckFailedException':
+                raise
+            logger.warning(
+                'Kml %s has been modified since version %s, not restoring it',
+                db_item['kml_id'],
+                version
+            )
+        finally:
+            self.cache.invalidate(('kml_id', db_item['kml_id']))
 
     def delete_item(self, kml_id):
         logger.debug('Deleting dynamodb item with primary key %s', kml_id)
@@ -141,3 +405,99 @@ class DynamoDBFilesHandler:
         except EndpointConnectionError as error:
             logger.exception('Failed to connect to DynamoDB: %s', error)
             abort(502, 'Backend DB connection error, please consult logs')
+        finally:
+            self.cache.invalidate(('kml_id', kml_id))
+
+
+class BatchGet:
+    '''Get several items from the cache and with DynamoDB BatchGetItem
+
+    The cached items and the first BatchGetItem response are fetched on creation, a connection
+    error therefore aborts with 502 before a response is started. Iterating yields lists of items
+    as they are received; the keys left unprocessed by DynamoDB (e.g. throttling) are requested
+    again with an exponential backoff. Once iterated the unknown kml_ids are in not_found and the
+    ones still unprocessed after KML_BATCH_MAX_RETRIES retries (or a connection error) in
+    unprocessed.
+
+    NOTE: the items are not yielded in the order of the kml_ids
+    '''
+
+    # Max number of keys of a BatchGetItem request
+    MAX_KEYS = 100
+    BACKOFF = 0.05
+
+    def __init__(self, db, kml_ids):
+        self.db = db
+        self.not_found = []
+        self.unprocessed = []
+        self._pending = []
+        self._version = db.cache.get_version()
+        self._first_items = []
+        self._throttled = False
+        # BatchGetItem rejects duplicated keys
+        for kml_id in dict.fromkeys(kml_ids):
+            item = db.cache.get(('kml_id', kml_id))
+            if item is None:
+                self.not_found.append(kml_id)
+            elif item is MISS:
+                self._pending.append(kml_id)
+            else:
+                self._first_items.append(item)
+        if self._pending:
+            try:
+                items, self._throttled = self._request()
+            except EndpointConnectionError as error:
+                logger.exception('Failed to connect to DynamoDB: %s', error)
+                abort(502, 'Backend DB connection error, please consult logs')
+            self._first_items.extend(items)
+
+    def _request(self):
+        '''Request the next pending keys, returns the received items and if some keys have not
+        been processed'''
+        keys, self._pending = self._pending[:self.MAX_KEYS], self._pending[self.MAX_KEYS:]
+        logger.debug('Batch get %d dynamodb items', len(keys))
+        response = self.db.dynamodb.batch_get_item(
+            RequestItems={self.db.table.name: {
+                'Keys': [{
+                    'kml_id': kml_id
+                } for kml_id in keys]
+            }}
+        )
+        items = response['Responses'].get(self.db.table.name, [])
+        unprocessed_keys = response.get('UnprocessedKeys', {}).get(self.db.table.name, {})
+        unprocessed = [key['kml_id'] for key in unprocessed_keys.get('Keys', [])]
+        found = {item['kml_id'] for item in items}
+        for kml_id in keys:
+            if kml_id not in found and kml_id not in unprocessed:
+                self.not_found.append(kml_id)
+                self.db.cache.set(('kml_id', kml_id), None, self._version)
+        for item in items:
+            self.db.cache.set(('kml_id', item['kml_id']), item, self._version)
+        self._pending = unprocessed + self._pending
+        return items, bool(unprocessed)
+
+    def __iter__(self):
+        yield self._first_items
+        throttled = self._throttled
+        retries = 0
+        while self._pending:
+            if throttled:
+                if retries >= KML_BATCH_MAX_RETRIES:
+                    logger.error(
+                        'Batch get: %d keys still unprocessed after %d retries',
+                        len(self._pending),
+                        retries
+                    )
+                    break
+                time.sleep(self.BACKOFF * 2**retries * random.uniform(0.5, 1.5))
+                retries += 1
+            try:
+                items, throttled = self._request()
+            except (BotoCoreError, ClientError) as error:
+                # The response has already been started, the remaining keys are returned as
+                # unprocessed
+                logger.exception('Batch get failed: %s', error)
+                break
+            yield items
+        self.unprocessed.extend(self._pending)
+        self._pending = []
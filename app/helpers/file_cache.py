@@ -0,0 +1,197 @@
+'''Local disk cache of the KML files served by /files/<kml_id>
+
+Viewers of a shared map repeatedly download the same KML file, the cache keeps the recently served
+files on the local disk so that they are served without any S3 request. The cache directory can be
+shared by the workers of a host: the files are written to a temporary file and renamed once
+complete, a hit updates the modification time of the file which the eviction uses as LRU order.
+
+An entry is a file with the body of the S3 object and a json file with its headers, named after
+the S3 key and a version. The blobs are immutable, the version of the other files must change with
+their content (e.g. the update time of their item). The outdated entries are never read again and
+are evicted like the others once the total size of the cache exceeds its max size.
+'''
+import hashlib
+import json
+import logging
+import os
+import tempfile
+import time
+from threading import Lock
+
+from app.helpers.metrics import register_collector
+from app.settings import KML_FILE_CACHE_DIR
+from app.settings import KML_FILE_CACHE_MAX_SIZE
+
+logger = logging.getLogger(__name__)
+
+# The eviction removes the least recently used entries until the cache is below this fraction of
+# its max size, so that it doesn't scan the directory on each new entry.
+LOW_WATERMARK = 0.9
+
+# Temporary files which have not been written for this number of seconds are left over by a
+# killed worker, they are removed by the eviction.
+STALE_TEMPORARY_AGE = 300
+
+_cache = None
+_cache_lock = Lock()
+
+
+def get_file_cache():
+    '''Returns the worker file cache, None if KML_FILE_CACHE_DIR is not set'''
+    global _cache  # pylint: disable=global-statement
+    if _cache is None and KML_FILE_CACHE_DIR:
+        with _cache_lock:
+            if _cache is None:
+                _cache = FileCache(KML_FILE_CACHE_DIR, KML_FILE_CACHE_MAX_SIZE)
+    return _cache
+
+
+def collect_file_cache_metrics():
+    cache = _cache
+    if cache is None:
+        return []
+    return [
+        ('counter', 'kml_file_cache_lookups_total', {
+            'result': 'hit'
+        }, cache.hits),
+        ('counter', 'kml_file_cache_lookups_total', {
+            'result': 'miss'
+        }, cache.misses),
+    ]
+
+
+register_collector(collect_file_cache_metrics)
+
+
+class FileCache:
+    '''Size bounded LRU cache of S3 objects on the local disk
+
+    The files bigger than a tenth of the max size are not cached, they would evict most of the
+    cache.
+    '''
+
+    def __init__(self, directory, max_size):
+        self.directory = directory
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+        # Estimated total size of the cache, the other workers sharing the directory also add
+        # entries. It is recomputed from the directory on each eviction.
+        self._size = None
+        self._lock = Lock()
+        os.makedirs(directory, exist_ok=True)
+
+    def _get_path(self, key, version):
+        name = hashlib.sha256(f'{key}\n{version}'.encode('utf-8')).hexdigest()
+        return os.path.join(self.directory, name)
+
+    def open(self, key, version):
+        '''Returns the opened body file and the headers of a cached object, or None'''
+        path = self._get_path(key, version)
+        try:
+            # Opened first, a concurrent eviction doesn't affect an opened file
+            fd = open(path, 'rb')  # pylint: disable=consider-using-with
+        except OSError:
+            self.misses += 1
+            return None
+        try:
+            with open(f'{path}.json', 'r', encoding='utf-8') as headers_fd:
+                headers = json.load(headers_fd)
+            os.utime(path)
+        except (OSError, ValueError) as error:
+            logger.warning('Failed to read the cached file %s: %s', path, error)
+            fd.close()
+            self.misses += 1
+            return None
+        self.hits += 1
+        return fd, headers
+
+    def fill(self, key, version, headers, chunks):
+        '''Yield the chunks of an object body and caches it once all chunks have been read
+
+        The object is not cached if the iteration is not complete, e.g. on a client disconnection
+        or when only a range of the object is sent.
+        '''
+        if headers['size'] > self.max_size // 10:
+            yield from chunks
+            return
+        path = self._get_path(key, version)
+        try:
+            handle, temporary = tempfile.mkstemp(dir=self.directory, suffix='.tmp')
+            fd = os.fdopen(handle, 'wb')
+        except OSError as error:
+            logger.warning('Failed to create a cache file for %s: %s', key, error)
+            yield from chunks
+            return
+        complete = False
+        try:
+            for chunk in chunks:
+                if fd is not None:
+                    try:
+                        fd.write(chunk)
+                    except OSError as error:
+                        logger.warning('Failed to write the cache file of %s: %s', key, error)
+                        fd.close()
+                        fd = None
+                yield chunk
+            complete = fd is not None
+        finally:
+            if fd is not None:
+                fd.close()
+            if complete:
+                self._add(path, temporary, headers)
+            else:
+                self._remove(temporary)
+
+    def _add(self, path, temporary, headers):
+        try:
+            # The headers are written first, an entry is only read once its body exists
+            with open(f'{temporary}.json', 'w', encoding='utf-8') as fd:
+                json.dump(headers, fd)
+            os.replace(f'{temporary}.json', f'{path}.json')
+            os.replace(temporary, path)
+        except OSError as error:
+            logger.warning('Failed to add the cache file %s: %s', path, error)
+            self._remove(temporary, f'{temporary}.json')
+            return
+        with self._lock:
+            if self._size is not None:
+                self._size += headers['size']
+            if self._size is None or self._size > self.max_size:
+                self._evict()
+
+    def _evict(self):
+        entries = []
+        stale = time.time() - STALE_TEMPORARY_AGE
+        for entry in os.scandir(self.directory):
+            temporary = entry.name.endswith(('.tmp', '.tmp.json'))
+            if entry.name.endswith('.json') and not temporary:
+                continue
+            try:
+                stat = entry.stat()
+            except OSError:
+                # Evicted by another worker
+                continue
+            if temporary:
+                if stat.st_mtime < stale:
+                    self._remove(entry.path)
+                continue
+            entries.append((stat.st_mtime, stat.st_size, entry.path))
+        self._size = sum(size for _, size, _ in entries)
+        if self._size <= self.max_size:
+            return
+        for _, size, path in sorted(entries):
+            if self._size <= self.max_size * LOW_WATERMARK:
+                break
+            self._remove(path, f'{path}.json')
+            self._size -= size
+        logger.debug('File cache evicted down to %d bytes', self._size)
+
+    def _remove(self, *paths):
+        for path in paths:
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            except OSError as error:
+                logger.warning('Failed to remove the cache file %s: %s', path, error)
@@ -0,0 +1,587 @@
+'''Streaming processing of uploaded KML files
+
+The KML file is processed chunk by chunk; decompression, decoding, unquoting, sanitizing, XML
+validation and compression are chained so that the document is never held in memory in all its
+intermediate representations at once.
+'''
+import codecs
+import hashlib
+import logging
+import re
+import time
+import zlib
+from urllib.parse import unquote_plus
+from xml.parsers import expat
+
+from defusedxml import EntitiesForbidden
+from defusedxml import ExternalReferenceForbidden
+from defusedxml.ElementTree import DefusedXMLParser
+from defusedxml.ElementTree import ParseError
+
+from flask import abort
+
+from app.helpers.compression import KmlCompressor
+from app.settings import KML_MAX_COMPRESSION_RATIO
+from app.settings import KML_MAX_EXPANDED_SIZE
+from app.settings import KML_MAX_SIZE
+from app.settings import KML_STREAM_CHUNK_SIZE
+from app.settings import MB
+
+logger = logging.getLogger(__name__)
+
+GZIP_MAGIC = b'\x1f\x8b'
+
+_PARTIAL_PERCENT_ESCAPE = re.compile(r'%[0-9A-Fa-f]?')
+_PERCENT_ESCAPE = re.compile(r'%[0-9A-Fa-f]{2}')
+
+
+def is_blank(text):
+    if text is None:
+        return True
+    if text.strip(r'\n\t ') == '':
+        return True
+    return False
+
+
+def unquote_split_index(text):
+    '''Returns the index up to which the text can be unquoted without knowing what follows
+
+    The text is unquoted with urllib.parse.unquote_plus() which decodes consecutive percent escapes
+    as UTF-8, therefore a trailing partial escape (`%` or `%X`) as well as the escapes of a
+    possibly incomplete UTF-8 sequence need to wait for the next chunk.
+    '''
+    end = len(text)
+    percent = text.rfind('%', max(0, end - 2))
+    if percent != -1 and _PARTIAL_PERCENT_ESCAPE.fullmatch(text, percent):
+        end = percent
+    index = end
+    # An UTF-8 sequence is at most 4 bytes long, so we only need to look at the last 4 escapes
+    for _ in range(4):
+        if index < 3 or not _PERCENT_ESCAPE.fullmatch(text, index - 3, index):
+            break
+        if int(text[index - 2:index], 16) & 0xC0 != 0x80:
+            # ASCII or UTF-8 leading byte, keep it together with its continuation bytes
+            return index - 3
+        index -= 3
+    return end
+
+
+class GzipDecoder:
+    '''Incrementally decompress gzipped data, non gzipped data is passed through
+
+    The decompressed data is returned by pieces of at most max_piece bytes. The decompression is
+    aborted with 413 as soon as the decompressed data exceeds max_size or, once it exceeds
+    ratio_threshold, if it is more than max_ratio times larger than the compressed data.
+    '''
+
+    def __init__(
+        self,
+        max_size=KML_MAX_EXPANDED_SIZE,
+        max_ratio=KML_MAX_COMPRESSION_RATIO,
+        ratio_threshold=KML_MAX_SIZE,
+        max_piece=KML_STREAM_CHUNK_SIZE
+    ):
+        self.gzipped = None
+        self.members = 0
+        self.max_size = max_size
+        self.max_ratio = max_ratio
+        self.ratio_threshold = ratio_threshold
+        self.max_piece = max_piece
+        self._head = b''
+        self._decompressor = None
+        self._compressed_size = 0
+        self._size = 0
+
+    def feed(self, data):
+        '''Returns an iterator over the decompressed pieces of data'''
+        if self.gzipped is None:
+            data = self._head + data
+            if len(data) < len(GZIP_MAGIC):
+                self._head = data
+                return iter(())
+            self._head = b''
+            self.gzipped = data.startswith(GZIP_MAGIC)
+            logger.debug('Received %s kml file', 'gzipped' if self.gzipped else 'unzipped')
+        if not self.gzipped:
+            return iter((data,))
+        self._compressed_size += len(data)
+        return self._decompress(data)
+
+    def close(self):
+        if self.gzipped is None:
+            self.gzipped = False
+            return self._head
+        if self.gzipped and self._decompressor is not None:
+            logger.error('Truncated gzipped kml file')
+            abort(400, 'Could not decompress file content')
+        return b''
+
+    def _decompress(self, data):
+        # A gzip file might be made of several members, see gzip.decompress()
+        while True:
+            if self._decompressor is None:
+                if not data:
+                    return
+                self._decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+            try:
+                output = self._decompressor.decompress(data, self.max_piece)
+            except zlib.error as error:
+                logger.error('Could not decompress kml file: %s', error)
+                abort(400, 'Could not decompress file content')
+            self._check_size(len(output))
+            if output:
+                yield output
+            if self._decompressor.eof:
+                data = self._decompressor.unused_data
+                self._decompressor = None
+                self.members += 1
+            else:
+                data = self._decompressor.unconsumed_tail
+                # A full piece means that some output might still be pending
+                if not data and len(output) < self.max_piece:
+                    return
+
+    def _check_size(self, length):
+        self._size += length
+        if self._size > self.max_size:
+            logger.error(
+                'Decompressed KML file too large: more than %d bytes, max allowed=%d bytes',
+                self._size,
+                self.max_size
+            )
+            abort(413, f"Decompressed KML file too large, max allowed={self.max_size / MB}MB")
+        if self._size > self.ratio_threshold and \
+            self._size > self.max_ratio * self._compressed_size:
+            logger.error(
+                'KML file compression ratio too high: %d compressed bytes expand to more than %d '
+                'bytes, max ratio allowed=%d',
+                self._compressed_size,
+                self._size,
+                self.max_ratio
+            )
+            abort(413, f"KML file compression ratio too high, max allowed={self.max_ratio}")
+
+
+class QuotedTextDecoder:
+    '''Incrementally decode bytes into text and unquote it (see urllib.parse.unquote_plus)'''
+
+    def __init__(self, charset='utf-8'):
+        try:
+            self._decoder = codecs.getincrementaldecoder(charset)()
+        except LookupError as error:
+            logger.error("Could not decode file content: %s", error)
+            abort(400, "Could not decode file content")
+        self._pending = ''
+        # True if the unquoting modified the text
+        self.changed = False
+
+    def feed(self, data, final=False):
+        try:
+            text = self._pending + self._decoder.decode(data, final)
+        except UnicodeDecodeError as error:
+            logger.error("Could not decode file content: %s", error)
+            abort(400, "Could not decode file content")
+        split = len(text) if final else unquote_split_index(text)
+        self._pending = text[split:]
+        text = text[:split]
+        unquoted = unquote_plus(text)
+        if unquoted != text:
+            self.changed = True
+        return unquoted
+
+
+class _StreamSanitizer:
+    '''Base class of the incremental sanitizers
+
+    Subclasses implement _sanitize(text, final) which returns the sanitized text and the trailing
+    part of the text which cannot be sanitized yet because it might be the start of a match.
+    '''
+
+    def __init__(self):
+        self.changed = False
+        self._pending = ''
+        self._incoming = []
+        self._incoming_length = 0
+
+    def feed(self, text, final=False):
+        self._incoming.append(text)
+        self._incoming_length += len(text)
+        # The pending text is only scanned again once at least as much new text has been received,
+        # this keeps the sanitizer linear even if a potential match spans the whole document.
+        if not final and self._incoming_length < len(self._pending):
+            return ''
+        text = self._pending + ''.join(self._incoming)
+        self._incoming = []
+        self._incoming_length = 0
+        output, self._pending = self._sanitize(text, final)
+        return output
+
+    def _sanitize(self, text, final):
+        raise NotImplementedError()
+
+
+class _EventAttributeSanitizer(_StreamSanitizer):
+    '''Removes the event handler attributes (e.g. onclick="...")'''
+    # The attribute must not be preceded by a name character, so that e.g. version="1.0" is kept,
+    # but can directly follow the quote of the previous attribute value (e.g. src="x"onerror="y").
+    _NOT_IN_NAME = r'(?<![\w.:-])'
+    _ATTRIBUTE = r'''on\w+\s*=\s*(?:"[^"]*"|'[^']*')'''
+    # Start of an attribute that could only be completed by the next chunk
+    _PARTIAL_ATTRIBUTE = r'''o(?:n\w*(?:\s*(?:=\s*(?:"[^"]*|'[^']*)?)?)?)?\Z'''
+
+    attribute = re.compile(rf'{_NOT_IN_NAME}{_ATTRIBUTE}', re.IGNORECASE)
+    attribute_or_partial = re.compile(
+        rf'{_NOT_IN_NAME}(?:{_ATTRIBUTE}|(?P<partial>{_PARTIAL_ATTRIBUTE}))', re.IGNORECASE
+    )
+
+    def __init__(self):
+        super().__init__()
+        # Last character of the text already sanitized, the lookbehind of the next text
+        self._context = ''
+
+    def _sanitize(self, text, final):
+        text = self._context + text
+        pattern = self.attribute if final else self.attribute_or_partial
+        output = []
+        position = len(self._context)
+        hold = len(text)
+        for match in pattern.finditer(text, position):
+            if not final and match.group('partial') is not None:
+                hold = match.start()
+                break
+            output.append(text[position:match.start()])
+            position = match.end()
+            self.changed = True
+        output.append(text[position:hold])
+        self._context = text[max(hold - 1, 0):hold]
+        return ''.join(output), text[hold:]
+
+
+class _ScriptSanitizer(_StreamSanitizer):
+    '''Replaces the script elements, also html escaped ones (&lt;script&gt;), by a space'''
+    script_start = re.compile(r'(?:<|&lt;)\s*\bscript\b', re.IGNORECASE)
+    script_start_end = re.compile(r'>|&gt;', re.IGNORECASE)
+    script_end = re.compile(r'(?:<|&lt;)/\s*\bscript\b\s*(?:>|&gt;)', re.IGNORECASE)
+    # Start of a script tag that could only be completed by the next chunk, as it contains neither
+    # "<" nor "&" after its first character it can only start at the last of them.
+    partial_script_start = re.compile(
+        r'(?:&(?:lt?)?|(?:<|&lt;)\s*(?:s(?:c(?:r(?:i(?:pt?)?)?)?)?)?)\Z', re.IGNORECASE
+    )
+
+    def _sanitize(self, text, final):
+        output = []
+        position = 0
+        while True:
+            start = self.script_start.search(text, position)
+            if start is None:
+                hold = len(text) if final else self._partial_start(text, position)
+                break
+            if not final and start.end() == len(text):
+                # "<script" might be the beginning of another word (e.g. "<scripts")
+                hold = start.start()
+                break
+            start_end = self.script_start_end.search(text, start.end())
+            end = start_end and self.script_end.search(text, start_end.end())
+            if end is None:
+                # NOTE: if this script element is not closed, none of the following is closed
+                hold = len(text) if final else start.start()
+                break
+            output.append(text[position:start.start()])
+            output.append(' ')
+            position = end.end()
+            self.changed = True
+        output.append(text[position:hold])
+        return ''.join(output), text[hold:]
+
+    def _partial_start(self, text, position):
+        start = max(text.rfind('<', position), text.rfind('&', position))
+        if start >= 0 and self.partial_script_start.match(text, start):
+            return start
+        return len(text)
+
+
+class KmlSanitizer:
+    '''Incrementally removes the event handler attributes and script elements from a KML
+
+    Both steps run in linear time, even on adversarial input, and only hold back the text that
+    could be part of a match that is not yet complete.
+    '''
+
+    def __init__(self):
+        self._attributes = _EventAttributeSanitizer()
+        self._scripts = _ScriptSanitizer()
+
+    @property
+    def changed(self):
+        '''True if some content has been removed'''
+        return self._attributes.changed or self._scripts.changed
+
+    def feed(self, text):
+        return self._scripts.feed(self._attributes.feed(text))
+
+    def close(self):
+        return self._scripts.feed(self._attributes.feed('', final=True), final=True)
+
+
+class _EmptyKmlTarget:
+    '''XML parser target which doesn't build any tree, it only checks if the root is empty
+
+    The root is empty if it has no attributes, no children and no text.
+    '''
+
+    def __init__(self):
+        self.empty = True
+        self._depth = 0
+
+    def start(self, tag, attrib):  # pylint: disable=unused-argument
+        if self._depth > 0 or attrib:
+            self.empty = False
+        self._depth += 1
+
+    def end(self, tag):  # pylint: disable=unused-argument
+        self._depth -= 1
+
+    def data(self, data):
+        if self.empty and self._depth == 1 and not is_blank(data):
+            self.empty = False
+
+    def close(self):
+        return self.empty
+
+
+def _forbid_entity_decl(name, is_parameter_entity, value, *args):  # pylint: disable=unused-argument
+    # args: base, sysid, pubid, notation_name
+    raise EntitiesForbidden(name, value, *args)
+
+
+def _forbid_unparsed_entity_decl(name, *args):
+    raise EntitiesForbidden(name, None, *args)
+
+
+def _forbid_external_entity_ref(*args):
+    # args: context, base, sysid, pubid
+    raise ExternalReferenceForbidden(*args)
+
+
+def create_defused_expat_parser(encoding='utf-8'):
+    '''Returns a raw expat parser configured like the DefusedXMLParser of KmlValidator
+
+    The entity declarations and the external entity references raise a
+    defusedxml.DefusedXmlException. Unlike DefusedXMLParser, the parser doesn't process the
+    namespaces, the element and attribute names are reported as written.
+    '''
+    parser = expat.ParserCreate(encoding)
+    parser.EntityDeclHandler = _forbid_entity_decl
+    parser.UnparsedEntityDeclHandler = _forbid_unparsed_entity_decl
+    parser.ExternalEntityRefHandler = _forbid_external_entity_ref
+    return parser
+
+
+class KmlValidator:
+    '''Incrementally validate a KML document and detect empty documents (e.g. <kml></kml>)
+
+    The document is parsed with a defused expat parser without building any element tree,
+    therefore the memory usage doesn't depend on the document size. As soon as the root is known
+    to be non empty, the element callbacks are removed from the expat parser and the rest of the
+    document is only checked for well-formedness.
+    '''
+
+    def __init__(self):
+        self._target = _EmptyKmlTarget()
+        self._parser = DefusedXMLParser(target=self._target)
+        self._tracking = True
+
+    def feed(self, text):
+        try:
+            self._parser.feed(text)
+        except ParseError as err:
+            self._abort(err)
+        if self._tracking and not self._target.empty:
+            self._stop_tracking()
+
+    def close(self):
+        '''Terminate the validation and returns True if the document is empty'''
+        try:
+            self._parser.close()
+        except ParseError as err:
+            self._abort(err)
+        return self._target.empty
+
+    def _stop_tracking(self):
+        # NOTE: the handlers must not be changed from within an expat callback
+        self._tracking = False
+        parser = self._parser.parser
+        parser.StartElementHandler = None
+        parser.EndElementHandler = None
+        parser.CharacterDataHandler = None
+        # Without handlers everything would go through the python default handler, which is only
+        # needed to reject undefined entities (see xml.etree.ElementTree.XMLParser._default)
+        parser.DefaultHandlerExpand = None
+        parser.SkippedEntityHandler = self._undefined_entity
+
+    def _undefined_entity(self, name, is_parameter_entity):  # pylint: disable=unused-argument
+        parser = self._parser.parser
+        err = expat.error(
+            f'undefined entity &{name};: line {parser.ErrorLineNumber}, '
+            f'column {parser.ErrorColumnNumber}'
+        )
+        err.code = expat.errors.codes[expat.errors.XML_ERROR_UNDEFINED_ENTITY]
+        err.lineno = parser.ErrorLineNumber
+        err.offset = parser.ErrorColumnNumber
+        raise err
+
+    def _abort(self, err):
+        line, column = err.position
+        logger.error("Invalid kml file at line %d, column %d: %s", line, column, err)
+        abort(400, 'Invalid kml file')
+
+
+class KmlProcessor:
+    '''Sanitize, validate and gzip an uploaded KML file in a single streaming pass
+
+    An uploaded gzipped UTF-8 KML file which is not modified by the unquoting and the sanitizing is
+    returned as is, without being compressed again. Otherwise it is gzipped from the first
+    modification on, the unmodified text before it is decompressed again from the upload.
+
+    Usage:
+
+        processor = KmlProcessor(charset)
+        kml_gzip, empty = processor.process(chunks)
+        sidecars = processor.sidecars  # e.g. {'br': b'...'}
+        content_hash = processor.content_hash  # sha256 of the sanitized KML text
+        unchanged = processor.unchanged  # True if kml_gzip is the upload as is
+        timings = processor.timings  # e.g. {'decompress': 0.001, 'validate': 0.004, ...}
+    '''
+
+    def __init__(self, charset='utf-8', passthrough=True, sidecars=None):
+        self.empty = None
+        self.sidecars = None
+        self.content_hash = None
+        self.unchanged = False
+        # Processing time by stage: decompress, decode, sanitize, validate and compress (including
+        # the content hash)
+        self.timings = {}
+        self._stage = None
+        self._stage_started = None
+        self._sidecars = sidecars
+        self._gzip_decoder = GzipDecoder()
+        self._text_decoder = QuotedTextDecoder(charset)
+        self._sanitizer = KmlSanitizer()
+        self._validator = KmlValidator()
+        # Hash of the sanitized UTF-8 text, identical for identical KMLs whatever their upload
+        # encoding and compression
+        self._hash = hashlib.sha256()
+        # The compressor is created once it is known whether the upload is gzipped
+        self._compressor = None
+        # Chunks of the upload, kept until it is known that they cannot be returned as is
+        self._passthrough = passthrough and codecs.lookup(charset).name == 'utf-8'
+        self._chunks = []
+        # Size of the text compressed while the upload could be returned as is, and the gzip
+        # compressor created once it cannot
+        self._passed_size = 0
+        self._gzip = None
+
+    def process(self, chunks):
+        '''Process all chunks and returns the gzipped KML and its empty flag'''
+        for chunk in chunks:
+            self.feed(chunk)
+        return self.close()
+
+    def feed(self, chunk):
+        if self._passthrough:
+            self._chunks.append(chunk)
+        self._switch_stage('decompress')
+        for data in self._gzip_decoder.feed(chunk):
+            self._switch_stage('decode')
+            self._feed_text(self._text_decoder.feed(data))
+            self._switch_stage('decompress')
+        self._switch_stage(None)
+
+    def close(self):
+        self._switch_stage('decompress')
+        data = self._gzip_decoder.close()
+        self._switch_stage('decode')
+        self._feed_text(self._text_decoder.feed(data, final=True))
+        self._switch_stage('sanitize')
+        self._feed_text(self._sanitizer.close(), sanitized=True)
+        self._switch_stage('validate')
+        self.empty = self._validator.close()
+        self._switch_stage('compress')
+        self.content_hash = self._hash.hexdigest()
+        self._check_passthrough()
+        self.sidecars = self._get_compressor().flush()
+        if self._gzip is not None:
+            kml_gzip = self._gzip.flush()['gzip']
+        elif not self._passthrough:
+            kml_gzip = self.sidecars.pop('gzip')
+        else:
+            logger.debug('Uploaded gzipped kml file unchanged, storing it as is')
+            kml_gzip = b''.join(self._chunks)
+            self.unchanged = True
+        self._switch_stage(None)
+        self._chunks = []
+        return kml_gzip, self.empty
+
+    def _switch_stage(self, stage):
+        '''Add the time elapsed since the last switch to the current stage, None to stop'''
+        now = time.perf_counter()
+        if self._stage is not None:
+            self.timings[self._stage
+                        ] = self.timings.get(self._stage, 0.0) + now - self._stage_started
+        self._stage = stage
+        self._stage_started = now
+
+    def _get_compressor(self):
+        if self._compressor is None:
+            self._passthrough = self._passthrough and self._gzip_decoder.gzipped
+            if not self._passthrough:
+                self._chunks = []
+            self._compressor = KmlCompressor(gzip=not self._passthrough, sidecars=self._sidecars)
+        return self._compressor
+
+    def _check_passthrough(self):
+        '''Starts gzipping the text once the upload cannot be returned as is'''
+        # A multi members gzip is only known once its second member is complete
+        if not self._passthrough or (
+            self._gzip_decoder.members <= 1 and not self._text_decoder.changed and
+            not self._sanitizer.changed
+        ):
+            return
+        logger.debug('Uploaded gzipped kml file changed, compressing it again')
+        self._passthrough = False
+        self._gzip = KmlCompressor(sidecars=[])
+        # The text passed so far has not been modified, it is the start of the decompressed upload
+        remaining = self._passed_size
+        for data in self._decompress_chunks():
+            if not remaining:
+                break
+            self._switch_stage('compress')
+            self._gzip.compress(data[:remaining])
+            remaining -= min(len(data), remaining)
+            self._switch_stage('decompress')
+        self._switch_stage('compress')
+        self._chunks = []
+
+    def _decompress_chunks(self):
+        decoder = GzipDecoder()
+        for chunk in self._chunks:
+            yield from decoder.feed(chunk)
+
+    def _feed_text(self, text, sanitized=False):
+        if not sanitized:
+            self._switch_stage('sanitize')
+            text = self._sanitizer.feed(text)
+        if not text:
+            return
+        self._switch_stage('validate')
+        self._validator.feed(text)
+        self._switch_stage('compress')
+        data = text.encode('utf-8')
+        self._hash.update(data)
+        compressor = self._get_compressor()
+        self._check_passthrough()
+        if self._gzip is not None:
+            self._gzip.compress(data)
+        elif self._passthrough:
+            self._passed_size += len(data)
+        compressor.compress(data)
@@ -0,0 +1,229 @@
+'''Feature level patches of a stored KML document
+
+A patch is a list of operations on the Placemarks identified by their id attribute, applied in
+order:
+
+    {"op": "upsert", "id": "<id>", "kml": "<Placemark id=\"<id>\">...</Placemark>"}
+    {"op": "delete", "id": "<id>"}
+
+An upsert replaces the Placemark with this id, or appends it to the first Document of the KML (to
+the root element if there is no Document). The stored document is only scanned (without building
+any tree) to locate its Placemarks, with an expat parser defused like the one of KmlValidator: the
+files stored before the uploads were sanitized and validated may contain entity declarations.
+Only the Placemarks of the patch are sanitized and validated, within the root element of the
+document in order to resolve its namespace prefixes.
+'''
+import hashlib
+import logging
+from xml.parsers import expat
+
+from defusedxml import DefusedXmlException
+
+from flask import abort
+
+from app.helpers.compression import KmlCompressor
+from app.helpers.kml import GzipDecoder
+from app.helpers.kml import KmlSanitizer
+from app.helpers.kml import KmlValidator
+from app.helpers.kml import create_defused_expat_parser
+from app.helpers.kml import is_blank
+from app.settings import KML_MAX_EXPANDED_SIZE
+from app.settings import KML_MAX_SIZE
+
+logger = logging.getLogger(__name__)
+
+PATCH_OPERATIONS = ['upsert', 'delete']
+
+
+def _local_name(name):
+    return name.rpartition(':')[2]
+
+
+def _tag_end(data, start):
+    '''Returns the offset after the tag starting at start, its attribute values may contain ">"'''
+    quote = None
+    for index in range(start, len(data)):
+        char = data[index]
+        if quote is not None:
+            if char == quote:
+                quote = None
+        elif char in b'"\'':
+            quote = char
+        elif char == ord('>'):
+            return index + 1
+    return len(data)
+
+
+class KmlIndex:
+    '''Byte offsets of the Placemarks and of the insertion point of a UTF-8 KML document'''
+
+    def __init__(self, data):
+        self.data = data
+        # Placemark id -> list of (start, end, child of the root)
+        self.placemarks = {}
+        self.root_tag = None
+        self.root_start_tag = None
+        # The root is empty if it has no attributes, no children and no text, see KmlValidator
+        self.root_attributes = False
+        self.root_children = 0
+        self.root_text = False
+        self.insert_at = None
+        self.insert_in_root = True
+        self._document_end = None
+        self._stack = []
+        self._parser = create_defused_expat_parser()
+        self._parser.StartElementHandler = self._start
+        self._parser.EndElementHandler = self._end
+        self._parser.CharacterDataHandler = self._data
+        self._parser.Parse(data, True)
+
+    def _start(self, name, attrs):
+        start = self._parser.CurrentByteIndex
+        start_tag_end = _tag_end(self.data, start)
+        if not self._stack:
+            self.root_tag = name
+            self.root_start_tag = self.data[start:start_tag_end]
+            self.root_attributes = any(not attr.startswith('xmlns') for attr in attrs)
+        elif len(self._stack) == 1:
+            self.root_children += 1
+        empty = self.data[start_tag_end - 2:start_tag_end] == b'/>'
+        self._stack.append((name, start, start_tag_end if empty else None, attrs.get('id', None)))
+
+    def _end(self, name):
+        name, start, end, placemark_id = self._stack.pop()
+        if end is None:
+            # CurrentByteIndex is the start of the end tag, or the end of an empty element
+            end_tag = self._parser.CurrentByteIndex
+            end = _tag_end(self.data, end_tag)
+        else:
+            end_tag = None
+        local_name = _local_name(name)
+        if local_name == 'Placemark' and placemark_id is not None:
+            self.placemarks.setdefault(placemark_id, []).append((start, end, len(self._stack) == 1))
+        elif local_name == 'Document' and end_tag is not None and self._document_end is None:
+            self._document_end = end_tag
+        if not self._stack and end_tag is not None:
+            # New Placemarks are appended to the first Document, else to the root
+            self.insert_in_root = self._document_end is None
+            self.insert_at = end_tag if self.insert_in_root else self._document_end
+
+    def _data(self, text):
+        if len(self._stack) == 1 and not is_blank(text):
+            self.root_text = True
+
+
+def _validate_placemark(index, placemark_id, kml):
+    '''Sanitize and validate the Placemark of an upsert, returns it as UTF-8'''
+    sanitizer = KmlSanitizer()
+    text = sanitizer.feed(kml) + sanitizer.close()
+    root_start_tag = index.root_start_tag.decode('utf-8')
+    validator = KmlValidator()
+    validator.feed(f'{root_start_tag}{text}</{index.root_tag}>')
+    validator.close()
+    # The Placemark must be the only element of the fragment and have the id of the operation
+    elements = []
+    depth = [0]
+    parser = create_defused_expat_parser()
+
+    def start(name, attrs):
+        if depth[0] == 1:
+            elements.append((_local_name(name), attrs.get('id', None)))
+        depth[0] += 1
+
+    def end(name):  # pylint: disable=unused-argument
+        depth[0] -= 1
+
+    def data(content):
+        if depth[0] == 1 and not is_blank(content):
+            elements.append((None, None))
+
+    parser.StartElementHandler = start
+    parser.EndElementHandler = end
+    parser.CharacterDataHandler = data
+    parser.Parse(f'<patch>{text}</patch>'.encode('utf-8'), True)
+    if elements != [('Placemark', placemark_id)]:
+        logger.error('Invalid patch, the kml of %s is not a Placemark with its id', placemark_id)
+        abort(400, f'Invalid patch, the kml of {placemark_id} must be a Placemark with its id')
+    return text.encode('utf-8')
+
+
+def patch_kml(data, operations):
+    '''Apply the patch operations to a UTF-8 KML document
+
+    Returns:
+        tuple(patched document, empty flag)
+    '''
+    try:
+        index = KmlIndex(data)
+    except (expat.error, DefusedXmlException) as error:
+        logger.error('Invalid patch, the stored kml cannot be parsed: %s', error)
+        abort(400, 'Invalid patch, the kml cannot be patched')
+    if index.insert_at is None:
+        logger.error('Invalid patch, the kml root element has no end tag')
+        abort(400, 'Invalid patch, the kml cannot be patched')
+    # Placemark id -> new Placemark, None if deleted. The ids which are not in the document are
+    # appended in their order of insertion.
+    changes = {}
+    for operation in operations:
+        placemark_id = operation['id']
+        spans = index.placemarks.get(placemark_id, [])
+        if len(spans) > 1:
+            logger.error('Invalid patch, several Placemarks have the id %s', placemark_id)
+            abort(400, f'Invalid patch, several Placemarks have the id {placemark_id}')
+        if operation['op'] == 'delete':
+            if not spans and changes.get(placemark_id, None) is None:
+                logger.error('Invalid patch, unknown Placemark %s', placemark_id)
+                abort(400, f'Invalid patch, unknown Placemark {placemark_id}')
+            if spans:
+                changes[placemark_id] = None
+            else:
+                del changes[placemark_id]
+        else:
+            changes[placemark_id] = _validate_placemark(index, placemark_id, operation['kml'])
+
+    edits = []
+    appended = []
+    root_children = index.root_children
+    for placemark_id, placemark in changes.items():
+        if placemark_id in index.placemarks:
+            start, end, in_root = index.placemarks[placemark_id][0]
+            edits.append((start, end, placemark or b''))
+            if placemark is None and in_root:
+                root_children -= 1
+        else:
+            appended.append(placemark)
+            if index.insert_in_root:
+                root_children += 1
+    if appended:
+        edits.append((index.insert_at, index.insert_at, b''.join(appended)))
+
+    output = []
+    position = 0
+    for start, end, replacement in sorted(edits, key=lambda edit: edit[0]):
+        output.extend((data[position:start], replacement))
+        position = end
+    output.append(data[position:])
+    empty = not index.root_attributes and not index.root_text and root_children == 0
+    return b''.join(output), empty
+
+
+def apply_kml_patch(kml_gzip, operations):
+    '''Patch a stored gzipped KML, returns the same as KmlProcessor
+
+    Returns:
+        tuple(gzipped kml, empty flag, sidecars, content hash)
+    '''
+    decoder = GzipDecoder(max_size=KML_MAX_EXPANDED_SIZE)
+    data = b''.join([*decoder.feed(kml_gzip), decoder.close()])
+    patched, empty = patch_kml(data, operations)
+    if len(patched) > KML_MAX_EXPANDED_SIZE:
+        logger.error('Patched kml too large: %d bytes', len(patched))
+        abort(413, 'Patched kml too large')
+    compressor = KmlCompressor()
+    compressor.compress(patched)
+    sidecars = compressor.flush()
+    kml_string_gzip = sidecars.pop('gzip')
+    if len(kml_string_gzip) > KML_MAX_SIZE:
+        logger.error('Patched kml too large: %d bytes gzipped', len(kml_string_gzip))
+        abort(413, 'Patched kml too large')
+    return kml_string_gzip, empty, sidecars, hashlib.sha256(patched).hexdigest()
@@ -0,0 +1,327 @@
+'''Prometheus metrics of the service
+
+The metrics are recorded in memory by each worker process and exposed by /metrics in the Prometheus
+text format. The gunicorn workers don't share any memory, when started by wsgi.py (see
+init_metrics()) each worker periodically writes a snapshot of its metrics to a directory shared by
+the workers, and /metrics merges the snapshots of the other workers with the current metrics of
+the worker serving it. The counters and histograms of the exited workers are kept so that the
+merged counters never decrease, their gauges are dropped.
+'''
+import json
+import logging
+import os
+import time
+from bisect import bisect_left
+from threading import Event
+from threading import Lock
+from threading import Thread
+
+logger = logging.getLogger(__name__)
+
+DURATION_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+# Name -> (type, help) of the exposed metrics
+METRICS = {
+    'kml_http_requests_total': ('counter', 'Number of HTTP requests'),
+    'kml_http_request_duration_seconds': ('histogram', 'Duration of the HTTP requests'),
+    'kml_http_request_bytes_total': ('counter', 'Size of the HTTP request bodies'),
+    'kml_http_response_bytes_total': ('counter', 'Size of the HTTP response bodies'),
+    'kml_http_requests_in_flight': ('gauge', 'Number of HTTP requests being processed'),
+    'kml_stage_duration_seconds':
+        (
+            'histogram',
+            'Duration of the stages of the requests: multipart_parse, decompress, decode, '
+            'sanitize, validate, compress, s3 and dynamodb (per call)'
+        ),
+    'kml_backend_pool_connections':
+        ('gauge', 'Number of connections of the S3 and DynamoDB connection pools'),
+    'kml_metadata_cache_lookups_total': ('counter', 'Number of lookups in the metadata cache'),
+    'kml_file_cache_lookups_total': ('counter', 'Number of lookups in the KML file cache'),
+}
+
+STAGE_DURATION = 'kml_stage_duration_seconds'
+
+
+def _labels(labels):
+    return tuple(sorted(labels.items()))
+
+
+class Registry:
+    '''In memory metrics of a worker
+
+    The collectors are functions called on each snapshot, they return the current value of
+    metrics maintained elsewhere as a list of tuple(type, name, labels dict, value).
+    '''
+
+    def __init__(self):
+        self._lock = Lock()
+        self._counters = {}
+        # (name, labels) -> number of observations per bucket (not cumulated, +Inf last) and sum
+        self._histograms = {}
+        self._gauges = {}
+        self._collectors = []
+
+    def inc(self, name, value=1, **labels):
+        key = (name, _labels(labels))
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + value
+
+    def add(self, name, value, **labels):
+        '''Add value (negative to subtract) to a gauge'''
+        key = (name, _labels(labels))
+        with self._lock:
+            self._gauges[key] = self._gauges.get(key, 0) + value
+
+    def observe(self, name, value, **labels):
+        key = (name, _labels(labels))
+        with self._lock:
+            histogram = self._histograms.get(key, None)
+            if histogram is None:
+                histogram = self._histograms[key] = [0] * (len(DURATION_BUCKETS) + 1) + [0.0]
+            histogram[bisect_left(DURATION_BUCKETS, value)] += 1
+            histogram[-1] += value
+
+    def register_collector(self, collector):
+        self._collectors.append(collector)
+
+    def clear(self):
+        with self._lock:
+            self._counters.clear()
+            self._histograms.clear()
+            self._gauges.clear()
+
+    def snapshot(self, gauges=True):
+        '''Returns the metrics as a json serializable dict'''
+        with self._lock:
+            snapshot = {
+                'counters':
+                    [[name, labels, value] for (name, labels), value in self._counters.items()],
+                'histograms':
+                    [
+                        [name, labels, list(value)]
+                        for (name, labels), value in self._histograms.items()
+                    ],
+                'gauges':
+                    [[name, labels, value] for (name, labels), value in self._gauges.items()]
+                    if gauges else [],
+            }
+        for collector in self._collectors:
+            try:
+                collected = collector()
+            except Exception as error:  # pylint: disable=broad-except
+                logger.exception('Metrics collector %s failed: %s', collector, error)
+                continue
+            for metric_type, name, labels, value in collected:
+                if metric_type == 'counter' or gauges:
+                    snapshot[f'{metric_type}s'].append([name, _labels(labels), value])
+        return snapshot
+
+
+def merge_snapshots(snapshots):
+    '''Sum the counters, histograms and gauges of several snapshots
+
+    Returns:
+        dict of (name, labels) -> value, or list of the bucket counts and sum for the histograms
+    '''
+    merged = {}
+    for snapshot in snapshots:
+        for kind in ['counters', 'gauges']:
+            for name, labels, value in snapshot[kind]:
+                key = (name, tuple(map(tuple, labels)))
+                merged[key] = merged.get(key, 0) + value
+        for name, labels, value in snapshot['histograms']:
+            key = (name, tuple(map(tuple, labels)))
+            if key in merged:
+                merged[key] = [total + count for total, count in zip(merged[key], value)]
+            else:
+                merged[key] = list(value)
+    return merged
+
+
+def _format_labels(labels):
+    if not labels:
+        return ''
+    escaped = (
+        (key, str(value).replace('\\', r'\\').replace('"', r'\"').replace('\n', r'\n'))
+        for key, value in labels
+    )
+    return '{' + ','.join(f'{key}="{value}"' for key, value in escaped) + '}'
+
+
+def format_metrics(merged):
+    '''Returns the merged metrics in the Prometheus text format'''
+    lines = []
+    for metric, (metric_type, description) in METRICS.items():
+        samples = sorted(
+            (labels, value) for (name, labels), value in merged.items() if name == metric
+        )
+        if not samples:
+            continue
+        lines.append(f'# HELP {metric} {description}')
+        lines.append(f'# TYPE {metric} {metric_type}')
+        for labels, value in samples:
+            if metric_type != 'histogram':
+                lines.append(f'{metric}{_format_labels(labels)} {value}')
+                continue
+            cumulated = 0
+            for bound, count in zip([*DURATION_BUCKETS, '+Inf'], value[:-1]):
+                cumulated += count
+                bucket_labels = _format_labels((*labels, ('le', str(bound))))
+                lines.append(f'{metric}_bucket{bucket_labels} {cumulated}')
+            lines.append(f'{metric}_sum{_format_labels(labels)} {value[-1]}')
+            lines.append(f'{metric}_count{_format_labels(labels)} {cumulated}')
+    return '\n'.join(lines) + '\n'
+
+
+class SnapshotWriter:
+    '''Periodically write the snapshot of the worker metrics in the shared directory'''
+
+    def __init__(self, registry, directory, interval):
+        self.registry = registry
+        self.directory = directory
+        self.interval = interval
+        self.path = os.path.join(directory, f'worker-{os.getpid()}.json')
+        self._stopped = Event()
+        self._thread = Thread(target=self._run, name='metrics-writer', daemon=True)
+
+    def start(self):
+        os.makedirs(self.directory, exist_ok=True)
+        self.write()
+        self._thread.start()
+
+    def stop(self):
+        self._stopped.set()
+        # The exited worker only keeps its counters and histograms
+        self.write(gauges=False)
+
+    def _run(self):
+        while not self._stopped.wait(self.interval):
+            self.write()
+
+    def write(self, gauges=True):
+        try:
+            temporary = f'{self.path}.tmp'
+            with open(temporary, 'w', encoding='utf-8') as fd:
+                json.dump(self.registry.snapshot(gauges=gauges), fd)
+            os.replace(temporary, self.path)
+        except OSError as error:
+            logger.error('Failed to write the metrics snapshot %s: %s', self.path, error)
+
+    def read_others(self):
+        '''Returns the snapshots of the other workers
+
+        The gauges of a snapshot that has not been written for several intervals are dropped, its
+        worker has been killed without writing its final snapshot.
+        '''
+        snapshots = []
+        expired = time.time() - 3 * self.interval
+        for entry in os.scandir(self.directory):
+            if not entry.name.endswith('.json') or entry.path == self.path:
+                continue
+            try:
+                with open(entry.path, 'r', encoding='utf-8') as fd:
+                    snapshot = json.load(fd)
+                if entry.stat().st_mtime < expired:
+                    snapshot['gauges'] = []
+            except (OSError, ValueError) as error:
+                logger.error('Failed to read the metrics snapshot %s: %s', entry.path, error)
+                continue
+            snapshots.append(snapshot)
+        return snapshots
+
+
+_registry = Registry()
+_writer = None
+
+
+def inc_counter(name, value=1, **labels):
+    _registry.inc(name, value, **labels)
+
+
+def add_gauge(name, value, **labels):
+    _registry.add(name, value, **labels)
+
+
+def observe(name, value, **labels):
+    _registry.observe(name, value, **labels)
+
+
+def observe_stages(timings):
+    '''Record the durations of the stages of a request, e.g. KmlProcessor.timings'''
+    for stage, duration in timings.items():
+        _registry.observe(STAGE_DURATION, duration, stage=stage)
+
+
+def register_collector(collector):
+    _registry.register_collector(collector)
+
+
+def clear_metrics_dir(directory):
+    '''Remove the snapshots of the previous workers (e.g. on gunicorn master start)'''
+    os.makedirs(directory, exist_ok=True)
+    for entry in os.scandir(directory):
+        if entry.name.startswith('worker-'):
+            os.remove(entry.path)
+
+
+def init_metrics(directory, interval):
+    '''Share the metrics of the worker with the other workers, must be called after the fork'''
+    global _writer  # pylint: disable=global-statement
+    _registry.clear()
+    _writer = SnapshotWriter(_registry, directory, interval)
+    _writer.start()
+
+
+def close_metrics():
+    global _writer  # pylint: disable=global-statement
+    if _writer is not None:
+        _writer.stop()
+    _writer = None
+
+
+def render_metrics():
+    '''Returns the metrics of all workers in the Prometheus text format'''
+    snapshots = [_registry.snapshot()]
+    if _writer is not None:
+        snapshots.extend(_writer.read_others())
+    return format_metrics(merge_snapshots(snapshots))
+
+
+def instrument_client(client, stage):
+    '''Record the duration of the calls of a boto3 client, including their retries'''
+
+    def before_call(context, **kwargs):  # pylint: disable=unused-argument
+        context['metrics_started'] = time.perf_counter()
+
+    def after_call(context, **kwargs):  # pylint: disable=unused-argument
+        started = context.pop('metrics_started', None)
+        if started is not None:
+            _registry.observe(STAGE_DURATION, time.perf_counter() - started, stage=stage)
+
+    client.meta.events.register('before-call', before_call)
+    client.meta.events.register('after-call', after_call)
+    client.meta.events.register('after-call-error', after_call)
+
+
+def get_pool_connections(client, service):
+    '''Returns the connections in use and idle of the connection pools of a boto3 client'''
+    try:
+        # pylint: disable=protected-access
+        pools = client._endpoint.http_session._manager.pools
+        pools = [pools[key] for key in pools.keys()]
+    except (AttributeError, KeyError):
+        return []
+    in_use = 0
+    idle = 0
+    for pool in pools:
+        # The queue of a pool holds its idle connections and None for the connections not opened
+        in_use += pool.pool.maxsize - pool.pool.qsize()
+        idle += sum(1 for connection in list(pool.pool.queue) if connection is not None)
+    return [
+        ('gauge', 'kml_backend_pool_connections', {
+            'service': service, 'state': 'in_use'
+        }, in_use),
+        ('gauge', 'kml_backend_pool_connections', {
+            'service': service, 'state': 'idle'
+        }, idle),
+    ]
@@ -0,0 +1,115 @@
+'''Pool of native threads for the CPU bound KML processing
+
+The service runs in gevent workers where all the requests of a worker share a single OS thread;
+decompressing, sanitizing, validating and compressing a KML would block every other request
+(including the /checker probe) for its whole duration. When KML_PROCESSING_POOL_SIZE is set this
+work is dispatched to a bounded pool of native threads while the request greenlet waits for the
+result.
+'''
+import logging
+import time
+from concurrent import futures
+from threading import BoundedSemaphore
+from threading import Lock
+
+from gevent import monkey
+from gevent.threadpool import ThreadPoolExecutor as GeventThreadPoolExecutor
+
+from flask import abort
+from flask import g
+
+from app.settings import KML_PROCESSING_POOL_SIZE
+from app.settings import KML_PROCESSING_QUEUE_SIZE
+
+logger = logging.getLogger(__name__)
+
+_pool = None
+_pool_lock = Lock()
+
+
+def get_processing_pool():
+    '''Returns the processing pool of the worker or None if the processing is done inline'''
+    global _pool  # pylint: disable=global-statement
+    if _pool is None and KML_PROCESSING_POOL_SIZE > 0:
+        with _pool_lock:
+            if _pool is None:
+                _pool = ProcessingPool(KML_PROCESSING_POOL_SIZE, KML_PROCESSING_QUEUE_SIZE)
+    return _pool
+
+
+def init_processing_pool():
+    '''Starts the processing pool, must be called after the worker has been forked'''
+    get_processing_pool()
+
+
+def close_processing_pool():
+    global _pool  # pylint: disable=global-statement
+    with _pool_lock:
+        if _pool is not None:
+            _pool.close()
+        _pool = None
+
+
+def run_kml_processing(func, *args):
+    '''Run the KML processing function, in the processing pool if enabled
+
+    The time spent waiting for a thread and executing is recorded in g.kml_processing.
+    '''
+    pool = get_processing_pool()
+    if pool is None:
+        started = time.perf_counter()
+        try:
+            return func(*args)
+        finally:
+            g.kml_processing = {'queued': 0.0, 'executing': time.perf_counter() - started}
+    return pool.run(func, *args)
+
+
+class ProcessingPool:
+
+    def __init__(self, size, queue_size):
+        self.size = size
+        self.queue_size = queue_size
+        # Number of tasks either executing or waiting for a thread
+        self._slots = BoundedSemaphore(size + queue_size)
+        if monkey.is_module_patched('threading'):
+            # The threads of concurrent.futures would be greenlets, gevent provides native ones
+            self._executor = GeventThreadPoolExecutor(max_workers=size)
+        else:
+            self._executor = futures.ThreadPoolExecutor(
+                max_workers=size, thread_name_prefix='kml-processing'
+            )
+
+    def run(self, func, *args):
+        '''Run func in a thread of the pool and wait for its result
+
+        Aborts with 503 when all threads are busy and the queue is full.
+        '''
+        if not self._slots.acquire(blocking=False):
+            logger.error(
+                'KML processing pool saturated: size=%d, queue_size=%d', self.size, self.queue_size
+            )
+            abort(503, 'Service overloaded, please retry later')
+        timings = {}
+
+        def task():
+            timings['started'] = time.perf_counter()
+            try:
+                return func(*args)
+            finally:
+                timings['ended'] = time.perf_counter()
+
+        submitted = time.perf_counter()
+        try:
+            return self._executor.submit(task).result()
+        finally:
+            self._slots.release()
+            started = timings.get('started', submitted)
+            g.kml_processing = {
+                'queued': started - submitted,
+                'executing': timings.get('ended', started) - started,
+            }
+            logger.debug('KML processing durations: %s', g.kml_processing)
+
+    def close(self):
+        self._executor.shutdown(wait=False)
@@ -0,0 +1,63 @@
+'''Extras of the response log records
+
+The response of every request is logged with its headers and json payload. Building them (copying
+the headers and parsing the json body again) is a noticeable share of the request CPU time, while
+the record may be dropped by the level of the handlers or only formatted with its message. The
+extras are therefore only computed when a formatter accesses them.
+'''
+import random
+from collections.abc import MutableMapping
+
+from app.settings import LOG_RESPONSE_HEADERS
+from app.settings import LOG_RESPONSE_SAMPLE_RATE
+
+
+class LazyResponseExtra(MutableMapping):
+    '''The `response` extra of a log record, its headers and json are computed on first access
+
+    It is a mapping, as the dict it replaces, in order to be accessed by the dotted keys of the json
+    formatter (e.g. response.headers.).
+    '''
+
+    KEYS = ('status_code', 'headers', 'json')
+
+    def __init__(self, response, headers=LOG_RESPONSE_HEADERS):
+        self._response = response
+        # Lower case names of the logged headers, None to log all headers
+        self._headers = headers
+        self._values = {'status_code': response.status_code}
+
+    def __getitem__(self, key):
+        if key not in self._values:
+            if key == 'headers':
+                self._values[key] = {
+                    name: value
+                    for name, value in self._response.headers.items()
+                    if self._headers is None or name.lower() in self._headers
+                }
+            elif key == 'json':
+                # Reading the json of a streamed response would buffer it
+                self._values[key] = None if self._response.is_streamed else self._response.json
+            else:
+                raise KeyError(key)
+        return self._values[key]
+
+    def __setitem__(self, key, value):
+        self._values[key] = value
+
+    def __delitem__(self, key):
+        del self._values[key]
+
+    def __iter__(self):
+        return iter(self.KEYS)
+
+    def __len__(self):
+        return len(self.KEYS)
+
+    def __repr__(self):
+        return repr(dict(self))
+
+
+def is_response_sampled(response, rate=LOG_RESPONSE_SAMPLE_RATE):
+    '''Returns True if the response must be logged, the error responses are always logged'''
+    return response.status_code >= 400 or rate >= 1 or random.random() < rate
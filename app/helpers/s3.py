@@ -1,9 +1,11 @@
 import logging
+from collections import deque
+from functools import partial
+from threading import Lock
 
 from urllib3.exceptions import HTTPError
 
 from flask import abort
-from flask import g
 
 import boto3
 
@@ -11,20 +13,64 @@ from botocore.client import Config
 from botocore.exceptions import ClientError
 from botocore.exceptions import EndpointConnectionError
 
+from app.helpers.compression import sidecar_key
+from app.helpers.concurrency import compensate
+from app.helpers.concurrency import raise_first_error
+from app.helpers.concurrency import run_concurrently
+from app.helpers.metrics import get_pool_connections
+from app.helpers.metrics import instrument_client
+from app.helpers.metrics import register_collector
+from app.settings import AWS_MAX_POOL_CONNECTIONS
 from app.settings import AWS_S3_BUCKET_NAME
 from app.settings import AWS_S3_ENDPOINT_URL
 from app.settings import AWS_S3_REGION_NAME
+from app.settings import AWS_TCP_KEEPALIVE
 from app.settings import KML_FILE_CACHE_CONTROL
 from app.settings import KML_FILE_CONTENT_ENCODING
 from app.settings import KML_FILE_CONTENT_TYPE
+from app.settings import KML_MULTIPART_CONCURRENCY
+from app.settings import KML_MULTIPART_PART_SIZE
+from app.settings import KML_MULTIPART_THRESHOLD
 
 logger = logging.getLogger(__name__)
 
+# The S3 handler is shared by all requests (greenlets) of a worker process. boto3 clients are
+# thread safe, sharing them avoids loading the service model, resolving the credentials and
+# opening new HTTPS connections on each request.
+_storage = None
+_storage_lock = Lock()
+
 
 def get_storage():
-    if 'storage' not in g:
-        g.storage = S3FileHandling(AWS_S3_REGION_NAME, AWS_S3_ENDPOINT_URL)
-    return g.storage
+    '''Returns the worker S3 file handler, creating it on first use'''
+    global _storage  # pylint: disable=global-statement
+    if _storage is None:
+        with _storage_lock:
+            if _storage is None:
+                _storage = S3FileHandling(AWS_S3_REGION_NAME, AWS_S3_ENDPOINT_URL)
+    return _storage
+
+
+def init_storage():
+    '''Eagerly create the worker S3 file handler (e.g. on gunicorn worker start)'''
+    get_storage()
+
+
+def close_storage():
+    '''Close the worker S3 file handler and its connection pool'''
+    global _storage  # pylint: disable=global-statement
+    with _storage_lock:
+        if _storage is not None:
+            _storage.close()
+        _storage = None
+
+
+def collect_storage_metrics():
+    storage = _storage
+    return get_pool_connections(storage.s3, 's3') if storage is not None else []
+
+
+register_collector(collect_storage_metrics)
 
 
 def get_s3_client(region, endpoint_url):
@@ -37,7 +83,11 @@ def get_s3_client(region, endpoint_url):
         's3',
         endpoint_url=endpoint_url,
         region_name=region,
-        config=Config(signature_version='s3v4')
+        config=Config(
+            signature_version='s3v4',
+            max_pool_connections=AWS_MAX_POOL_CONNECTIONS,
+            tcp_keepalive=AWS_TCP_KEEPALIVE
+        )
     )
 
 
@@ -45,18 +95,34 @@ class S3FileHandling:
 
     def __init__(self, region, endpoint_url):
         self.s3 = get_s3_client(region, endpoint_url)  # pylint: disable=invalid-name
+        instrument_client(self.s3, 's3')
+
+    def close(self):
+        logger.debug('Closing S3 client')
+        self.s3.close()
 
-    def get_file_from_bucket(self, file_key):
+    def get_file_from_bucket(self, file_key, **conditions):
+        '''Get an object, conditions are get_object arguments like Range or IfNoneMatch
+
+        A not modified object (304) returns the S3 error response, which has no Body, a range
+        which is not satisfiable aborts with 416.
+        '''
         # pylint: disable=duplicate-code
         try:
-            response = self.s3.get_object(Bucket=AWS_S3_BUCKET_NAME, Key=file_key)
+            response = self.s3.get_object(Bucket=AWS_S3_BUCKET_NAME, Key=file_key, **conditions)
         except EndpointConnectionError as error:
             logger.exception('Failed to connect to S3: %s', error)
             abort(502, 'Backend file storage connection error, please consult logs')
         except ClientError as error:
-            if error.response['Error']['Code'] == "NoSuchKey":
+            code = error.response['Error']['Code']
+            if code == "NoSuchKey":
                 logger.exception('Object with the given key %s not found in s3 bucket.', file_key)
                 abort(404, f'Object with the given key {file_key} not found in s3 bucket.')
+            if code == '304':
+                return error.response
+            if code == 'InvalidRange':
+                abort(416)
+            raise
         # pylint: enable=duplicate-code
         return response
 
@@ -75,7 +141,9 @@ class S3FileHandling:
             abort(502, 'Backend file storage connection error, please consult logs')
         return response
 
-    def upload_object_to_bucket(self, file_key, data):
+    def upload_object_to_bucket(self, file_key, data, content_encoding=KML_FILE_CONTENT_ENCODING):
+        if KML_MULTIPART_THRESHOLD and len(data) >= KML_MULTIPART_THRESHOLD:
+            return self.upload_multipart_to_bucket(file_key, data, content_encoding)
         logger.debug("Uploading file %s to bucket %s.", file_key, AWS_S3_BUCKET_NAME)
         try:
             response = self.s3.put_object(
@@ -83,10 +151,201 @@ class S3FileHandling:
                 Bucket=AWS_S3_BUCKET_NAME,
                 Key=file_key,
                 ContentType=KML_FILE_CONTENT_TYPE,
-                ContentEncoding=KML_FILE_CONTENT_ENCODING,
+                ContentEncoding=content_encoding,
+                CacheControl=KML_FILE_CACHE_CONTROL
+            )
+        except EndpointConnectionError as error:
+            logger.exception('Failed to connect to S3: %s', error)
+            abort(502, 'Backend file storage connection error, please consult logs')
+        return response
+
+    def upload_multipart_to_bucket(
+        self, file_key, data, content_encoding=KML_FILE_CONTENT_ENCODING
+    ):
+        '''Upload a large file in parts, KML_MULTIPART_CONCURRENCY parts at a time
+
+        A failing part is retried on its own (by the botocore retries) instead of the whole file.
+        If a part finally fails the multipart upload is aborted, S3 would otherwise keep (and
+        bill) its uploaded parts.
+        '''
+        logger.debug("Uploading file %s to bucket %s in parts.", file_key, AWS_S3_BUCKET_NAME)
+        try:
+            upload_id = self.s3.create_multipart_upload(
+                Bucket=AWS_S3_BUCKET_NAME,
+                Key=file_key,
+                ContentType=KML_FILE_CONTENT_TYPE,
+                ContentEncoding=content_encoding,
+                CacheControl=KML_FILE_CACHE_CONTROL
+            )['UploadId']
+        except EndpointConnectionError as error:
+            logger.exception('Failed to connect to S3: %s', error)
+            abort(502, 'Backend file storage connection error, please consult logs')
+
+        pending = deque(enumerate(range(0, len(data), KML_MULTIPART_PART_SIZE), start=1))
+        parts = {}
+
+        def upload_parts():
+            # Each worker uploads the next pending part until there is none left
+            while pending:
+                try:
+                    number, offset = pending.popleft()
+                except IndexError:
+                    return
+                try:
+                    response = self.s3.upload_part(
+                        Bucket=AWS_S3_BUCKET_NAME,
+                        Key=file_key,
+                        UploadId=upload_id,
+                        PartNumber=number,
+                        Body=data[offset:offset + KML_MULTIPART_PART_SIZE]
+                    )
+                except Exception:
+                    # Stop the other workers
+                    pending.clear()
+                    raise
+                parts[number] = response['ETag']
+
+        try:
+            raise_first_error(
+                run_concurrently(*[upload_parts] * min(KML_MULTIPART_CONCURRENCY, len(pending)))
+            )
+            completed = [
+                {
+                    'PartNumber': number, 'ETag': etag
+                } for number, etag in sorted(parts.items())
+            ]
+            response = self.s3.complete_multipart_upload(
+                Bucket=AWS_S3_BUCKET_NAME,
+                Key=file_key,
+                UploadId=upload_id,
+                MultipartUpload={'Parts': completed}
+            )
+        except Exception as error:
+            compensate(
+                f'abort multipart upload {upload_id} of {file_key}',
+                partial(
+                    self.s3.abort_multipart_upload,
+                    Bucket=AWS_S3_BUCKET_NAME,
+                    Key=file_key,
+                    UploadId=upload_id
+                )
+            )
+            if isinstance(error, EndpointConnectionError):
+                logger.exception('Failed to connect to S3: %s', error)
+                abort(502, 'Backend file storage connection error, please consult logs')
+            raise
+        return response
+
+    def copy_object_in_bucket(
+        self, copy_source, file_key, content_encoding=KML_FILE_CONTENT_ENCODING
+    ):
+        '''Copy an object within the bucket, without transferring its data through the service
+
+        Args:
+            copy_source: tuple(key, etag) of the source object, the copy fails with 409 if the
+                source has been modified in the meantime
+        '''
+        source_key, source_etag = copy_source
+        logger.debug(
+            "Copying file %s to %s in bucket %s.", source_key, file_key, AWS_S3_BUCKET_NAME
+        )
+        try:
+            response = self.s3.copy_object(
+                Bucket=AWS_S3_BUCKET_NAME,
+                Key=file_key,
+                CopySource={
+                    'Bucket': AWS_S3_BUCKET_NAME, 'Key': source_key
+                },
+                CopySourceIfMatch=source_etag,
+                MetadataDirective='REPLACE',
+                ContentType=KML_FILE_CONTENT_TYPE,
+                ContentEncoding=content_encoding,
                 CacheControl=KML_FILE_CACHE_CONTROL
             )
         except EndpointConnectionError as error:
             logger.exception('Failed to connect to S3: %s', error)
             abort(502, 'Backend file storage connection error, please consult logs')
+        except ClientError as error:
+            if error.response['Error']['Code'] in ('PreconditionFailed', '412'):
+                logger.error('Object %s modified while being copied to %s', source_key, file_key)
+                abort(409, f'Object {source_key} has been modified in the meantime')
+            raise
         return response
+
+    def generate_upload_post(self, file_key, max_size, expires):
+        '''Returns the url and form fields of a presigned POST uploading a KML file to file_key
+
+        The KML media type (with an optional charset) and the size limit are enforced by S3.
+        '''
+        return self.s3.generate_presigned_post(
+            Bucket=AWS_S3_BUCKET_NAME,
+            Key=file_key,
+            Fields={'Content-Type': KML_FILE_CONTENT_TYPE},
+            Conditions=[
+                ['starts-with', '$Content-Type', KML_FILE_CONTENT_TYPE],
+                ['content-length-range', 1, max_size],
+            ],
+            ExpiresIn=expires
+        )
+
+    def file_exists_in_bucket(self, file_key):
+        try:
+            self.s3.head_object(Bucket=AWS_S3_BUCKET_NAME, Key=file_key)
+        except EndpointConnectionError as error:
+            logger.exception('Failed to connect to S3: %s', error)
+            abort(502, 'Backend file storage connection error, please consult logs')
+        except ClientError as error:
+            if error.response['Error']['Code'] in ('404', 'NoSuchKey'):
+                return False
+            raise
+        return True
+
+    def upload_blob_to_bucket(self, blob_key, data, sidecars, copy_source=None):
+        '''Upload a content addressed file and its sidecars, unless they are already stored
+
+        The existence of the objects is checked concurrently, only the missing ones are uploaded.
+        With a copy_source (see copy_object_in_bucket()) the file is copied from this object
+        instead of being uploaded.
+
+        Returns:
+            list of the uploaded keys
+        '''
+        objects = {blob_key: (data, KML_FILE_CONTENT_ENCODING)}
+        for encoding, sidecar_data in sidecars.items():
+            objects[sidecar_key(blob_key, encoding)] = (sidecar_data, encoding)
+        keys = list(objects)
+        outcomes = run_concurrently(*[partial(self.file_exists_in_bucket, key) for key in keys])
+        raise_first_error(outcomes)
+        missing = [key for key, outcome in zip(keys, outcomes) if not outcome.value]
+        if len(missing) < len(keys):
+            logger.debug(
+                'Blob %s already stored, uploading %d of its %d objects',
+                blob_key,
+                len(missing),
+                len(keys)
+            )
+        if missing:
+            raise_first_error(
+                run_concurrently(
+                    *[
+                        partial(self.copy_object_in_bucket, copy_source, key) if key == blob_key and
+                        copy_source else partial(self.upload_object_to_bucket, key, *objects[key])
+                        for key in missing
+                    ]
+                )
+            )
+        return missing
+
+    def upload_sidecars_to_bucket(self, file_key, sidecars):
+        '''Upload the precomputed encodings of a file
+
+        Args:
+            file_key: key of the gzipped file
+            sidecars: dict of the compressed data by content encoding (e.g. {'br': b'...'})
+        '''
+        for encoding, data in sidecars.items():
+            self.upload_object_to_bucket(sidecar_key(file_key, encoding), data, encoding)
+
+    def delete_sidecars_in_bucket(self, file_key, encodings):
+        for encoding in encodings:
+            self.delete_file_in_bucket(sidecar_key(file_key, encoding))
@@ -0,0 +1,401 @@
+'''Reconciliation of the S3 objects and DynamoDB items
+
+A failure between the S3 and the DynamoDB operations of a request (or of its compensation) can
+leave an S3 object without item or an item without its S3 objects. The sweeper lists the objects
+under the files prefix and scans the table in parallel, then:
+
+- deletes the objects without item, in batches of up to 1000 keys (DeleteObjects)
+- reports the items whose kml file is missing, their deletion (together with their remaining
+  sidecars) can't be undone and is only done on explicit request (delete_items)
+- repairs the items whose sidecars are missing by removing them from the item
+
+Objects and items modified within the grace period are skipped, they may belong to a request in
+progress (the S3 and DynamoDB operations of a request run concurrently). The items are only
+deleted or repaired if they have not been updated since they have been scanned.
+
+The deduplicated files (blobs) are shared by identical kmls and are not deleted with their items,
+the sweeper deletes the unreferenced ones. A kml created or updated with an identical content in
+the meantime must not lose its file, the requests reusing a blob don't write it but check that it
+exists once their item is written, and upload it again otherwise. Before deleting the blobs the
+table is scanned again, the blobs referenced or uploaded since the first scan are skipped. The
+blobs are then copied to the trash prefix before being deleted, and the table is scanned a last
+time: a request which found its blob before the deletion has written its item before this scan,
+the blobs it references are restored from the trash. The trash left by an interrupted sweep is
+restored or emptied by the next one.
+
+The object keys are listed in parallel by first character of the kml id (urlsafe base64) or of the
+content hash (hexadecimal).
+'''
+import logging
+import string
+import time
+from concurrent import futures
+from datetime import datetime
+from datetime import timedelta
+from datetime import timezone
+from threading import Lock
+
+from botocore.exceptions import ClientError
+
+from app.helpers.bulk import get_file_keys
+
+logger = logging.getLogger(__name__)
+
+# Max number of keys of a DeleteObjects request
+DELETE_OBJECTS_SIZE = 1000
+KML_ID_ALPHABET = string.ascii_letters + string.digits + '-_'
+
+
+def get_expected_keys(items):
+    '''Returns the S3 keys of the objects referenced by the DynamoDB JSON items'''
+    return {key for item in items for key, _ in get_file_keys(item)}
+
+
+class RateLimiter:
+    '''Limit the number of operations per second, 0 for no limit'''
+
+    def __init__(self, rate, clock=time.monotonic, sleep=time.sleep):
+        self.rate = rate
+        self._clock = clock
+        self._sleep = sleep
+        self._next = clock()
+        self._lock = Lock()
+
+    def acquire(self, count=1):
+        if self.rate <= 0:
+            return
+        with self._lock:
+            now = self._clock()
+            wait = self._next - now
+            self._next = max(now, self._next) + count / self.rate
+        if wait > 0:
+            self._sleep(wait)
+
+
+class SweepReport:
+    '''Inconsistencies found (dry run) or fixed by a sweep'''
+
+    def __init__(self, dry_run, delete_items=False):
+        self.dry_run = dry_run
+        self.delete_items = delete_items
+        self.objects = 0
+        self.items = 0
+        self.orphan_objects = []
+        self.items_without_file = []
+        self.items_without_sidecars = []
+        self.skipped = 0
+        self.failed = 0
+
+    def __str__(self):
+        action = 'found' if self.dry_run else 'fixed'
+        kept = ' (reported only)' if not self.dry_run and not self.delete_items else ''
+        return (
+            f'{self.objects} objects and {self.items} items checked, {action}: '
+            f'{len(self.orphan_objects)} objects without item, '
+            f'{len(self.items_without_file)} items without kml file{kept}, '
+            f'{len(self.items_without_sidecars)} items with missing sidecars; '
+            f'{self.skipped} skipped (grace period or modified), {self.failed} failed'
+        )
+
+
+class Sweeper:
+    '''Delete the orphan S3 objects and fix the items whose S3 objects are missing'''
+
+    def __init__(
+        self,
+        s3,
+        dynamodb,
+        table,
+        bucket,
+        files_prefix,
+        blobs_prefix=None,
+        trash_prefix=None,
+        grace_period=timedelta(hours=1),
+        dry_run=True,
+        delete_items=False,
+        rate=0,
+        segments=8,
+        listers=16
+    ):
+        self.s3 = s3  # pylint: disable=invalid-name
+        self.dynamodb = dynamodb
+        self.table = table
+        self.bucket = bucket
+        self.files_prefix = files_prefix
+        self.blobs_prefix = blobs_prefix
+        if blobs_prefix and not trash_prefix:
+            trash_prefix = f'{blobs_prefix.rstrip("/")}-trash/'
+        self.trash_prefix = trash_prefix
+        self.grace_period = grace_period
+        self.dry_run = dry_run
+        self.delete_items = delete_items
+        self.rate_limiter = RateLimiter(rate)
+        self.segments = segments
+        self.listers = listers
+        self.report = SweepReport(dry_run, delete_items)
+
+    def run(self):
+        self.report = SweepReport(self.dry_run, self.delete_items)
+        deadline = datetime.now(timezone.utc) - self.grace_period
+        with futures.ThreadPoolExecutor(max_workers=self.segments + self.listers) as executor:
+            scans = [executor.submit(self._scan, segment) for segment in range(self.segments)]
+            prefixes = [f'{self.files_prefix}{char}' for char in KML_ID_ALPHABET]
+            if self.blobs_prefix:
+                prefixes.extend(f'{self.blobs_prefix}{char}' for char in string.hexdigits[:16])
+            listings = [executor.submit(self._list, prefix) for prefix in prefixes]
+            trash = executor.submit(self._list, self.trash_prefix) if self.blobs_prefix else None
+            items = [item for scan in scans for item in scan.result()]
+            objects = {key: modified for listing in listings for key, modified in listing.result()}
+            trash_keys = [key for key, _ in trash.result()] if trash else []
+        self.report.items = len(items)
+        self.report.objects = len(objects)
+        if trash_keys and not self.dry_run:
+            self._empty_trash(trash_keys, get_expected_keys(items), objects)
+
+        for item in items:
+            self._check_item(item, objects, deadline)
+
+        expected_keys = get_expected_keys(items)
+        for key, modified in objects.items():
+            if key in expected_keys:
+                continue
+            if modified > deadline:
+                self.report.skipped += 1
+                continue
+            self.report.orphan_objects.append(key)
+        if not self.dry_run:
+            orphans = self._recheck_blobs(self.report.orphan_objects, deadline)
+            blobs = [key for key in orphans if self._is_blob(key)]
+            self._delete_objects([key for key in orphans if not self._is_blob(key)])
+            kept = self._delete_blobs(blobs)
+            self.report.orphan_objects = [key for key in orphans if key not in kept]
+        logger.info('Sweep: %s', self.report)
+        return self.report
+
+    def _recheck_blobs(self, keys, deadline):
+        '''Returns the keys without the blobs referenced or reused since the first scan'''
+        if not any(self._is_blob(key) for key in keys):
+            return keys
+        expected_keys = self._scan_expected_keys()
+        with futures.ThreadPoolExecutor(max_workers=self.listers) as executor:
+            blobs = [key for key in keys if self._is_blob(key) and key not in expected_keys]
+            # Checked after the scan, as the items may be written before their blob is uploaded
+            modified = dict(zip(blobs, executor.map(self._get_last_modified, blobs)))
+        referenced = [
+            key for key in keys if key in expected_keys or
+            (key in modified and (modified[key] is None or modified[key] > deadline))
+        ]
+        if referenced:
+            logger.info(
+                '%d blobs referenced or reused since the scan, not deleting them', len(referenced)
+            )
+            self.report.skipped += len(referenced)
+        return [key for key in keys if key not in referenced]
+
+    def _delete_blobs(self, keys):
+        '''Delete the orphan blobs through the trash, restoring the ones referenced meanwhile
+
+        Returns:
+            set of the keys not deleted (restored or failed to be copied to the trash)
+        '''
+        if not keys:
+            return set()
+        with futures.ThreadPoolExecutor(max_workers=self.listers) as executor:
+            trashed = [
+                key for key, copied in
+                zip(keys, executor.map(lambda key: self._copy(key, self._trash_key(key)), keys))
+                if copied
+            ]
+            self._delete_objects(trashed)
+            expected_keys = self._scan_expected_keys()
+            referenced = [key for key in trashed if key in expected_keys]
+            restored = [
+                key for key, copied in zip(
+                    referenced,
+                    executor.map(lambda key: self._copy(self._trash_key(key), key), referenced)
+                ) if copied
+            ]
+        if referenced:
+            logger.info('%d blobs referenced during their deletion, restored', len(restored))
+            self.report.skipped += len(restored)
+        # The blobs failed to be restored stay in the trash for the next sweep
+        failed = set(referenced) - set(restored)
+        self._delete_objects([self._trash_key(key) for key in trashed if key not in failed])
+        return set(keys) - set(trashed) | set(referenced)
+
+    def _empty_trash(self, trash_keys, expected_keys, objects):
+        '''Restore the referenced blobs left in the trash by an interrupted sweep, drop the rest'''
+        blobs = {key: self.blobs_prefix + key[len(self.trash_prefix):] for key in trash_keys}
+        missing = [
+            key for key, blob in blobs.items() if blob in expected_keys and blob not in objects
+        ]
+        restored = [key for key in missing if self._copy(key, blobs[key])]
+        for key in restored:
+            logger.info('Blob %s restored from the trash', blobs[key])
+            objects[blobs[key]] = datetime.now(timezone.utc)
+        failed = set(missing) - set(restored)
+        self._delete_objects([key for key in trash_keys if key not in failed])
+
+    def _copy(self, source, target):
+        self.rate_limiter.acquire()
+        try:
+            self.s3.copy_object(
+                Bucket=self.bucket, Key=target, CopySource={
+                    'Bucket': self.bucket, 'Key': source
+                }
+            )
+        except ClientError as error:
+            logger.error('Failed to copy %s to %s: %s', source, target, error)
+            self.report.failed += 1
+            return False
+        return True
+
+    def _is_blob(self, key):
+        return bool(self.blobs_prefix) and key.startswith(self.blobs_prefix)
+
+    def _trash_key(self, key):
+        return self.trash_prefix + key[len(self.blobs_prefix):]
+
+    def _scan_expected_keys(self):
+        with futures.ThreadPoolExecutor(max_workers=self.segments) as executor:
+            return get_expected_keys(
+                item for items in executor.map(self._scan, range(self.segments)) for item in items
+            )
+
+    def _get_last_modified(self, key):
+        '''Returns the LastModified of an object, None if it doesn't exist anymore'''
+        try:
+            return self.s3.head_object(Bucket=self.bucket, Key=key)['LastModified']
+        except ClientError as error:
+            if error.response['Error']['Code'] in ('404', 'NoSuchKey'):
+                return None
+            raise
+
+    def _scan(self, segment):
+        items = []
+        kwargs = {
+            'TableName': self.table,
+            'Segment': segment,
+            'TotalSegments': self.segments,
+            'ProjectionExpression': '#kml_id, #file_key, #blob_key, #sidecars, #updated',
+            'ExpressionAttributeNames':
+                {
+                    f'#{name}': name
+                    for name in ['kml_id', 'file_key', 'blob_key', 'sidecars', 'updated']
+                },
+        }
+        while True:
+            page = self.dynamodb.scan(**kwargs)
+            items.extend(page.get('Items', []))
+            if 'LastEvaluatedKey' not in page:
+                return items
+            kwargs['ExclusiveStartKey'] = page['LastEvaluatedKey']
+
+    def _list(self, prefix):
+        objects = []
+        paginator = self.s3.get_paginator('list_objects_v2')
+        for page in paginator.paginate(Bucket=self.bucket, Prefix=prefix):
+            objects.extend((obj['Key'], obj['LastModified']) for obj in page.get('Contents', []))
+        return objects
+
+    def _check_item(self, item, objects, deadline):
+        (file_key, _), *sidecar_keys = get_file_keys(item)
+        keys = {encoding: key for key, encoding in sidecar_keys}
+        missing_sidecars = [encoding for encoding, key in keys.items() if key not in objects]
+        if file_key in objects and not missing_sidecars:
+            return
+        if datetime.fromisoformat(item['updated']['S']) > deadline:
+            self.report.skipped += 1
+            return
+        kml_id = item['kml_id']['S']
+        if file_key not in objects:
+            logger.warning('Kml %s: file %s is missing', kml_id, file_key)
+            self.report.items_without_file.append(kml_id)
+            if not self.delete_items:
+                return
+            # The sidecars of a blob might be shared with other items
+            self._fix_item(
+                item,
+                self._delete_item, [] if 'blob_key' in item else
+                [key for encoding, key in keys.items() if encoding not in missing_sidecars]
+            )
+        else:
+            logger.warning('Kml %s: sidecars %s are missing', kml_id, missing_sidecars)
+            self.report.items_without_sidecars.append(kml_id)
+            self._fix_item(
+                item,
+                self._remove_sidecars,
+                [encoding for encoding in keys if encoding not in missing_sidecars]
+            )
+
+    def _fix_item(self, item, func, *args):
+        if self.dry_run:
+            return
+        self.rate_limiter.acquire()
+        try:
+            func(item, *args)
+        except ClientError as error:
+            if error.response['Error']['Code'] == 'ConditionalCheckFailedException':
+                logger.info('Kml %s has been modified since the scan', item['kml_id']['S'])
+                self.report.skipped += 1
+            else:
+                logger.error('Failed to fix kml %s: %s', item['kml_id']['S'], error)
+                self.report.failed += 1
+
+    def _condition(self, item):
+        # Only modify the item if it has not been updated since the scan
+        return {
+            'ConditionExpression': '#updated = :updated',
+            'ExpressionAttributeNames': {
+                '#updated': 'updated'
+            },
+            'ExpressionAttributeValues': {
+                ':updated': item['updated']
+            },
+        }
+
+    def _delete_item(self, item, sidecar_keys):
+        self.dynamodb.delete_item(
+            TableName=self.table, Key={'kml_id': item['kml_id']}, **self._condition(item)
+        )
+        self._delete_objects(sidecar_keys)
+
+    def _remove_sidecars(self, item, sidecars):
+        kwargs = self._condition(item)
+        kwargs['ExpressionAttributeNames']['#sidecars'] = 'sidecars'
+        if sidecars:
+            expression = 'SET #sidecars = :sidecars'
+            kwargs['ExpressionAttributeValues'][':sidecars'] = {
+                'L': [{
+                    'S': encoding
+                } for encoding in sidecars]
+            }
+        else:
+            expression = 'REMOVE #sidecars'
+        self.dynamodb.update_item(
+            TableName=self.table,
+            Key={'kml_id': item['kml_id']},
+            UpdateExpression=expression,
+            **kwargs
+        )
+
+    def _delete_objects(self, keys):
+        for start in range(0, len(keys), DELETE_OBJECTS_SIZE):
+            batch = keys[start:start + DELETE_OBJECTS_SIZE]
+            self.rate_limiter.acquire(len(batch))
+            try:
+                response = self.s3.delete_objects(
+                    Bucket=self.bucket,
+                    Delete={
+                        'Objects': [{
+                            'Key': key
+                        } for key in batch], 'Quiet': True
+                    }
+                )
+            except ClientError as error:
+                logger.error('Failed to delete %d objects: %s', len(batch), error)
+                self.report.failed += len(batch)
+                continue
+            for error in response.get('Errors', []):
+                logger.error('Failed to delete %s: %s', error['Key'], error.get('Message'))
+                self.report.failed += 1
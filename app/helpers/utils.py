@@ -1,27 +1,41 @@
-import gzip
 import logging
 import logging.config
 import os
 import re
+from datetime import datetime
 from functools import wraps
+from hashlib import blake2b
 from itertools import chain
-from urllib.parse import unquote_plus
 
 import yaml
-
-import defusedxml.ElementTree as ET
-from defusedxml.ElementTree import ParseError
+from werkzeug.http import parse_options_header
 
 from flask import abort
+from flask import json
 from flask import jsonify
 from flask import make_response
 from flask import request
 from flask.helpers import url_for
 
+from app.helpers.compression import gzip_compress
+from app.helpers.kml import GzipDecoder
+from app.helpers.kml import KmlProcessor
+from app.helpers.kml import KmlSanitizer
+from app.helpers.kml import KmlValidator
+from app.helpers.kml_patch import PATCH_OPERATIONS
+from app.helpers.metrics import observe_stages
+from app.helpers.processing_pool import run_kml_processing
+from app.settings import ADMIN_CACHE_CONTROL
 from app.settings import DEFAULT_AUTHOR_VERSION
+from app.settings import KML_BATCH_MAX_IDS
 from app.settings import KML_FILE_CONTENT_TYPE
+from app.settings import KML_MAX_EXPANDED_SIZE
 from app.settings import KML_MAX_SIZE
+from app.settings import KML_STAGING_UPLOAD
 from app.settings import KML_STORAGE_HOST_URL
+from app.settings import KML_STREAM_CHUNK_SIZE
+from app.settings import METADATA_CACHE_CONTROL
+from app.settings import SCRIPT_NAME
 
 logger = logging.getLogger(__name__)
 
@@ -50,14 +64,8 @@ def init_logging():
 
 def prevent_erroneous_kml(kml_string):
     # remove all attributes with on prefix and all script elements
-    kml_string = re.sub(r'on\w*=(".+?"|\'.+?\')', '', kml_string, flags=re.IGNORECASE)
-    kml_string = re.sub(
-        r'(<|&lt;)\s*\bscript\b.*?(>|&gt;).*?(<|&lt;)/\s*\bscript\b\s*(>|&gt;)',
-        ' ',
-        kml_string,
-        flags=re.IGNORECASE | re.DOTALL
-    )
-    return kml_string
+    sanitizer = KmlSanitizer()
+    return sanitizer.feed(kml_string) + sanitizer.close()
 
 
 def bytes_conversion(byte, too, b_size=1024):
@@ -107,41 +115,27 @@ def validate_content_length():
     return inner_decorator
 
 
-def validate_file_length(file_content, max_length):
-    if len(file_content) > max_length:
+def validate_file_length(file_length, max_length):
+    if file_length > max_length:
         logger.error(
             'KML file too large: payload=%s MB, max_allowed=%s MB',
-            bytes_conversion(request.content_length, 'MB'),
+            bytes_conversion(file_length, 'MB'),
             bytes_conversion(max_length, 'MB'),
         )
         abort(413, f"KML file too large, max allowed={bytes_conversion(max_length, 'MB')}MB")
 
 
 def validate_kml_string(kml_string):
-    prevent_erroneous_kml(kml_string)
-    try:
-        root = ET.fromstring(kml_string)
-    except ParseError as err:
-        logger.error("Invalid kml file %s", err)
-        abort(400, 'Invalid kml file')
-
-    def no_text(text):
-        if text is None:
-            return True
-        if text.strip(r'\n\t ') == '':
-            return True
-        return False
-
-    # Check if this is an empty kml; <kml></kml>
-    empty = False
-    if len(root.findall('./')) == 0 and no_text(root.text) and len(root.attrib) == 0:
-        empty = True
-
+    kml_string = prevent_erroneous_kml(kml_string)
+    validator = KmlValidator()
+    validator.feed(kml_string)
+    empty = validator.close()
     return kml_string, empty
 
 
-def validate_permissions(db_item):
-    admin_id = request.form.get('admin_id', '')
+def validate_permissions(db_item, admin_id=None):
+    if admin_id is None:
+        admin_id = request.form.get('admin_id', '')
 
     if db_item['admin_id'] != admin_id:
         logger.error(
@@ -166,19 +160,46 @@ def validate_kml_file():
             KML_FILE_CONTENT_TYPE
         )
         abort(415, "Unsupported KML media type")
-    file_content = file.read()
-    validate_file_length(file_content, KML_MAX_SIZE)
-    file_content = decompress_if_gzipped(file_content)
-    try:
-        if 'charset' in file.mimetype_params:
-            quoted_data = file_content.decode(file.mimetype_params['charset'])
-        else:
-            quoted_data = file_content.decode('utf-8')
-    except UnicodeDecodeError as error:
-        logger.error("Could not decode file content: %s", error)
-        abort(400, "Could not decode file content")
-    kml_string, empty = validate_kml_string(unquote_plus(quoted_data))
-    return gzip_string(kml_string), empty
+    processor = KmlProcessor(file.mimetype_params.get('charset', 'utf-8'))
+    kml_string_gzip, empty = run_kml_processing(
+        processor.process, read_file_chunks(file.stream, KML_MAX_SIZE)
+    )
+    observe_stages(processor.timings)
+    return kml_string_gzip, empty, processor.sidecars, processor.content_hash
+
+
+def validate_staged_kml_file(s3_object):
+    '''Validate a KML file uploaded to the staging prefix, the same as validate_kml_file()
+
+    Returns:
+        tuple(gzipped kml, empty flag, sidecars, content hash), and True if the gzipped kml is the
+        staged object as is
+    '''
+    validate_file_length(s3_object['ContentLength'], KML_MAX_SIZE)
+    mimetype, params = parse_options_header(s3_object.get('ContentType', ''))
+    if mimetype != KML_FILE_CONTENT_TYPE:
+        logger.error(
+            'Unsupported staged KML media type %s; only %s is allowed',
+            mimetype,
+            KML_FILE_CONTENT_TYPE
+        )
+        abort(415, "Unsupported KML media type")
+    processor = KmlProcessor(params.get('charset', 'utf-8'))
+    kml_string_gzip, empty = run_kml_processing(
+        processor.process, read_file_chunks(s3_object['Body'], KML_MAX_SIZE)
+    )
+    observe_stages(processor.timings)
+    kml = (kml_string_gzip, empty, processor.sidecars, processor.content_hash)
+    return kml, processor.unchanged
+
+
+def read_file_chunks(stream, max_length):
+    '''Read the uploaded file chunk by chunk, aborting as soon as it is too large'''
+    file_length = 0
+    while chunk := stream.read(KML_STREAM_CHUNK_SIZE):
+        file_length += len(chunk)
+        validate_file_length(file_length, max_length)
+        yield chunk
 
 
 def validate_author():
@@ -188,29 +209,103 @@ def validate_author():
     return author
 
 
+def validate_patch():
+    '''Returns the admin_id, author_version and operations of a patch request, see kml_patch.py'''
+    data = request.get_json(silent=True)
+    if not isinstance(data, dict):
+        logger.error('Invalid patch request, the body is not a json object')
+        abort(400, 'Invalid patch, a json object is expected')
+    admin_id = data.get('admin_id', '')
+    author_version = data.get('author_version', None)
+    operations = data.get('operations', None)
+    if (
+        not isinstance(admin_id, str) or not isinstance(author_version, (str, type(None))) or
+        not isinstance(operations, list) or not operations or
+        not all(is_valid_patch_operation(operation) for operation in operations)
+    ):
+        logger.error('Invalid patch request: admin_id, author_version or operations invalid')
+        abort(400, 'Invalid patch operations')
+    return admin_id, author_version, operations
+
+
+def is_valid_patch_operation(operation):
+    return (
+        isinstance(operation, dict) and operation.get('op', None) in PATCH_OPERATIONS and
+        isinstance(operation.get('id', None), str) and operation['id'] and
+        (operation['op'] != 'upsert' or isinstance(operation.get('kml', None), str))
+    )
+
+
+def validate_batch_ids():
+    data = request.get_json(silent=True)
+    kml_ids = data.get('ids', None) if isinstance(data, dict) else None
+    if not isinstance(kml_ids, list) or not kml_ids or not all(
+        isinstance(kml_id, str) and kml_id for kml_id in kml_ids
+    ):
+        logger.error('Invalid batch request: %s', request.get_data()[:128])
+        abort(400, 'The body must be a json object with a non empty list of kml ids in "ids"')
+    if len(kml_ids) > KML_BATCH_MAX_IDS:
+        logger.error('Too many kml ids in batch request: %d', len(kml_ids))
+        abort(400, f'Too many kml ids, max allowed={KML_BATCH_MAX_IDS}')
+    return kml_ids
+
+
+def get_file_state(db_item):
+    '''Returns what identifies the stored files of an item: content, location and sidecars'''
+    return (
+        db_item.get('content_hash', None),
+        db_item.get('blob_key', None),
+        list(db_item.get('sidecars', [])),
+    )
+
+
+def is_unchanged(db_item, content_hash, blob_key, sidecars, author_version):
+    '''Returns True if an update would not modify the item, neither its files nor its metadata'''
+    return get_file_state(db_item) == (content_hash, blob_key, list(sidecars)) and (
+        author_version in (None, db_item.get('author_version', None))
+    )
+
+
+def is_file_unchanged(previous_item, db_item):
+    '''Returns True if the stored files of the previous item are those of the updated item'''
+    return get_file_state(previous_item) == get_file_state(db_item)
+
+
 def get_kml_file_link(file_key):
     if KML_STORAGE_HOST_URL:
         return f'{KML_STORAGE_HOST_URL}/{file_key}'
     return f'{request.host_url}{file_key}'
 
 
-def get_registered_method(app, url_rule):
-    '''Returns the list of registered method for the given endpoint'''
-
-    # The list of registered method is taken from the werkzeug.routing.Rule. A Rule object
-    # has a methods property with the list of allowed method on an endpoint. If this property is
-    # missing then all methods are allowed.
-    # See https://werkzeug.palletsprojects.com/en/2.0.x/routing/#werkzeug.routing.Rule
-    all_methods = ['GET', 'HEAD', 'OPTIONS', 'POST', 'PUT', 'DELETE']
-    return set(
-        chain.from_iterable(
-            [
-                r.methods if r.methods else all_methods
-                for r in app.url_map.iter_rules()
-                if r.rule == str(url_rule)
-            ]
-        )
-    )
+def get_blob_key(content_hash):
+    '''Returns the S3 key of a content addressed KML file'''
+    return f'{SCRIPT_NAME}/blobs/{content_hash}'.lstrip('/')
+
+
+def get_staging_key(upload_id):
+    '''Returns the S3 key where the KML file of a two-phase upload is staged'''
+    return f'{SCRIPT_NAME}/staging/{upload_id}'.lstrip('/')
+
+
+def validate_staging_upload():
+    if not KML_STAGING_UPLOAD:
+        logger.error('Two-phase upload requested but KML_STAGING_UPLOAD is disabled')
+        abort(404, 'Two-phase uploads are not enabled')
+
+
+def validate_upload_id(upload_id):
+    if not re.fullmatch(r'[A-Za-z0-9_-]{22}', upload_id):
+        logger.error('Invalid upload id %s', upload_id)
+        abort(404, f'Unknown upload {upload_id}')
+
+
+def get_storage_key(db_item):
+    '''Returns the S3 key where the KML file of an item is stored
+
+    The file_key (files/<kml_id>) is the public path of the file. With the deduplication the file
+    is stored under its blob_key (blobs/<content_hash>), shared by all identical KMLs.
+    '''
+    return db_item.get('blob_key', db_item['file_key'])
 
 
 def gzip_string(string):
@@ -219,24 +314,18 @@ def gzip_string(string):
     except (UnicodeDecodeError, AttributeError) as error:
         logger.error("Error when encoding string: %s", error)
         raise error
-    gzipped_data = gzip.compress(data, compresslevel=5)
+    gzipped_data = gzip_compress(data)
 
     return gzipped_data
 
 
-def decompress_if_gzipped(file_content):
-    '''Returns the file content as bytes object, after unzipping the file if necessary'''
+def decompress_if_gzipped(file_content, max_length=KML_MAX_EXPANDED_SIZE):
+    '''Returns the file content as bytes object, after unzipping the file if necessary
 
-    try:
-        ret = gzip.decompress(file_content)
-    except OSError as error:
-        if "Not a gzipped file" in str(error):
-            ret = file_content
-            logger.info("Received unzipped kml-string: %s", file_content)
-        else:
-            logger.error("Error when trying to decompress kml file: %s", error)
-            raise error
-    return ret
+    Aborts with 413 if the decompressed content is larger than max_length.
+    '''
+    decoder = GzipDecoder(max_size=max_length)
+    return b''.join(chain(decoder.feed(file_content), [decoder.close()]))
 
 
 def get_json_metadata(db_item, with_admin_id=False):
@@ -258,3 +347,72 @@ def get_json_metadata(db_item, with_admin_id=False):
     if with_admin_id:
         metadata['admin_id'] = db_item['admin_id']
     return metadata
+
+
+def generate_batch_metadata(batch):
+    '''Generate the json of a batch metadata response as the items are received
+
+    Args:
+        batch: app.helpers.dynamodb.BatchGet
+    '''
+    yield '{"success": true, "items": ['
+    separator = ''
+    for items in batch:
+        for item in items:
+            yield separator + json.dumps(get_json_metadata(item))
+            separator = ', '
+    yield f'], "not_found": {json.dumps(batch.not_found)}, ' \
+        f'"unprocessed": {json.dumps(batch.unprocessed)}}}'
+
+
+def get_metadata_etag(db_item):
+    '''Return the strong ETag of the metadata of a DB entry
+
+    The ETag starts with the version of the entry, which allows a conditional update (If-Match)
+    without reading the entry first, see get_if_match_version(). Every update changes the `updated`
+    timestamp, the length additionally distinguishes updates done within the same millisecond.
+    '''
+    digest = blake2b(f'{db_item["updated"]}:{db_item["length"]}'.encode('utf-8'), digest_size=16)
+    return f'{db_item.get("version", 0)}-{digest.hexdigest()}'
+
+
+def get_if_match_version():
+    '''Returns the version of the entry given by the If-Match header
+
+    Returns None if there is no If-Match header or if it doesn't contain a single ETag, in which
+    case the header must be checked with validate_if_match(). Aborts with 412 if the ETag has not
+    been generated by get_metadata_etag().
+    '''
+    etags = request.if_match.as_set()
+    if request.if_match.star_tag or len(etags) != 1:
+        return None
+    version = next(iter(etags)).partition('-')[0]
+    if not version.isdigit():
+        logger.error('Invalid If-Match header: %s', request.headers.get('If-Match'))
+        abort(412, 'The kml has been modified, its ETag does not match anymore')
+    return int(version)
+
+
+def validate_if_match(db_item):
+    if request.if_match and not request.if_match.contains(get_metadata_etag(db_item)):
+        logger.error(
+            'If-Match %s does not match the kml %s',
+            request.headers.get('If-Match'),
+            db_item['kml_id']
+        )
+        abort(412, 'The kml has been modified, its ETag does not match anymore')
+
+
+def make_metadata_response(db_item, with_admin_id=False, status=200):
+    '''Return the json metadata response of a DB entry with its ETag and Last-Modified headers
+
+    GET requests whose If-None-Match or If-Modified-Since header matches the entry are answered
+    with 304 and without body. The responses containing the admin_id are not stored by the clients.
+    '''
+    response = make_response(jsonify(get_json_metadata(db_item, with_admin_id)), status)
+    response.headers['Cache-Control'] = (
+        ADMIN_CACHE_CONTROL if with_admin_id else METADATA_CACHE_CONTROL
+    )
+    response.set_etag(get_metadata_etag(db_item))
+    response.last_modified = datetime.fromisoformat(db_item['updated'])
+    return response.make_conditional(request)
@@ -1,24 +1,59 @@
 import logging
 from base64 import urlsafe_b64encode
 from datetime import datetime
+from datetime import timedelta
 from datetime import timezone
 from uuid import uuid4
 
+from werkzeug.wsgi import wrap_file
+
 from flask import abort
 from flask import jsonify
 from flask import make_response
+from flask import redirect
 from flask import request
+from flask import stream_with_context
+from flask import url_for
 
 from app.app import app
+from app.helpers.concurrency import compensate
+from app.helpers.concurrency import raise_first_error
+from app.helpers.concurrency import run_concurrently
 from app.helpers.dynamodb import get_db
+from app.helpers.file_cache import get_file_cache
+from app.helpers.kml_patch import apply_kml_patch
+from app.helpers.metrics import render_metrics
+from app.helpers.processing_pool import run_kml_processing
 from app.helpers.s3 import get_storage
-from app.helpers.utils import get_json_metadata
+from app.helpers.utils import generate_batch_metadata
+from app.helpers.utils import get_blob_key
+from app.helpers.utils import get_if_match_version
+from app.helpers.utils import get_kml_file_link
+from app.helpers.utils import get_staging_key
+from app.helpers.utils import get_storage_key
+from app.helpers.utils import is_file_unchanged
+from app.helpers.utils import is_unchanged
+from app.helpers.utils import make_metadata_response
 from app.helpers.utils import validate_author
+from app.helpers.utils import validate_batch_ids
 from app.helpers.utils import validate_content_length
 from app.helpers.utils import validate_content_type
+from app.helpers.utils import validate_if_match
 from app.helpers.utils import validate_kml_file
+from app.helpers.utils import validate_patch
 from app.helpers.utils import validate_permissions
+from app.helpers.utils import validate_staged_kml_file
+from app.helpers.utils import validate_staging_upload
+from app.helpers.utils import validate_upload_id
 from app.settings import DEFAULT_AUTHOR_VERSION
+from app.settings import KML_FILE_CACHE_CONTROL
+from app.settings import KML_FILE_PROXY
+from app.settings import KML_MAX_SIZE
+from app.settings import KML_STAGING_UPLOAD_EXPIRES
+from app.settings import KML_STORAGE_DEDUPLICATION
+from app.settings import KML_STORAGE_HOST_URL
+from app.settings import KML_STREAM_CHUNK_SIZE
+from app.settings import KML_UPLOAD_LEASE_TIMEOUT
 from app.settings import SCRIPT_NAME
 from app.version import APP_VERSION
 
@@ -30,7 +65,111 @@ def checker():
     return make_response(jsonify({'success': True, 'message': 'OK', 'version': APP_VERSION}))
 
 
-# NOTE the /files/<kml_id> route is directly served by S3
+@app.route('/metrics', methods=['GET'])
+def metrics():
+    return app.response_class(render_metrics(), mimetype='text/plain; version=0.0.4')
+
+
+# NOTE the /files/<kml_id> route is directly served by S3, unless the files are deduplicated or
+# proxied (KML_FILE_PROXY). The deduplicated files are redirected to when they are publicly served
+# (KML_STORAGE_HOST_URL).
+
+
+@app.route('/files/<kml_id>', methods=['GET'])
+def get_kml_file(kml_id):
+    db_item = get_db().get_item(kml_id)
+    if 'blob_key' in db_item and KML_STORAGE_HOST_URL and not KML_FILE_PROXY:
+        # The blob of a kml changes with its content, the redirection must not be cached
+        response = redirect(get_kml_file_link(db_item['blob_key']))
+        response.headers['Cache-Control'] = 'no-cache'
+        return response
+    # The blobs are immutable while the file of a kml stored before the deduplication has been
+    # enabled is rewritten on update
+    version = '' if 'blob_key' in db_item else db_item.get('updated', '')
+    return make_file_response(get_storage_key(db_item), version)
+
+
+def make_file_response(file_key, version):
+    '''Stream a stored KML file, from the file cache if enabled or by chunks from S3
+
+    The stored Content-Encoding is sent as is. A cached file answers the Range, If-None-Match and
+    If-Modified-Since headers of the request from its ETag and LastModified, otherwise they are
+    forwarded to S3 so that only the requested part of the object is downloaded.
+    '''
+    cache = get_file_cache()
+    cached = cache.open(file_key, version) if cache is not None else None
+    if cached is not None:
+        fd, headers = cached
+        response = make_stored_file_response(
+            wrap_file(request.environ, fd, KML_STREAM_CHUNK_SIZE), headers
+        )
+        return response.make_conditional(
+            request, accept_ranges=True, complete_length=headers['size']
+        )
+
+    s3_object = get_storage().get_file_from_bucket(file_key, **get_forwarded_conditions())
+    status = s3_object['ResponseMetadata']['HTTPStatusCode']
+    if status == 304:
+        response = app.response_class(status=304)
+        s3_headers = s3_object['ResponseMetadata'].get('HTTPHeaders', {})
+        for name in ['ETag', 'Last-Modified', 'Cache-Control']:
+            if name.lower() in s3_headers:
+                response.headers[name] = s3_headers[name.lower()]
+        return response
+    headers = {
+        'size': s3_object['ContentLength'],
+        'content_type': s3_object['ContentType'],
+        'content_encoding': s3_object.get('ContentEncoding', None),
+        'cache_control': s3_object.get('CacheControl', KML_FILE_CACHE_CONTROL),
+        'etag': s3_object['ETag'].strip('"'),
+        'last_modified': s3_object['LastModified'].isoformat(),
+    }
+    body = s3_object['Body'].iter_chunks(KML_STREAM_CHUNK_SIZE)
+    if status == 206:
+        response = make_stored_file_response(body, headers, status=206)
+        response.headers['Content-Range'] = s3_object['ContentRange']
+        response.accept_ranges = 'bytes'
+    else:
+        if cache is not None:
+            body = cache.fill(file_key, version, headers, body)
+        response = make_stored_file_response(body, headers)
+        # S3 has already evaluated the forwarded headers, the ranges which were not forwarded
+        # remain to be answered
+        response = response.make_conditional(
+            request, accept_ranges=True, complete_length=headers['size']
+        )
+    # The body is not iterated at all if the range is not satisfiable
+    response.call_on_close(s3_object['Body'].close)
+    return response
+
+
+def get_forwarded_conditions():
+    '''Returns the get_object arguments of the Range and conditional headers of the request
+
+    S3 doesn't support the If-Range header nor several ranges, such a range is then answered from
+    the complete object.
+    '''
+    conditions = {}
+    if request.if_none_match:
+        conditions['IfNoneMatch'] = request.headers['If-None-Match']
+    elif request.if_modified_since:
+        # If-Modified-Since is ignored when If-None-Match is set (RFC 9110 13.1.3)
+        conditions['IfModifiedSince'] = request.if_modified_since
+    if request.range and len(request.range.ranges) == 1 and 'If-Range' not in request.headers:
+        conditions['Range'] = request.range.to_header()
+    return conditions
+
+
+def make_stored_file_response(body, headers, status=200):
+    response = app.response_class(body, status=status, direct_passthrough=True)
+    response.headers['Content-Type'] = headers['content_type']
+    if headers['content_encoding']:
+        response.headers['Content-Encoding'] = headers['content_encoding']
+    response.headers['Cache-Control'] = headers['cache_control']
+    response.content_length = headers['size']
+    response.set_etag(headers['etag'])
+    response.last_modified = datetime.fromisoformat(headers['last_modified'])
+    return response
 
 
 @app.route('/admin', methods=['POST'])
@@ -38,33 +177,149 @@ def checker():
 @validate_content_type("multipart/form-data")
 def create_kml():
     # Get the kml file data
-    kml_string_gzip, empty = validate_kml_file()
+    kml = validate_kml_file()
     # Get the author
     author = validate_author()
     # Get the client version
     author_version = request.form.get('author_version', DEFAULT_AUTHOR_VERSION)
 
+    return write_kml_create(kml, author, author_version)
+
+
+def write_kml_create(kml, author, author_version, copy_source=None):
+    '''Write a new kml and returns the metadata response
+
+    Args:
+        kml: tuple(gzipped kml, empty flag, sidecars, content hash)
+        copy_source: tuple(key, etag) of a staged object to copy instead of uploading the kml
+    '''
+    kml_string_gzip, empty, sidecars, content_hash = kml
     kml_admin_id = urlsafe_b64encode(uuid4().bytes).decode('utf8').replace('=', '')
     kml_id = urlsafe_b64encode(uuid4().bytes).decode('utf8').replace('=', '')
     file_key = f'{SCRIPT_NAME}/files/{kml_id}'.lstrip('/')
+    blob_key = get_blob_key(content_hash) if KML_STORAGE_DEDUPLICATION else None
     timestamp = datetime.utcnow().replace(tzinfo=timezone.utc).isoformat(timespec='milliseconds')
 
     storage = get_storage()
-    storage.upload_object_to_bucket(file_key, kml_string_gzip)
-
     db = get_db()
-    db_item = db.save_item(
-        kml_id,
-        kml_admin_id,
-        file_key,
-        len(kml_string_gzip),
-        timestamp,
-        author,
-        author_version,
-        empty
+
+    def upload():
+        if blob_key:
+            return storage.upload_blob_to_bucket(blob_key, kml_string_gzip, sidecars, copy_source)
+        if copy_source:
+            storage.copy_object_in_bucket(copy_source, file_key)
+        else:
+            storage.upload_object_to_bucket(file_key, kml_string_gzip)
+        storage.upload_sidecars_to_bucket(file_key, sidecars)
+
+    def save():
+        return db.save_item(
+            kml_id,
+            kml_admin_id,
+            file_key,
+            len(kml_string_gzip),
+            timestamp,
+            author,
+            author_version,
+            empty,
+            sidecars=list(sidecars),
+            blob_key=blob_key,
+            content_hash=content_hash
+        )
+
+    uploaded, saved = run_concurrently(upload, save)
+    if not uploaded.ok or not saved.ok:
+        # Remove what has been created, the (partially) uploaded files and/or the metadata. The
+        # blobs might be shared with other kmls, the unreferenced ones are removed by the sweeper.
+        if saved.ok:
+            compensate(f'delete db item {kml_id}', db.delete_item, kml_id)
+        if not blob_key:
+            compensate(f'delete file {file_key}', storage.delete_file_in_bucket, file_key)
+            compensate(
+                f'delete sidecars of {file_key}',
+                storage.delete_sidecars_in_bucket,
+                file_key,
+                list(sidecars)
+            )
+        raise_first_error([uploaded, saved])
+    if blob_key and len(uploaded.value) < len(sidecars) + 1:
+        # The blob was found before the item was written, the sweeper might have deleted it as
+        # unreferenced in between (see app/helpers/sweeper.py), check it again
+        storage.upload_blob_to_bucket(blob_key, kml_string_gzip, sidecars, copy_source)
+    db_item = saved.value
+
+    return make_metadata_response(db_item, with_admin_id=True, status=201)
+
+
+@app.route('/admin/uploads', methods=['POST'])
+def create_upload():
+    # Two-phase upload: the client uploads the kml file directly to S3 with the returned presigned
+    # POST, then finalizes the upload, see the README
+    validate_staging_upload()
+    upload_id = urlsafe_b64encode(uuid4().bytes).decode('utf8').replace('=', '')
+    upload = get_storage().generate_upload_post(
+        get_staging_key(upload_id), KML_MAX_SIZE, KML_STAGING_UPLOAD_EXPIRES
+    )
+    return make_response(
+        jsonify(
+            {
+                'success': True,
+                'id': upload_id,
+                'upload': upload,
+                'expires': KML_STAGING_UPLOAD_EXPIRES,
+                'links':
+                    {
+                        'finalize': url_for('finalize_upload', upload_id=upload_id, _external=True)
+                    }
+            }
+        ),
+        201
     )
 
-    return make_response(jsonify(get_json_metadata(db_item, with_admin_id=True)), 201)
+
+@app.route('/admin/uploads/<upload_id>', methods=['POST'])
+@validate_content_length()
+@validate_content_type("multipart/form-data")
+def finalize_upload(upload_id):
+    # Creates a kml from the staged file, or updates the kml_id of the form with it
+    validate_staging_upload()
+    validate_upload_id(upload_id)
+    kml_id = request.form.get('kml_id', None)
+    if kml_id is None:
+        author = validate_author()
+        author_version = request.form.get('author_version', DEFAULT_AUTHOR_VERSION)
+    else:
+        admin_id, version, conflict_status, db_item = get_update_target(kml_id)
+        author_version = request.form.get('author_version', None)
+
+    # The staged file is validated like an upload. When it is stored as is, it is copied within
+    # S3 instead of being uploaded again, unless it has been replaced in the meantime.
+    storage = get_storage()
+    staging_key = get_staging_key(upload_id)
+    s3_object = storage.get_file_from_bucket(staging_key)
+    try:
+        kml, unchanged = validate_staged_kml_file(s3_object)
+        copy_source = (staging_key, s3_object['ETag']) if unchanged else None
+
+        if kml_id is None:
+            response = write_kml_create(kml, author, author_version, copy_source)
+        else:
+            response = write_kml_update(
+                kml_id,
+                admin_id,
+                version,
+                conflict_status,
+                db_item,
+                kml,
+                author_version,
+                copy_source=copy_source
+            )
+    except Exception:
+        # The staged file of a rejected or failed upload is not kept, the client uploads it again
+        compensate(f'delete staged file {staging_key}', storage.delete_file_in_bucket, staging_key)
+        raise
+    storage.delete_file_in_bucket(staging_key)
+    return response
 
 
 @app.route('/admin', methods=['GET'])
@@ -74,53 +329,207 @@ def get_kml_metadata_by_admin_id():
         logger.error("Query parameter admin_id is required: query=%s", request.args)
         abort(400, "Query parameter admin_id is required")
     db_item = get_db().get_item_by_admin_id(admin_id)
-    return make_response(jsonify(get_json_metadata(db_item, with_admin_id=True)), 200)
+    return make_metadata_response(db_item, with_admin_id=True)
 
 
 @app.route('/admin/<kml_id>', methods=['GET'])
 def get_kml_metadata(kml_id):
     db_item = get_db().get_item(kml_id)
-    return make_response(jsonify(get_json_metadata(db_item, with_admin_id=False)), 200)
+    return make_metadata_response(db_item, with_admin_id=False)
+
+
+@app.route('/admin/batch', methods=['POST'])
+@validate_content_length()
+@validate_content_type("application/json")
+def get_kml_metadata_batch():
+    kml_ids = validate_batch_ids()
+    batch = get_db().batch_get_items(kml_ids)
+    return app.response_class(
+        stream_with_context(generate_batch_metadata(batch)), mimetype='application/json'
+    )
 
 
 @app.route('/admin/<kml_id>', methods=['PUT'])
 @validate_content_length()
 @validate_content_type("multipart/form-data")
 def update_kml(kml_id):
-    db = get_db()
-
-    db_item = db.get_item(kml_id)
-    admin_id = validate_permissions(db_item)
+    admin_id, version, conflict_status, db_item = get_update_target(kml_id)
 
     # Get the client version
     author_version = request.form.get('author_version', None)
 
     # Get the kml file data
-    kml_string_gzip, empty = validate_kml_file()
+    kml = validate_kml_file()
 
-    storage = get_storage()
-    storage.upload_object_to_bucket(db_item['file_key'], kml_string_gzip)
+    return write_kml_update(
+        kml_id, admin_id, version, conflict_status, db_item, kml, author_version
+    )
 
-    timestamp = datetime.utcnow().replace(tzinfo=timezone.utc).isoformat(timespec='milliseconds')
-    db_item = db.update_item(
-        kml_id, db_item, len(kml_string_gzip), timestamp, empty, author_version
+
+def get_update_target(kml_id):
+    '''Returns the admin_id, version, conflict status and item (if read) of a kml update
+
+    With a If-Match header the item is not read beforehand, its permission and version are checked
+    by the conditional write.
+    '''
+    version = get_if_match_version()
+    if version is None:
+        db_item = get_db().get_item(kml_id, cached=False)
+        admin_id = validate_permissions(db_item)
+        validate_if_match(db_item)
+        return admin_id, db_item.get('version', 0), 409, db_item
+    return request.form.get('admin_id', ''), version, 412, None
+
+
+@app.route('/admin/<kml_id>', methods=['PATCH'])
+@validate_content_length()
+@validate_content_type("application/json")
+def patch_kml(kml_id):
+    # The patch applies to a given version of the kml, see app/helpers/kml_patch.py
+    if get_if_match_version() is None:
+        logger.error('Kml %s patch without If-Match header', kml_id)
+        abort(428, 'The If-Match header with the ETag of the kml to patch is required')
+    admin_id, author_version, operations = validate_patch()
+
+    db = get_db()
+    db_item = db.get_item(kml_id, cached=False)
+    validate_permissions(db_item, admin_id)
+    validate_if_match(db_item)
+
+    s3_object = get_storage().get_file_from_bucket(get_storage_key(db_item))
+    kml = run_kml_processing(apply_kml_patch, s3_object['Body'].read(), operations)
+
+    return write_kml_update(
+        kml_id, admin_id, db_item.get('version', 0), 412, db_item, kml, author_version
+    )
+
+
+def write_kml_update(
+    kml_id, admin_id, version, conflict_status, db_item, kml, author_version, copy_source=None
+):
+    '''Write the processed kml of an update or patch and returns the metadata response
+
+    Args:
+        db_item: the item read beforehand, None if only the conditional write checks it
+        kml: tuple(gzipped kml, empty flag, sidecars, content hash)
+        copy_source: tuple(key, etag) of a staged object to copy instead of uploading the kml
+    '''
+    db = get_db()
+    kml_string_gzip, empty, sidecars, content_hash = kml
+    blob_key = get_blob_key(content_hash) if KML_STORAGE_DEDUPLICATION else None
+
+    if db_item is not None and is_unchanged(
+        db_item, content_hash, blob_key, sidecars, author_version
+    ):
+        # Nothing to write, e.g. an autosave of an unmodified drawing
+        logger.debug('Kml %s unchanged, skipping its update', kml_id)
+        return make_metadata_response(db_item, with_admin_id=True)
+
+    # The metadata is written first, the file is only uploaded once the write has been granted. A
+    # file overwritten in place (not content addressed) is protected by an upload lease: a later
+    # update is rejected until the file has been uploaded, otherwise its upload could land before
+    # this one and the stored file would not match the metadata.
+    now = datetime.utcnow().replace(tzinfo=timezone.utc)
+    timestamp = now.isoformat(timespec='milliseconds')
+    upload_lease = None
+    if not blob_key:
+        upload_lease = (now + timedelta(seconds=KML_UPLOAD_LEASE_TIMEOUT)).isoformat(
+            timespec='milliseconds'
+        )
+    previous_item, db_item = db.update_item(
+        kml_id,
+        admin_id,
+        version,
+        len(kml_string_gzip),
+        timestamp,
+        empty,
+        author_version,
+        list(sidecars),
+        blob_key=blob_key,
+        content_hash=content_hash,
+        conflict_status=conflict_status,
+        upload_lease=upload_lease
     )
+    db_item.pop('upload_lease', None)
+    file_key = previous_item['file_key']
+    previous_key = get_storage_key(previous_item)
+    previous_sidecars = previous_item.get('sidecars', [])
 
-    return make_response(jsonify(get_json_metadata(db_item, with_admin_id=True)), 200)
+    if is_file_unchanged(previous_item, db_item):
+        # Only the metadata has been updated, the stored files are still up to date
+        logger.debug('Kml %s file unchanged, skipping its upload', kml_id)
+        if upload_lease:
+            db.release_upload_lease(kml_id, db_item['version'])
+        return make_metadata_response(db_item, with_admin_id=True)
+
+    storage = get_storage()
+    if blob_key:
+        outcomes = run_concurrently(
+            lambda: storage.upload_blob_to_bucket(blob_key, kml_string_gzip, sidecars, copy_source)
+        )
+    elif copy_source:
+        outcomes = run_concurrently(
+            lambda: storage.upload_sidecars_to_bucket(file_key, sidecars),
+            lambda: storage.copy_object_in_bucket(copy_source, file_key)
+        )
+    else:
+        outcomes = run_concurrently(
+            lambda: storage.upload_sidecars_to_bucket(file_key, sidecars),
+            lambda: storage.upload_object_to_bucket(file_key, kml_string_gzip)
+        )
+    if not all(outcome.ok for outcome in outcomes):
+        # The file could not be (entirely) replaced, restore the previous metadata unless it has
+        # been updated again in the meantime, and remove the new sidecars it doesn't reference
+        compensate(f'restore db item {kml_id}', db.restore_item, previous_item, db_item['version'])
+        if not blob_key:
+            compensate(
+                f'delete new sidecars of {file_key}',
+                storage.delete_sidecars_in_bucket,
+                file_key, [encoding for encoding in sidecars if encoding not in previous_sidecars]
+            )
+        raise_first_error(outcomes)
+    if upload_lease:
+        db.release_upload_lease(kml_id, db_item['version'])
+
+    # The stale files are only removed once no metadata references them anymore. The previous
+    # blob might be shared with other kmls, the unreferenced ones are removed by the sweeper.
+    if 'blob_key' not in previous_item:
+        if blob_key:
+            storage.delete_file_in_bucket(previous_key)
+            storage.delete_sidecars_in_bucket(previous_key, previous_sidecars)
+        else:
+            storage.delete_sidecars_in_bucket(
+                file_key, [encoding for encoding in previous_sidecars if encoding not in sidecars]
+            )
+
+    return make_metadata_response(db_item, with_admin_id=True)
 
 
 @app.route('/admin/<kml_id>', methods=['DELETE'])
 @validate_content_type("multipart/form-data")
 def delete_kml(kml_id):
     db = get_db()
-    item = db.get_item(kml_id)
+    item = db.get_item(kml_id, cached=False)
 
     validate_permissions(item)
 
     storage = get_storage()
-    storage.delete_file_in_bucket(item['file_key'])
 
-    db.delete_item(kml_id)
+    def delete_files():
+        # The blobs might be shared with other kmls, the unreferenced ones are removed by the
+        # sweeper
+        if 'blob_key' in item:
+            return
+        storage.delete_file_in_bucket(item['file_key'])
+        storage.delete_sidecars_in_bucket(item['file_key'], item.get('sidecars', []))
+
+    deleted_files, deleted_item = run_concurrently(delete_files, lambda: db.delete_item(kml_id))
+    if not deleted_files.ok and deleted_item.ok:
+        # Keep the metadata of the remaining files so that the deletion can be retried. When only
+        # the metadata deletion failed, retrying also completes the deletion as deleting an
+        # already deleted file succeeds.
+        compensate(f'restore db item {kml_id}', db.restore_item, item)
+    raise_first_error([deleted_files, deleted_item])
 
     return make_response(
         jsonify(
@@ -16,9 +16,75 @@ AWS_DB_REGION_NAME = os.environ['AWS_DB_REGION_NAME']
 AWS_DB_TABLE_NAME = os.environ['AWS_DB_TABLE_NAME']
 AWS_DB_ENDPOINT_URL = os.getenv('AWS_DB_ENDPOINT_URL', None)
 KML_STORAGE_HOST_URL = os.getenv('KML_STORAGE_HOST_URL', None)
+# Store the KML files by content hash under blobs/, identical KMLs share the same S3 objects. The
+# files/<kml_id> links are then served by the service, see the README.
+KML_STORAGE_DEDUPLICATION = os.getenv('KML_STORAGE_DEDUPLICATION',
+                                      'False').lower() in ['true', '1', 'yes']
+# Time in seconds during which an update overwriting a kml file in place (not deduplicated) holds
+# the kml, the later updates are rejected with 409 until its file has been uploaded. It must exceed
+# the duration of the upload including its retries, see app/routes.py:write_kml_update()
+KML_UPLOAD_LEASE_TIMEOUT = float(os.getenv('KML_UPLOAD_LEASE_TIMEOUT', '120'))
+# Two-phase uploads: the KML file is uploaded directly to S3 under staging/ with a presigned POST
+# valid for KML_STAGING_UPLOAD_EXPIRES seconds, then validated and promoted by the service.
+KML_STAGING_UPLOAD = os.getenv('KML_STAGING_UPLOAD', 'False').lower() in ['true', '1', 'yes']
+KML_STAGING_UPLOAD_EXPIRES = int(os.getenv('KML_STAGING_UPLOAD_EXPIRES', '900'))
+
+# Boto3 clients are shared by all requests of a worker, the connection pool must therefore be
+# large enough for the number of concurrent greenlets that access the backend.
+AWS_MAX_POOL_CONNECTIONS = int(os.getenv('AWS_MAX_POOL_CONNECTIONS', '10'))
+AWS_TCP_KEEPALIVE = os.getenv('AWS_TCP_KEEPALIVE', 'True').lower() in ['true', '1', 'yes']
 
 MB = 1024 * 1024
 KML_MAX_SIZE = int(os.getenv('KML_MAX_SIZE', str(2 * MB)))
+# Opt-in multipart uploads for deployments raising KML_MAX_SIZE: files of at least
+# KML_MULTIPART_THRESHOLD bytes (0 to disable) are uploaded to S3 in parts of
+# KML_MULTIPART_PART_SIZE bytes (at least 5 MB, except the last one), KML_MULTIPART_CONCURRENCY
+# parts at a time, so that a failing part is retried on its own. The parts are sliced from the
+# processed file in memory, the upload is not streamed.
+KML_MULTIPART_THRESHOLD = int(os.getenv('KML_MULTIPART_THRESHOLD', '0'))
+KML_MULTIPART_PART_SIZE = int(os.getenv('KML_MULTIPART_PART_SIZE', str(8 * MB)))
+KML_MULTIPART_CONCURRENCY = int(os.getenv('KML_MULTIPART_CONCURRENCY', '4'))
+# S3 only rejects the smaller parts when completing the upload, after all parts have been sent
+S3_MIN_PART_SIZE = 5 * MB
+if KML_MULTIPART_PART_SIZE < S3_MIN_PART_SIZE:
+    raise ValueError(
+        f'KML_MULTIPART_PART_SIZE must be at least {S3_MIN_PART_SIZE} bytes, '
+        f'got {KML_MULTIPART_PART_SIZE}'
+    )
+# Uploaded KML files are read, decompressed, validated and compressed by chunks of this size, the
+# served KML files are streamed by chunks of this size
+KML_STREAM_CHUNK_SIZE = int(os.getenv('KML_STREAM_CHUNK_SIZE', str(64 * 1024)))
+# Limits of the decompressed size of gzipped uploads. The ratio is only checked once the
+# decompressed size exceeds KML_MAX_SIZE.
+KML_MAX_EXPANDED_SIZE = int(os.getenv('KML_MAX_EXPANDED_SIZE', str(50 * MB)))
+KML_MAX_COMPRESSION_RATIO = int(os.getenv('KML_MAX_COMPRESSION_RATIO', '100'))
+# Number of native threads per worker processing the uploaded KML files, 0 to process them inline
+# in the request greenlet. Requests exceeding the pool and its queue are rejected with 503.
+KML_PROCESSING_POOL_SIZE = int(os.getenv('KML_PROCESSING_POOL_SIZE', '0'))
+KML_PROCESSING_QUEUE_SIZE = int(os.getenv('KML_PROCESSING_QUEUE_SIZE', '8'))
+# Compression of the stored KML files, see app/helpers/compression.py
+KML_GZIP_COMPRESSION_LEVEL = int(os.getenv('KML_GZIP_COMPRESSION_LEVEL', '5'))
+KML_GZIP_BACKEND = os.getenv('KML_GZIP_BACKEND', 'auto')
+KML_SIDECAR_ENCODINGS = [
+    encoding.strip()
+    for encoding in os.getenv('KML_SIDECAR_ENCODINGS', '').split(',')
+    if encoding.strip()
+]
+KML_BROTLI_QUALITY = int(os.getenv('KML_BROTLI_QUALITY', '6'))
+KML_ZSTD_LEVEL = int(os.getenv('KML_ZSTD_LEVEL', '9'))
+# Per worker cache of the KML metadata, 0 to disable it. The other workers only see an update once
+# their entry expired, see app/helpers/cache.py
+KML_METADATA_CACHE_SIZE = int(os.getenv('KML_METADATA_CACHE_SIZE', '0'))
+KML_METADATA_CACHE_TTL = float(os.getenv('KML_METADATA_CACHE_TTL', '10'))
+KML_METADATA_CACHE_NEGATIVE_TTL = float(os.getenv('KML_METADATA_CACHE_NEGATIVE_TTL', '2'))
+# Max number of kml ids of a batch metadata request and number of retries of the ids not processed
+# by DynamoDB
+KML_BATCH_MAX_IDS = int(os.getenv('KML_BATCH_MAX_IDS', '100'))
+KML_BATCH_MAX_RETRIES = int(os.getenv('KML_BATCH_MAX_RETRIES', '5'))
+# Directory where the gunicorn workers share their metrics, see app/helpers/metrics.py. By default
+# metrics/ in GUNICORN_WORKER_TMP_DIR.
+KML_METRICS_DIR = os.getenv('KML_METRICS_DIR', '')
+KML_METRICS_WRITE_INTERVAL = float(os.getenv('KML_METRICS_WRITE_INTERVAL', '5'))
 
 KML_FILE_CONTENT_TYPE = 'application/vnd.google-earth.kml+xml'
 KML_FILE_CONTENT_ENCODING = 'gzip'
@@ -26,15 +92,41 @@ KML_FILE_CONTENT_ENCODING = 'gzip'
 # https://developer.mozilla.org/en-US/docs/Web/HTTP/Headers/Cache-Control#preventing_caching
 NO_CACHE = 'no-store, max-age=0'
 KML_FILE_CACHE_CONTROL = os.getenv('KML_FILE_CACHE_CONTROL', NO_CACHE)
+# Stream the deduplicated KML files from S3 in /files/<kml_id> instead of redirecting to their blob,
+# and local disk cache of these files (disabled without directory), see app/helpers/file_cache.py
+KML_FILE_PROXY = os.getenv('KML_FILE_PROXY', 'False').lower() in ['true', '1', 'yes']
+KML_FILE_CACHE_DIR = os.getenv('KML_FILE_CACHE_DIR', '')
+KML_FILE_CACHE_MAX_SIZE = int(os.getenv('KML_FILE_CACHE_MAX_SIZE', str(256 * 1024 * 1024)))
 
 ALLOWED_DOMAINS = os.getenv('ALLOWED_DOMAINS', r'.*').split(',')
 ALLOWED_DOMAINS_PATTERN = f"({'|'.join(ALLOWED_DOMAINS)})"
+# Time in seconds the browsers may cache a CORS preflight response (capped by the browsers)
+CORS_MAX_AGE = int(os.getenv('CORS_MAX_AGE', '7200'))
 
 SCRIPT_NAME = os.getenv('SCRIPT_NAME', '')
 
 GUNICORN_KEEPALIVE = int(os.getenv('GUNICORN_KEEPALIVE', '2'))
+# With the gevent worker class the S3 and DynamoDB I/O of a request doesn't block the other requests
+# of the worker, sync, gthread and gevent deployments can be compared with scripts/load_test.py
+GUNICORN_WORKER_CLASS = os.getenv('GUNICORN_WORKER_CLASS', 'gevent')
+GUNICORN_WORKERS = int(os.getenv('GUNICORN_WORKERS', '2'))
+GUNICORN_THREADS = int(os.getenv('GUNICORN_THREADS', '1'))
+GUNICORN_WORKER_CONNECTIONS = int(os.getenv('GUNICORN_WORKER_CONNECTIONS', '1000'))
 
 CACHE_CONTROL = os.getenv('CACHE_CONTROL', 'no-cache, no-store, must-revalidate')
+# The metadata can be stored by the clients and revalidated with its ETag, except the responses
+# containing the admin_id which must never be stored
+METADATA_CACHE_CONTROL = os.getenv('METADATA_CACHE_CONTROL', 'private, no-cache')
+ADMIN_CACHE_CONTROL = 'private, no-cache, no-store'
 CACHE_CONTROL_4XX = os.getenv('CACHE_CONTROL_4XX', 'public, max-age=3600')
 
+# Fraction of the successful responses that are logged (the errors are always logged) and comma
+# separated list of the logged response headers, * for all
+LOG_RESPONSE_SAMPLE_RATE = float(os.getenv('LOG_RESPONSE_SAMPLE_RATE', '1'))
+LOG_RESPONSE_HEADERS = None if os.getenv('LOG_RESPONSE_HEADERS', '*').strip() == '*' else [
+    header.strip().lower()
+    for header in os.getenv('LOG_RESPONSE_HEADERS', '').split(',')
+    if header.strip()
+]
+
 DEFAULT_AUTHOR_VERSION = '0.0.0'
@@ -0,0 +1,324 @@
+#!python3
+'''Micro benchmarks of the KML processing
+
+Each benchmark is run on the given KML files or, if no file is given, on a generated drawing KML.
+
+Usage:
+
+    python3 scripts/benchmark.py validate [--placemarks N] [--repeat N] [FILE ...]
+    python3 scripts/benchmark.py sanitize [--placemarks N] [--repeat N] [FILE ...]
+    python3 scripts/benchmark.py compress [--placemarks N] [--repeat N] [--downloads N] [FILE ...]
+    python3 scripts/benchmark.py log-response [--repeat N] [--requests N]
+
+The sanitize benchmark additionally runs on pathological inputs (--pathological-size characters)
+which make the former regular expressions backtrack polynomially (use small sizes).
+
+The compress benchmark compares the CPU time and output size of every installed gzip backend and
+sidecar encoding, over all given KML files (e.g. a corpus of real KMLs), as well as the resulting
+S3 egress for --downloads downloads of each file.
+
+The log-response benchmark measures the per request overhead of the response log record, with the
+former eagerly built extras and with the lazy ones, when the record is dropped by the handler level
+and when it is formatted by the json formatter.
+'''
+import argparse
+import logging
+import os
+import re
+import time
+import tracemalloc
+from functools import partial
+
+import init_scripts  # pylint: disable=unused-import
+from logging_utilities.formatters.json_formatter import JsonFormatter
+
+import defusedxml.ElementTree as ET
+
+from flask import jsonify
+
+from app.app import app
+from app.helpers import compression
+from app.helpers.kml import KmlSanitizer
+from app.helpers.kml import KmlValidator
+from app.helpers.kml import is_blank
+from app.helpers.response_log import LazyResponseExtra
+from app.helpers.response_log import is_response_sampled
+from app.settings import KML_STREAM_CHUNK_SIZE
+
+PLACEMARK = '''<Placemark id="drawing_feature_{index}">
+  <name>Feature {index}</name>
+  <description>Drawing feature number {index}</description>
+  <Style><LineStyle><color>ff0000ff</color><width>3</width></LineStyle></Style>
+  <LineString>
+    <coordinates>{coordinates}</coordinates>
+  </LineString>
+</Placemark>
+'''
+
+
+def generate_kml(placemarks):
+    coordinates = ' '.join(f'{7 + i * 0.001:.6f},{46 + i * 0.001:.6f}' for i in range(50))
+    features = ''.join(
+        PLACEMARK.format(index=index, coordinates=coordinates) for index in range(placemarks)
+    )
+    return (
+        '<?xml version="1.0" encoding="UTF-8"?>\n'
+        '<kml xmlns="http://www.opengis.net/kml/2.2"><Document>\n'
+        f'{features}</Document></kml>\n'
+    )
+
+
+def load_kmls(args):
+    if not args.files:
+        return {f'generated-{args.placemarks}-placemarks': generate_kml(args.placemarks)}
+    kmls = {}
+    for path in args.files:
+        with open(path, 'r', encoding='utf-8') as fd:
+            kmls[path] = fd.read()
+    return kmls
+
+
+def chunks(text, size=KML_STREAM_CHUNK_SIZE):
+    for i in range(0, len(text), size):
+        yield text[i:i + size]
+
+
+def measure(func, data, repeat):
+    '''Returns the best duration in seconds and the peak of traced memory in bytes'''
+    durations = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func(data)
+        durations.append(time.perf_counter() - start)
+    tracemalloc.start()
+    func(data)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return min(durations), peak
+
+
+def report(name, size, results):
+    print(f'{name} ({size / 1024:.0f} KB)')
+    for label, (duration, peak) in results.items():
+        print(
+            f'  {label:<24} {duration * 1000:9.2f} ms {size / duration / 1024 / 1024:9.1f} MB/s '
+            f'{peak / 1024:10.0f} KB peak'
+        )
+
+
+def validate_dom(kml_string):
+    root = ET.fromstring(kml_string)
+    return len(root.findall('./')) == 0 and is_blank(root.text) and len(root.attrib) == 0
+
+
+def validate_stream(kml_string):
+    validator = KmlValidator()
+    for chunk in chunks(kml_string):
+        validator.feed(chunk)
+    return validator.close()
+
+
+def benchmark_validate(args):
+    for name, kml_string in load_kmls(args).items():
+        report(
+            name,
+            len(kml_string),
+            {
+                'dom (fromstring)': measure(validate_dom, kml_string, args.repeat),
+                'stream (KmlValidator)': measure(validate_stream, kml_string, args.repeat),
+            }
+        )
+
+
+def sanitize_regex(kml_string):
+    '''Former implementation of prevent_erroneous_kml()'''
+    kml_string = re.sub(r'on\w*=(".+?"|\'.+?\')', '', kml_string, flags=re.IGNORECASE)
+    return re.sub(
+        r'(<|&lt;)\s*\bscript\b.*?(>|&gt;).*?(<|&lt;)/\s*\bscript\b\s*(>|&gt;)',
+        ' ',
+        kml_string,
+        flags=re.IGNORECASE | re.DOTALL
+    )
+
+
+def sanitize_stream(kml_string):
+    # The sanitized chunks are not kept, in the service they are directly validated and compressed
+    sanitizer = KmlSanitizer()
+    for chunk in chunks(kml_string):
+        sanitizer.feed(chunk)
+    sanitizer.close()
+
+
+def pathological_kmls(size):
+    return {
+        'unclosed script tags': '<script>' * (size // 8),
+        'unclosed escaped script tags': '&lt;script&gt;' * (size // 14),
+        'event attributes': ' onclick="x"' * (size // 12),
+    }
+
+
+def benchmark_sanitize(args):
+    kmls = load_kmls(args)
+    kmls.update(pathological_kmls(args.pathological_size))
+    for name, kml_string in kmls.items():
+        report(
+            name,
+            len(kml_string),
+            {
+                'regex (re.sub)': measure(sanitize_regex, kml_string, args.repeat),
+                'stream (KmlSanitizer)': measure(sanitize_stream, kml_string, args.repeat),
+            }
+        )
+
+
+def compression_configs():
+    configs = {}
+    for backend, (module, compressobj) in compression.GZIP_BACKENDS.items():
+        if module is None:
+            continue
+        for level in [1, 5, 9]:
+            configs[f'gzip {backend} -{level}'] = partial(compressobj, level)
+    for encoding, (module, _, compressobj) in compression.SIDECAR_COMPRESSORS.items():
+        if module is not None:
+            configs[f'{encoding} sidecar'] = compressobj
+    return configs
+
+
+def benchmark_compress(args):
+    kmls = {name: kml_string.encode('utf-8') for name, kml_string in load_kmls(args).items()}
+    total_size = sum(len(data) for data in kmls.values())
+    print(
+        f'{len(kmls)} KML files ({total_size / 1024:.0f} KB), egress for {args.downloads} '
+        'downloads of each file'
+    )
+    for label, compressobj in compression_configs().items():
+        cpu_time = 0
+        size = 0
+        for data in kmls.values():
+            durations = []
+            for _ in range(args.repeat):
+                start = time.process_time()
+                compressor = compressobj()
+                output = compressor.compress(data) + compressor.flush()
+                durations.append(time.process_time() - start)
+            cpu_time += min(durations)
+            size += len(output)
+        print(
+            f'  {label:<20} {cpu_time * 1000:9.2f} ms CPU {size / 1024:9.0f} KB '
+            f'ratio {total_size / size:5.1f} egress {size * args.downloads / 1024 / 1024:9.1f} MB'
+        )
+
+
+def eager_response_extra(response):
+    '''Former response extra of log_response()'''
+    return {
+        "status_code": response.status_code,
+        "headers": dict(response.headers.items()),
+        "json": None if response.is_streamed else response.json
+    }
+
+
+def response_logger(level):
+    '''Returns a logger whose json handler (as in logging-cfg-local.yml) has the given level'''
+    # pylint: disable=consider-using-with
+    handler = logging.StreamHandler(open(os.devnull, 'w', encoding='utf-8'))
+    handler.setLevel(level)
+    handler.setFormatter(
+        JsonFormatter(
+            {
+                'message': 'message',
+                'response':
+                    {
+                        'statusCode': 'response.status_code',
+                        'headers': 'response.headers.',
+                        'payload': '%(response.json).128s'
+                    },
+            },
+            remove_empty=True,
+            ignore_missing=True
+        )
+    )
+    logger = logging.getLogger(f'benchmark.log_response.{logging.getLevelName(level)}')
+    logger.setLevel(logging.DEBUG)
+    logger.propagate = False
+    logger.addHandler(handler)
+    return logger
+
+
+def benchmark_log_response(args):
+    modes = {
+        'eager': (eager_response_extra, 1),
+        'lazy': (LazyResponseExtra, 1),
+        'lazy sampled 10%': (LazyResponseExtra, 0.1),
+    }
+    with app.test_request_context():
+        response = jsonify(
+            {
+                'id': 'tvrhgBGLT7GDVzB8u6Ko2w',
+                'success': True,
+                'created': '2023-06-01T12:00:00.000+00:00',
+                'updated': '2023-06-01T12:00:00.000+00:00',
+                'empty': False,
+                'author': 'mf-geoadmin3',
+                'author_version': '1.0.0',
+                'links':
+                    {
+                        'self': 'https://example.com/api/kml/admin/tvrhgBGLT7GDVzB8u6Ko2w',
+                        'kml': 'https://example.com/api/kml/files/tvrhgBGLT7GDVzB8u6Ko2w'
+                    }
+            }
+        )
+        for level, label in [(logging.WARNING, 'dropped'), (logging.DEBUG, 'json formatted')]:
+            logger = response_logger(level)
+            print(f'Response record {label}')
+            for mode, (make_extra, rate) in modes.items():
+                durations = []
+                for _ in range(args.repeat):
+                    start = time.perf_counter()
+                    for _ in range(args.requests):
+                        if is_response_sampled(response, rate):
+                            logger.info(
+                                'GET /admin - 200', extra={'response': make_extra(response)}
+                            )
+                    durations.append(time.perf_counter() - start)
+                print(f'  {mode:<20} {min(durations) / args.requests * 1e6:9.2f} us/request')
+
+
+BENCHMARKS = {
+    'validate': benchmark_validate,
+    'sanitize': benchmark_sanitize,
+    'compress': benchmark_compress,
+    'log-response': benchmark_log_response,
+}
+
+
+def main():
+    parser = argparse.ArgumentParser(description='KML processing micro benchmarks')
+    parser.add_argument('benchmark', choices=BENCHMARKS.keys())
+    parser.add_argument('files', nargs='*', help='KML files to use, default to a generated KML')
+    parser.add_argument('--placemarks', type=int, default=2000, help='Generated KML size')
+    parser.add_argument('--repeat', type=int, default=5, help='Number of runs per measure')
+    parser.add_argument(
+        '--downloads',
+        type=int,
+        default=1000,
+        help='Number of downloads per file to estimate the S3 egress of the compress benchmark'
+    )
+    parser.add_argument(
+        '--requests',
+        type=int,
+        default=10000,
+        help='Number of logged responses per measure of the log-response benchmark'
+    )
+    parser.add_argument(
+        '--pathological-size',
+        type=int,
+        default=2048,
+        help='Size of the pathological inputs of the sanitize benchmark'
+    )
+    args = parser.parse_args()
+    BENCHMARKS[args.benchmark](args)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,74 @@
+#!python3
+'''Bulk export and import of the KML collection, see app/helpers/bulk.py
+
+Export the table and bucket of the settings (or of the given options) into an archive directory,
+or import an archive into a table and bucket, e.g. to migrate or restore the KMLs. An interrupted
+export or import is resumed when run again with the same archive.
+
+Usage:
+
+    python3 scripts/bulk.py export ARCHIVE [--segments N] [--transfers N]
+    python3 scripts/bulk.py import ARCHIVE [--workers N] [--transfers N] [--table T] [--bucket B]
+'''
+import argparse
+import logging
+
+import init_scripts  # pylint: disable=unused-import
+
+from app.helpers.bulk import BulkExporter
+from app.helpers.bulk import BulkImporter
+from app.helpers.bulk import get_clients
+from app.settings import AWS_DB_ENDPOINT_URL
+from app.settings import AWS_DB_REGION_NAME
+from app.settings import AWS_DB_TABLE_NAME
+from app.settings import AWS_S3_BUCKET_NAME
+from app.settings import AWS_S3_ENDPOINT_URL
+from app.settings import AWS_S3_REGION_NAME
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Bulk export and import of the KML collection')
+    parser.add_argument('operation', choices=['export', 'import'])
+    parser.add_argument('archive', help='Archive directory')
+    parser.add_argument('--table', default=AWS_DB_TABLE_NAME, help='DynamoDB table name')
+    parser.add_argument('--bucket', default=AWS_S3_BUCKET_NAME, help='S3 bucket name')
+    parser.add_argument('--db-region', default=AWS_DB_REGION_NAME)
+    parser.add_argument('--db-endpoint-url', default=AWS_DB_ENDPOINT_URL)
+    parser.add_argument('--s3-region', default=AWS_S3_REGION_NAME)
+    parser.add_argument('--s3-endpoint-url', default=AWS_S3_ENDPOINT_URL)
+    parser.add_argument(
+        '--segments', type=int, default=8, help='Number of parallel Scan segments (export)'
+    )
+    parser.add_argument(
+        '--workers', type=int, default=8, help='Number of archive segments imported in parallel'
+    )
+    parser.add_argument(
+        '--transfers', type=int, default=32, help='Number of concurrent S3 transfers'
+    )
+    parser.add_argument('--page-size', type=int, default=None, help='Scan page size (export)')
+    parser.add_argument(
+        '--report-interval', type=float, default=10, help='Throughput report interval in seconds'
+    )
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.WARNING)
+
+    s3, dynamodb = get_clients(  # pylint: disable=invalid-name
+        args.s3_region,
+        args.s3_endpoint_url,
+        args.db_region,
+        args.db_endpoint_url,
+        max_connections=args.transfers + max(args.segments, args.workers)
+    )
+    operation_args = (s3, dynamodb, args.table, args.bucket, args.archive)
+    operation_kwargs = {'transfers': args.transfers, 'report_interval': args.report_interval}
+    if args.operation == 'export':
+        operation = BulkExporter(
+            *operation_args, segments=args.segments, page_size=args.page_size, **operation_kwargs
+        )
+    else:
+        operation = BulkImporter(*operation_args, workers=args.workers, **operation_kwargs)
+    print(operation.run().report())
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,155 @@
+#!python3
+'''Load test of a running service instance
+
+Each virtual user loops over the lifecycle of a KML: create it, read its metadata --reads times,
+update it and delete it. At the end the throughput, the error count and the latency percentiles
+are printed per operation.
+
+In order to compare deployments (e.g. GUNICORN_WORKER_CLASS=gevent vs gthread) run them with the
+same number of cores, for instance with `docker run --cpus=2`, and the same load test parameters.
+There is no ASGI deployment to compare, the gevent workers already serve the other requests of a
+worker while a request waits for S3 or DynamoDB.
+
+Usage:
+
+    python3 scripts/load_test.py http://localhost:5000/api/kml [--users N] [--duration S]
+'''
+import argparse
+import io
+import json
+import statistics
+import threading
+import time
+import urllib.error
+import urllib.request
+from collections import defaultdict
+from uuid import uuid4
+
+KML_CONTENT_TYPE = 'application/vnd.google-earth.kml+xml'
+
+
+def encode_multipart(fields, kml_data):
+    boundary = uuid4().hex
+    body = io.BytesIO()
+    for name, value in fields.items():
+        body.write(
+            f'--{boundary}\r\nContent-Disposition: form-data; name="{name}"\r\n\r\n{value}\r\n'.
+            encode('utf-8')
+        )
+    if kml_data is not None:
+        body.write(
+            f'--{boundary}\r\nContent-Disposition: form-data; name="kml"; filename="kml.xml"\r\n'
+            f'Content-Type: {KML_CONTENT_TYPE}\r\n\r\n'.encode('utf-8')
+        )
+        body.write(kml_data)
+        body.write(b'\r\n')
+    body.write(f'--{boundary}--\r\n'.encode('utf-8'))
+    return body.getvalue(), f'multipart/form-data; boundary={boundary}'
+
+
+class VirtualUser:
+
+    def __init__(self, args, kml_data, results):
+        self.args = args
+        self.kml_data = kml_data
+        self.results = results
+
+    def request(self, operation, method, path, fields=None, kml_data=None):
+        headers = {'Origin': self.args.origin}
+        data = None
+        if fields is not None:
+            data, headers['Content-Type'] = encode_multipart(fields, kml_data)
+        req = urllib.request.Request(
+            f'{self.args.url}{path}', data=data, headers=headers, method=method
+        )
+        start = time.perf_counter()
+        try:
+            with urllib.request.urlopen(req, timeout=self.args.timeout) as response:
+                status = response.status
+                body = response.read()
+        except urllib.error.HTTPError as error:
+            status = error.code
+            body = b''
+        except OSError:
+            status = None
+            body = b''
+        self.results[operation].append((time.perf_counter() - start, status))
+        if status is None or status >= 400:
+            return None
+        return json.loads(body)
+
+    def run(self, deadline):
+        while time.monotonic() < deadline:
+            metadata = self.request(
+                'create', 'POST', '/admin', {'author': 'load-test'}, self.kml_data
+            )
+            if metadata is None:
+                continue
+            for _ in range(self.args.reads):
+                self.request('read', 'GET', f'/admin/{metadata["id"]}')
+            self.request(
+                'update',
+                'PUT',
+                f'/admin/{metadata["id"]}', {'admin_id': metadata['admin_id']},
+                self.kml_data
+            )
+            self.request(
+                'delete', 'DELETE', f'/admin/{metadata["id"]}', {'admin_id': metadata['admin_id']}
+            )
+
+
+def percentile(values, percent):
+    return values[min(len(values) - 1, int(len(values) * percent / 100))]
+
+
+def report(results, duration):
+    total = sum(len(values) for values in results.values())
+    print(f'{total} requests in {duration:.1f} s: {total / duration:.1f} req/s')
+    print(
+        f'  {"operation":<10} {"requests":>9} {"errors":>7} {"req/s":>8} {"mean":>9} {"p50":>9} '
+        f'{"p95":>9} {"p99":>9} {"max":>9}'
+    )
+    for operation, values in results.items():
+        latencies = sorted(latency * 1000 for latency, _ in values)
+        errors = sum(1 for _, status in values if status is None or status >= 400)
+        print(
+            f'  {operation:<10} {len(values):>9} {errors:>7} {len(values) / duration:>8.1f} '
+            f'{statistics.mean(latencies):>7.1f}ms {percentile(latencies, 50):>7.1f}ms '
+            f'{percentile(latencies, 95):>7.1f}ms {percentile(latencies, 99):>7.1f}ms '
+            f'{latencies[-1]:>7.1f}ms'
+        )
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Service load test')
+    parser.add_argument('url', help='Service base url, e.g. http://localhost:5000/api/kml')
+    parser.add_argument('--users', type=int, default=20, help='Number of concurrent users')
+    parser.add_argument('--duration', type=float, default=30, help='Test duration in seconds')
+    parser.add_argument('--reads', type=int, default=5, help='Metadata reads per created KML')
+    parser.add_argument('--timeout', type=float, default=30, help='Request timeout in seconds')
+    parser.add_argument(
+        '--kml', default='tests/samples/valid-kml.xml', help='KML file to create and update'
+    )
+    parser.add_argument('--origin', default='https://map.geo.admin.ch', help='Origin header')
+    args = parser.parse_args()
+    args.url = args.url.rstrip('/')
+
+    with open(args.kml, 'rb') as fd:
+        kml_data = fd.read()
+
+    results = defaultdict(list)
+    start = time.monotonic()
+    deadline = start + args.duration
+    users = [
+        threading.Thread(target=VirtualUser(args, kml_data, results).run, args=(deadline,))
+        for _ in range(args.users)
+    ]
+    for user in users:
+        user.start()
+    for user in users:
+        user.join()
+    report(results, time.monotonic() - start)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,103 @@
+#!python3
+'''Orphan S3 objects and DynamoDB items sweeper, see app/helpers/sweeper.py
+
+Reports the S3 objects without item and the items without S3 objects, and fixes them with
+--delete. The items without kml file are only deleted with --delete-items. Meant to be run
+periodically, e.g. as a cron job.
+
+Usage:
+
+    python3 scripts/sweep.py [--delete [--delete-items]] [--grace-period SECONDS] [--rate N]
+        [--segments N]
+'''
+import argparse
+import logging
+from datetime import timedelta
+
+import init_scripts  # pylint: disable=unused-import
+
+from app.helpers.bulk import get_clients
+from app.helpers.sweeper import Sweeper
+from app.settings import AWS_DB_ENDPOINT_URL
+from app.settings import AWS_DB_REGION_NAME
+from app.settings import AWS_DB_TABLE_NAME
+from app.settings import AWS_S3_BUCKET_NAME
+from app.settings import AWS_S3_ENDPOINT_URL
+from app.settings import AWS_S3_REGION_NAME
+from app.settings import SCRIPT_NAME
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Orphan S3 objects and DynamoDB items sweeper')
+    parser.add_argument('--table', default=AWS_DB_TABLE_NAME, help='DynamoDB table name')
+    parser.add_argument('--bucket', default=AWS_S3_BUCKET_NAME, help='S3 bucket name')
+    parser.add_argument(
+        '--prefix',
+        default=f'{SCRIPT_NAME}/files/'.lstrip('/'),
+        help='Prefix of the kml files in the bucket'
+    )
+    parser.add_argument(
+        '--blobs-prefix',
+        default=f'{SCRIPT_NAME}/blobs/'.lstrip('/'),
+        help='Prefix of the deduplicated kml files in the bucket'
+    )
+    parser.add_argument('--db-region', default=AWS_DB_REGION_NAME)
+    parser.add_argument('--db-endpoint-url', default=AWS_DB_ENDPOINT_URL)
+    parser.add_argument('--s3-region', default=AWS_S3_REGION_NAME)
+    parser.add_argument('--s3-endpoint-url', default=AWS_S3_ENDPOINT_URL)
+    parser.add_argument(
+        '--delete',
+        action='store_true',
+        help='Delete the orphan objects and fix the items, only report them otherwise (dry run)'
+    )
+    parser.add_argument(
+        '--delete-items',
+        action='store_true',
+        help='With --delete, also delete the items without kml file (cannot be undone)'
+    )
+    parser.add_argument(
+        '--grace-period',
+        type=float,
+        default=3600,
+        help='Skip the objects and items modified within this number of seconds'
+    )
+    parser.add_argument(
+        '--rate', type=float, default=100, help='Max deletions per second, 0 for no limit'
+    )
+    parser.add_argument('--segments', type=int, default=8, help='Number of parallel Scan segments')
+    parser.add_argument('--listers', type=int, default=16, help='Number of parallel S3 listings')
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.WARNING)
+
+    s3, dynamodb = get_clients(  # pylint: disable=invalid-name
+        args.s3_region,
+        args.s3_endpoint_url,
+        args.db_region,
+        args.db_endpoint_url,
+        max_connections=args.segments + args.listers
+    )
+    report = Sweeper(
+        s3,
+        dynamodb,
+        args.table,
+        args.bucket,
+        args.prefix,
+        blobs_prefix=args.blobs_prefix,
+        grace_period=timedelta(seconds=args.grace_period),
+        dry_run=not args.delete,
+        delete_items=args.delete_items,
+        rate=args.rate,
+        segments=args.segments,
+        listers=args.listers
+    ).run()
+    print(report)
+    for key in report.orphan_objects:
+        print(f'object without item: {key}')
+    for kml_id in report.items_without_file:
+        print(f'item without kml file: {kml_id}')
+    for kml_id in report.items_without_sidecars:
+        print(f'item with missing sidecars: {kml_id}')
+
+
+if __name__ == '__main__':
+    main()
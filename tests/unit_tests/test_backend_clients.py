@@ -0,0 +1,123 @@
+import importlib
+import os
+import unittest
+from unittest.mock import patch
+
+from flask import url_for
+
+import boto3
+
+from botocore.exceptions import ClientError
+
+from app import settings
+from app.helpers.dynamodb import close_db
+from app.helpers.dynamodb import get_db
+from app.helpers.dynamodb import init_db
+from app.helpers.s3 import close_storage
+from app.helpers.s3 import get_storage
+from app.helpers.s3 import init_storage
+from app.settings import AWS_S3_BUCKET_NAME
+from app.settings import KML_FILE_CONTENT_ENCODING
+from app.settings import KML_FILE_CONTENT_TYPE
+from app.settings import MB
+from tests.unit_tests.base import BaseRouteTestCase
+
+
+class TestBackendClients(BaseRouteTestCase):
+
+    def setUp(self):
+        super().setUp()
+        close_storage()
+        close_db()
+
+    def test_clients_created_once_per_worker(self):
+        with patch('app.helpers.s3.boto3.client', wraps=boto3.client) as client_mock, \
+            patch('app.helpers.dynamodb.resource', wraps=boto3.resource) as resource_mock:
+            sample_kml = self.create_test_kml('valid-kml.xml', author='mf-geoadmin3').json
+            for _ in range(3):
+                response = self.app.get(
+                    url_for('get_kml_metadata', kml_id=sample_kml['id']),
+                    headers=self.origin_headers["allowed"]
+                )
+                self.assertEqual(response.status_code, 200)
+            self.create_test_kml('valid-kml.xml.gz', author='mf-geoadmin3')
+        client_mock.assert_called_once()
+        resource_mock.assert_called_once()
+
+    def test_clients_lifecycle(self):
+        init_storage()
+        init_db()
+        storage = get_storage()
+        db = get_db()
+        self.assertIs(storage, get_storage())
+        self.assertIs(db, get_db())
+
+        close_storage()
+        close_db()
+        self.assertIsNot(storage, get_storage())
+        self.assertIsNot(db, get_db())
+
+
+@patch('app.helpers.s3.KML_MULTIPART_THRESHOLD', 5 * MB)
+@patch('app.helpers.s3.KML_MULTIPART_PART_SIZE', 5 * MB)
+class TestMultipartUpload(BaseRouteTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.storage = get_storage()
+        self.data = os.urandom(11 * MB)
+
+    def list_multipart_uploads(self):
+        return self.storage.s3.list_multipart_uploads(Bucket=AWS_S3_BUCKET_NAME).get('Uploads', [])
+
+    def test_small_file_single_put(self):
+        with patch.object(self.storage.s3, 'create_multipart_upload') as create_mock:
+            self.storage.upload_object_to_bucket('files/small', self.data[:MB])
+        create_mock.assert_not_called()
+        self.assertEqual(self.get_s3_object('files/small')['Body'].read(), self.data[:MB])
+
+    def test_disabled(self):
+        with patch('app.helpers.s3.KML_MULTIPART_THRESHOLD', 0), \
+            patch.object(self.storage.s3, 'create_multipart_upload') as create_mock:
+            self.storage.upload_object_to_bucket('files/large', self.data)
+        create_mock.assert_not_called()
+        self.assertEqual(self.get_s3_object('files/large')['Body'].read(), self.data)
+
+    def test_large_file_in_parts(self):
+        with patch.object(
+            self.storage.s3, 'upload_part', wraps=self.storage.s3.upload_part
+        ) as upload_part_mock:
+            self.storage.upload_object_to_bucket('files/large', self.data)
+        self.assertEqual(upload_part_mock.call_count, 3)
+        s3_object = self.get_s3_object('files/large')
+        self.assertEqual(s3_object['ContentEncoding'], KML_FILE_CONTENT_ENCODING)
+        self.assertEqual(s3_object['ContentType'], KML_FILE_CONTENT_TYPE)
+        self.assertEqual(s3_object['Body'].read(), self.data)
+        self.assertListEqual(self.list_multipart_uploads(), [])
+
+    def test_failed_part_aborts_upload(self):
+        upload_part = self.storage.s3.upload_part
+
+        def fail_last_part(**kwargs):
+            if kwargs['PartNumber'] == 3:
+                raise ClientError({'Error': {'Code': 'InternalError'}}, 'UploadPart')
+            return upload_part(**kwargs)
+
+        with patch.object(self.storage.s3, 'upload_part', side_effect=fail_last_part):
+            with self.assertRaises(ClientError):
+                self.storage.upload_object_to_bucket('files/failed', self.data)
+        self.assertIsNone(self.get_s3_object('files/failed'))
+        self.assertListEqual(self.list_multipart_uploads(), [])
+
+
+class TestMultipartSettings(unittest.TestCase):
+
+    def tearDown(self):
+        importlib.reload(settings)
+
+    def test_part_size_too_small(self):
+        with patch.dict(os.environ, {'KML_MULTIPART_PART_SIZE': str(4 * MB)}):
+            with self.assertRaisesRegex(ValueError, 'KML_MULTIPART_PART_SIZE'):
+                importlib.reload(settings)
+        with patch.dict(os.environ, {'KML_MULTIPART_PART_SIZE': str(5 * MB)}):
+            self.assertEqual(importlib.reload(settings).KML_MULTIPART_PART_SIZE, 5 * MB)
@@ -0,0 +1,180 @@
+import json
+import tempfile
+from pathlib import Path
+from unittest.mock import patch
+
+from app.helpers.bulk import BulkExporter
+from app.helpers.bulk import BulkImporter
+from app.helpers.bulk import Checkpoint
+from app.helpers.bulk import get_clients
+from app.settings import AWS_DB_REGION_NAME
+from app.settings import AWS_DB_TABLE_NAME
+from app.settings import AWS_S3_BUCKET_NAME
+from app.settings import AWS_S3_REGION_NAME
+from tests.unit_tests.base import BaseRouteTestCase
+
+IMPORT_TABLE_NAME = 'import-db'
+IMPORT_BUCKET_NAME = 'import-bucket'
+
+
+class TestBulk(BaseRouteTestCase):
+
+    def setUp(self):
+        super().setUp()
+        patcher = patch('app.helpers.compression.SIDECAR_ENCODINGS', ['br'])
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.s3, self.client = get_clients(  # pylint: disable=invalid-name
+            AWS_S3_REGION_NAME, None, AWS_DB_REGION_NAME, None, max_connections=10
+        )
+        self.kml_ids = [
+            self.create_test_kml('valid-kml.xml', author='mf-geoadmin3').json['id']
+            for _ in range(5)
+        ]
+        self.archive = tempfile.TemporaryDirectory()  # pylint: disable=consider-using-with
+        self.addCleanup(self.archive.cleanup)
+
+    def create_import_target(self):
+        self.client.create_table(
+            TableName=IMPORT_TABLE_NAME,
+            AttributeDefinitions=[{
+                'AttributeName': 'kml_id', 'AttributeType': 'S'
+            }],
+            KeySchema=[{
+                'AttributeName': 'kml_id', 'KeyType': 'HASH'
+            }],
+            BillingMode='PAY_PER_REQUEST'
+        )
+        self.addCleanup(self.client.delete_table, TableName=IMPORT_TABLE_NAME)
+        self.s3.create_bucket(
+            Bucket=IMPORT_BUCKET_NAME,
+            CreateBucketConfiguration={'LocationConstraint': AWS_S3_REGION_NAME}
+        )
+        self.addCleanup(self.delete_import_bucket)
+
+    def delete_import_bucket(self):
+        for obj in self.s3.list_objects_v2(Bucket=IMPORT_BUCKET_NAME).get('Contents', []):
+            self.s3.delete_object(Bucket=IMPORT_BUCKET_NAME, Key=obj['Key'])
+        self.s3.delete_bucket(Bucket=IMPORT_BUCKET_NAME)
+
+    def export(self, **kwargs):
+        # NOTE moto ignores the Scan segments, every segment returns all items
+        kwargs = {'segments': 1, 'transfers': 4, 'report_interval': 60, **kwargs}
+        return BulkExporter(
+            self.s3,
+            self.client,
+            AWS_DB_TABLE_NAME,
+            AWS_S3_BUCKET_NAME,
+            self.archive.name,
+            **kwargs
+        ).run()
+
+    def make_importer(self, **kwargs):
+        kwargs = {'workers': 2, 'transfers': 4, 'report_interval': 60, **kwargs}
+        return BulkImporter(
+            self.s3,
+            self.client,
+            IMPORT_TABLE_NAME,
+            IMPORT_BUCKET_NAME,
+            self.archive.name,
+            **kwargs
+        )
+
+    def import_archive(self, **kwargs):
+        return self.make_importer(**kwargs).run()
+
+    def get_archive_items(self):
+        return [
+            json.loads(line)
+            for path in Path(self.archive.name, 'items').glob('*.jsonl')
+            for line in path.read_text(encoding='utf-8').splitlines()
+        ]
+
+    def get_objects(self, bucket):
+        return {
+            obj['Key']: self.s3.get_object(Bucket=bucket, Key=obj['Key'])
+            for obj in self.s3.list_objects_v2(Bucket=bucket).get('Contents', [])
+        }
+
+    def test_export_import(self):
+        throughput = self.export()
+        self.assertEqual(throughput.items, 5)
+        self.assertEqual(throughput.files, 10)
+        self.assertEqual(
+            sorted(item['kml_id']['S'] for item in self.get_archive_items()), sorted(self.kml_ids)
+        )
+
+        self.create_import_target()
+        throughput = self.import_archive()
+        self.assertEqual(throughput.items, 5)
+        self.assertEqual(throughput.files, 10)
+
+        for kml_id in self.kml_ids:
+            source = self.client.get_item(
+                TableName=AWS_DB_TABLE_NAME, Key={'kml_id': {
+                    'S': kml_id
+                }}
+            )
+            target = self.client.get_item(
+                TableName=IMPORT_TABLE_NAME, Key={'kml_id': {
+                    'S': kml_id
+                }}
+            )
+            self.assertEqual(
+                {
+                    **source['Item'], 'bucket': {
+                        'S': IMPORT_BUCKET_NAME
+                    }
+                }, target['Item']
+            )
+        source_objects = self.get_objects(AWS_S3_BUCKET_NAME)
+        target_objects = self.get_objects(IMPORT_BUCKET_NAME)
+        self.assertEqual(sorted(source_objects), sorted(target_objects))
+        for key, obj in target_objects.items():
+            self.assertEqual(obj['ContentEncoding'], source_objects[key]['ContentEncoding'])
+            self.assertEqual(obj['Body'].read(), source_objects[key]['Body'].read())
+
+    def test_export_resumed(self):
+        download = BulkExporter._download  # pylint: disable=protected-access
+        calls = []
+
+        def failing_download(exporter, key, encoding):
+            calls.append(key)
+            if len(calls) == 5:
+                raise ConnectionError('Connection lost')
+            return download(exporter, key, encoding)
+
+        with patch.object(BulkExporter, '_download', failing_download):
+            with self.assertRaises(ConnectionError):
+                self.export(segments=1, page_size=1, transfers=1)
+        self.assertEqual(len(self.get_archive_items()), 2)
+
+        throughput = self.export(segments=1, page_size=1)
+        self.assertEqual(throughput.items, 3)
+        self.assertEqual(
+            sorted(item['kml_id']['S'] for item in self.get_archive_items()), sorted(self.kml_ids)
+        )
+
+        with self.assertRaises(ValueError):
+            self.export(segments=3)
+
+    def test_import_resumed(self):
+        self.export()
+        self.create_import_target()
+        segment = 'segment-0000.jsonl'
+        # The first items have already been imported
+        Checkpoint(Path(self.archive.name, 'import-checkpoint.json')).update(segment, lines=3)
+
+        throughput = self.import_archive()
+        self.assertEqual(throughput.items, 2)
+        self.assertEqual(self.client.scan(TableName=IMPORT_TABLE_NAME, Select='COUNT')['Count'], 2)
+        self.assertEqual(self.import_archive().items, 0)
+
+    def test_import_run_twice(self):
+        self.export()
+        self.create_import_target()
+        importer = self.make_importer()
+        self.assertEqual(importer.run().items, 5)
+        # The transfer pool of the first run has been shut down
+        importer.checkpoint.update('segment-0000.jsonl', lines=3, done=False)
+        self.assertEqual(importer.run().items, 7)
@@ -0,0 +1,164 @@
+import unittest
+from unittest.mock import patch
+
+from flask import url_for
+
+from app.helpers.cache import MISS
+from app.helpers.cache import MetadataCache
+from app.helpers.dynamodb import get_db
+from tests.unit_tests.base import BaseRouteTestCase
+from tests.unit_tests.base import prepare_kml_payload
+
+
+class FakeClock:
+
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+class TestMetadataCache(unittest.TestCase):
+
+    def setUp(self):
+        self.clock = FakeClock()
+        self.cache = MetadataCache(2, ttl=10, negative_ttl=1, clock=self.clock)
+
+    def set(self, key, value):
+        self.cache.set(key, value, self.cache.get_version())
+
+    def test_get_set(self):
+        self.assertIs(self.cache.get('a'), MISS)
+        self.set('a', {'sidecars': ['br']})
+        self.assertEqual(self.cache.get('a'), {'sidecars': ['br']})
+        # The cached value is a copy
+        self.cache.get('a')['sidecars'].append('zstd')
+        self.assertEqual(self.cache.get('a'), {'sidecars': ['br']})
+        self.assertEqual(self.cache.stats(), {'size': 1, 'hits': 3, 'misses': 1, 'hit_ratio': 0.75})
+
+    def test_expiration(self):
+        self.set('a', 'item')
+        self.set('unknown', None)
+        self.clock.now = 0.5
+        self.assertEqual(self.cache.get('a'), 'item')
+        self.assertIsNone(self.cache.get('unknown'))
+        self.clock.now = 1
+        self.assertEqual(self.cache.get('a'), 'item')
+        self.assertIs(self.cache.get('unknown'), MISS)
+        self.clock.now = 10
+        self.assertIs(self.cache.get('a'), MISS)
+        self.assertEqual(self.cache.stats()['size'], 0)
+
+    def test_lru_eviction(self):
+        self.set('a', 1)
+        self.set('b', 2)
+        self.cache.get('a')
+        self.set('c', 3)
+        self.assertEqual(self.cache.get('a'), 1)
+        self.assertIs(self.cache.get('b'), MISS)
+        self.assertEqual(self.cache.get('c'), 3)
+
+    def test_invalidate(self):
+        self.set('a', 1)
+        self.set('b', 2)
+        self.cache.invalidate('a')
+        self.assertIs(self.cache.get('a'), MISS)
+        self.assertEqual(self.cache.get('b'), 2)
+
+    def test_invalidated_while_reading(self):
+        version = self.cache.get_version()
+        self.cache.invalidate('a')
+        self.cache.set('a', 'stale', version)
+        self.assertIs(self.cache.get('a'), MISS)
+
+    def test_disabled(self):
+        cache = MetadataCache(0, ttl=10, negative_ttl=1)
+        cache.set('a', 1, cache.get_version())
+        self.assertIs(cache.get('a'), MISS)
+        self.assertEqual(cache.stats(), {'size': 0, 'hits': 0, 'misses': 0, 'hit_ratio': 0.0})
+
+
+class TestMetadataCacheRoutes(BaseRouteTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.db = get_db()
+        patcher = patch.object(self.db, 'cache', MetadataCache(100, ttl=60, negative_ttl=60))
+        self.cache = patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def get_metadata(self, kml_id):
+        return self.app.get(
+            url_for('get_kml_metadata', kml_id=kml_id), headers=self.origin_headers["allowed"]
+        )
+
+    def get_metadata_by_admin_id(self, admin_id):
+        return self.app.get(
+            url_for('get_kml_metadata_by_admin_id', admin_id=admin_id),
+            headers=self.origin_headers["allowed"]
+        )
+
+    def test_get_kml_metadata_cached(self):
+        response = self.create_test_kml('valid-kml.xml', author='mf-geoadmin3')
+        kml_id = response.json['id']
+        admin_id = response.json['admin_id']
+
+        with patch.object(self.db.table, 'get_item', wraps=self.db.table.get_item) as get_item:
+            for _ in range(3):
+                response = self.get_metadata(kml_id)
+                self.assertEqual(response.status_code, 200)
+                self.assertEqual(response.json['id'], kml_id)
+            self.assertEqual(get_item.call_count, 1)
+
+        with patch.object(self.db.table, 'query', wraps=self.db.table.query) as query:
+            for _ in range(3):
+                response = self.get_metadata_by_admin_id(admin_id)
+                self.assertEqual(response.status_code, 200)
+                self.assertEqual(response.json['admin_id'], admin_id)
+            self.assertEqual(query.call_count, 1)
+        self.assertEqual(self.cache.stats()['hits'], 6)
+
+    def test_get_kml_metadata_invalidated(self):
+        response = self.create_test_kml('valid-kml.xml', author='mf-geoadmin3')
+        kml_id = response.json['id']
+        admin_id = response.json['admin_id']
+        self.assertEqual(self.get_metadata(kml_id).json['updated'], response.json['updated'])
+
+        response = self.app.put(
+            url_for('update_kml', kml_id=kml_id),
+            data=prepare_kml_payload(kml_file='updated-kml.xml', admin_id=admin_id),
+            content_type="multipart/form-data",
+            headers=self.origin_headers["allowed"]
+        )
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(self.get_metadata(kml_id).json['updated'], response.json['updated'])
+        self.assertEqual(
+            self.get_metadata_by_admin_id(admin_id).json['updated'], response.json['updated']
+        )
+
+        response = self.delete_test_kml(kml_id, admin_id)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(self.get_metadata(kml_id).status_code, 404)
+        self.assertEqual(self.get_metadata_by_admin_id(admin_id).status_code, 404)
+
+    def test_get_kml_metadata_not_modified_cached(self):
+        response = self.create_test_kml('valid-kml.xml', author='mf-geoadmin3')
+        kml_id = response.json['id']
+        etag = self.get_metadata(kml_id).headers['ETag']
+
+        with patch.object(self.db.table, 'get_item') as get_item:
+            response = self.app.get(
+                url_for('get_kml_metadata', kml_id=kml_id),
+                headers={
+                    **self.origin_headers["allowed"], 'If-None-Match': etag
+                }
+            )
+            self.assertEqual(response.status_code, 304)
+            get_item.assert_not_called()
+
+    def test_get_kml_metadata_not_found_cached(self):
+        with patch.object(self.db.table, 'get_item', wraps=self.db.table.get_item) as get_item:
+            for _ in range(2):
+                self.assertEqual(self.get_metadata('unknown-kml-id').status_code, 404)
+            self.assertEqual(get_item.call_count, 1)
@@ -0,0 +1,135 @@
+import gzip
+import unittest
+from unittest.mock import patch
+
+from flask import url_for
+
+from app.helpers import compression
+from app.helpers.compression import KmlCompressor
+from app.helpers.compression import check_sidecar_encodings
+from app.helpers.compression import get_gzip_backend
+from app.settings import AWS_S3_BUCKET_NAME
+from tests.unit_tests.base import BaseRouteTestCase
+from tests.unit_tests.base import prepare_kml_payload
+
+SIDECARS_INSTALLED = compression.brotli is not None and compression.zstandard is not None
+
+
+def decompress_sidecar(encoding, data):
+    if encoding == 'br':
+        return compression.brotli.decompress(data)
+    return compression.zstandard.ZstdDecompressor().decompressobj().decompress(data)
+
+
+class TestCompression(unittest.TestCase):
+
+    def setUp(self):
+        with open('./tests/samples/valid-kml.xml', 'rb') as fd:
+            self.kml_data = fd.read()
+
+    def test_gzip_backends(self):
+        for backend, (module, _) in compression.GZIP_BACKENDS.items():
+            for level in [0, 1, 5, 9]:
+                with self.subTest(backend=backend, level=level):
+                    if module is None:
+                        self.skipTest(f'{backend} not installed')
+                    _, compressobj = get_gzip_backend(backend)
+                    compressor = compressobj(level)
+                    data = compressor.compress(self.kml_data) + compressor.flush()
+                    self.assertEqual(gzip.decompress(data), self.kml_data)
+
+    def test_invalid_settings(self):
+        with self.assertRaises(ValueError):
+            get_gzip_backend('lzma')
+        with self.assertRaises(ValueError):
+            check_sidecar_encodings(['gzip'])
+        with patch.dict(compression.SIDECAR_COMPRESSORS, {'br': (None, 'brotli', None)}):
+            with self.assertRaises(ValueError):
+                check_sidecar_encodings(['br'])
+
+    def test_kml_compressor_gzip_only(self):
+        compressor = KmlCompressor(sidecars=[])
+        compressor.compress(self.kml_data[:100])
+        compressor.compress(self.kml_data[100:])
+        compressed = compressor.flush()
+        self.assertEqual(list(compressed), ['gzip'])
+        self.assertEqual(gzip.decompress(compressed['gzip']), self.kml_data)
+
+    @unittest.skipUnless(SIDECARS_INSTALLED, 'brotli and/or zstandard not installed')
+    def test_kml_compressor_sidecars(self):
+        compressor = KmlCompressor(sidecars=['br', 'zstd'])
+        compressor.compress(self.kml_data[:100])
+        compressor.compress(self.kml_data[100:])
+        compressed = compressor.flush()
+        self.assertEqual(set(compressed), {'gzip', 'br', 'zstd'})
+        for encoding in ['br', 'zstd']:
+            with self.subTest(encoding=encoding):
+                self.assertEqual(decompress_sidecar(encoding, compressed[encoding]), self.kml_data)
+
+
+@unittest.skipUnless(SIDECARS_INSTALLED, 'brotli and/or zstandard not installed')
+class TestSidecarRoutes(BaseRouteTestCase):
+
+    def setUp(self):
+        super().setUp()
+        patcher = patch('app.helpers.compression.SIDECAR_ENCODINGS', ['br', 'zstd'])
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def get_object(self, key):
+        return self.s3bucket.meta.client.get_object(Bucket=AWS_S3_BUCKET_NAME, Key=key)
+
+    def assertSidecars(self, file_key, expected_kml_file):
+        with open(f'./tests/samples/{expected_kml_file}', 'rb') as fd:
+            expected_kml = fd.read()
+        for encoding, extension in [('br', 'br'), ('zstd', 'zst')]:
+            obj = self.get_object(f'{file_key}.{extension}')
+            self.assertEqual(obj['ContentEncoding'], encoding)
+            self.assertEqual(decompress_sidecar(encoding, obj['Body'].read()), expected_kml)
+
+    def assertNoSidecars(self, file_key):
+        response = self.s3bucket.meta.client.list_objects_v2(
+            Bucket=AWS_S3_BUCKET_NAME, Prefix=f'{file_key}.'
+        )
+        self.assertEqual(response['KeyCount'], 0)
+
+    def test_sidecars_lifecycle(self):
+        response = self.create_test_kml('valid-kml.xml', author='mf-geoadmin3')
+        kml_id = response.json['id']
+        admin_id = response.json['admin_id']
+        file_key = response.json['links']['kml'].split('/', 3)[-1]
+        self.assertKml(response, 'valid-kml.xml', with_admin_id=True)
+        self.assertSidecars(file_key, 'valid-kml.xml')
+
+        response = self.app.put(
+            url_for('update_kml', kml_id=kml_id),
+            data=prepare_kml_payload(kml_file='updated-kml.xml', admin_id=admin_id),
+            content_type="multipart/form-data",
+            headers=self.origin_headers["allowed"]
+        )
+        self.assertEqual(response.status_code, 200)
+        self.assertSidecars(file_key, 'updated-kml.xml')
+
+        # Stale sidecars are removed once they are disabled
+        with patch('app.helpers.compression.SIDECAR_ENCODINGS', []):
+            response = self.app.put(
+                url_for('update_kml', kml_id=kml_id),
+                data=prepare_kml_payload(kml_file='valid-kml.xml', admin_id=admin_id),
+                content_type="multipart/form-data",
+                headers=self.origin_headers["allowed"]
+            )
+        self.assertEqual(response.status_code, 200)
+        self.assertNoSidecars(file_key)
+
+        response = self.app.put(
+            url_for('update_kml', kml_id=kml_id),
+            data=prepare_kml_payload(kml_file='valid-kml.xml', admin_id=admin_id),
+            content_type="multipart/form-data",
+            headers=self.origin_headers["allowed"]
+        )
+        self.assertEqual(response.status_code, 200)
+        self.assertSidecars(file_key, 'valid-kml.xml')
+
+        response = self.delete_test_kml(kml_id, admin_id)
+        self.assertEqual(response.status_code, 200)
+        self.assertNoSidecars(file_key)
@@ -0,0 +1,136 @@
+import threading
+import unittest
+from unittest.mock import patch
+
+from flask import abort
+from flask import request
+from flask import url_for
+
+from app import app
+from app.helpers.concurrency import raise_first_error
+from app.helpers.concurrency import run_concurrently
+from app.settings import AWS_DB_TABLE_NAME
+from app.settings import AWS_S3_BUCKET_NAME
+from tests.unit_tests.base import BaseRouteTestCase
+from tests.unit_tests.base import prepare_kml_payload
+
+
+def s3_connection_error(*args, **kwargs):
+    abort(502, 'Backend file storage connection error, please consult logs')
+
+
+def db_connection_error(*args, **kwargs):
+    abort(502, 'Backend DB connection error, please consult logs')
+
+
+class TestRunConcurrently(unittest.TestCase):
+
+    def test_run_concurrently(self):
+        # Would time out if the functions were run one after the other
+        barrier = threading.Barrier(3, timeout=5)
+
+        def wait(value):
+            barrier.wait()
+            return value
+
+        outcomes = run_concurrently(lambda: wait(1), lambda: wait(2), lambda: wait(3))
+        self.assertEqual([outcome.get() for outcome in outcomes], [1, 2, 3])
+
+    def test_run_concurrently_errors(self):
+        outcomes = run_concurrently(lambda: 1 / 0, lambda: 'ok')
+        self.assertFalse(outcomes[0].ok)
+        self.assertIsInstance(outcomes[0].error, ZeroDivisionError)
+        self.assertTrue(outcomes[1].ok)
+        self.assertEqual(outcomes[1].get(), 'ok')
+        with self.assertRaises(ZeroDivisionError):
+            raise_first_error(outcomes)
+
+    def test_run_concurrently_request_context(self):
+        with app.test_request_context('/api/kml/admin'):
+            outcomes = run_concurrently(lambda: request.path, lambda: request.path)
+        self.assertEqual([outcome.get() for outcome in outcomes], ['/api/kml/admin'] * 2)
+
+
+class TestConcurrentRoutes(BaseRouteTestCase):
+
+    def count_items(self):
+        return self.dynamodb.Table(AWS_DB_TABLE_NAME).scan(Select='COUNT')['Count']
+
+    def count_files(self):
+        return self.s3bucket.meta.client.list_objects_v2(Bucket=AWS_S3_BUCKET_NAME)['KeyCount']
+
+    def post_kml(self):
+        return self.app.post(
+            url_for('create_kml'),
+            data=prepare_kml_payload(kml_file='valid-kml.xml', author='mf-geoadmin3'),
+            content_type="multipart/form-data",
+            headers=self.origin_headers["allowed"]
+        )
+
+    def test_create_kml_upload_failure(self):
+        items, files = self.count_items(), self.count_files()
+        with patch(
+            'app.helpers.s3.S3FileHandling.upload_object_to_bucket',
+            side_effect=s3_connection_error
+        ):
+            response = self.post_kml()
+        self.assertEqual(response.status_code, 502)
+        self.assertEqual(self.count_items(), items)
+        self.assertEqual(self.count_files(), files)
+
+    def test_create_kml_db_failure(self):
+        items, files = self.count_items(), self.count_files()
+        with patch(
+            'app.helpers.dynamodb.DynamoDBFilesHandler.save_item', side_effect=db_connection_error
+        ):
+            response = self.post_kml()
+        self.assertEqual(response.status_code, 502)
+        self.assertEqual(
+            response.json['error']['message'], 'Backend DB connection error, please consult logs'
+        )
+        self.assertEqual(self.count_items(), items)
+        self.assertEqual(self.count_files(), files)
+
+    def test_update_kml_upload_failure(self):
+        response = self.create_test_kml('valid-kml.xml', author='mf-geoadmin3')
+        kml_id = response.json['id']
+        db_item = self.dynamodb.Table(AWS_DB_TABLE_NAME).get_item(Key={'kml_id': kml_id})['Item']
+        with patch(
+            'app.helpers.s3.S3FileHandling.upload_object_to_bucket',
+            side_effect=s3_connection_error
+        ):
+            response = self.app.put(
+                url_for('update_kml', kml_id=kml_id),
+                data=prepare_kml_payload(
+                    kml_file='updated-kml.xml', admin_id=response.json['admin_id']
+                ),
+                content_type="multipart/form-data",
+                headers=self.origin_headers["allowed"]
+            )
+        self.assertEqual(response.status_code, 502)
+        self.assertEqual(
+            self.dynamodb.Table(AWS_DB_TABLE_NAME).get_item(Key={'kml_id': kml_id})['Item'],
+            db_item
+        )
+
+    def test_delete_kml_s3_failure(self):
+        response = self.create_test_kml('valid-kml.xml', author='mf-geoadmin3')
+        kml_id = response.json['id']
+        admin_id = response.json['admin_id']
+        with patch(
+            'app.helpers.s3.S3FileHandling.delete_file_in_bucket', side_effect=s3_connection_error
+        ):
+            response = self.delete_test_kml(kml_id, admin_id)
+        self.assertEqual(response.status_code, 502)
+        response = self.app.get(
+            url_for('get_kml_metadata', kml_id=kml_id), headers=self.origin_headers["allowed"]
+        )
+        self.assertEqual(response.status_code, 200)
+
+        # The deletion can be retried
+        response = self.delete_test_kml(kml_id, admin_id)
+        self.assertEqual(response.status_code, 200)
+        response = self.app.get(
+            url_for('get_kml_metadata', kml_id=kml_id), headers=self.origin_headers["allowed"]
+        )
+        self.assertEqual(response.status_code, 404)
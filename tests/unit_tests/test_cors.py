@@ -0,0 +1,54 @@
+import unittest
+
+from flask import url_for
+
+from app.app import app
+from app.helpers.cors import OriginPolicy
+from app.settings import CORS_MAX_AGE
+from tests.unit_tests.base import BaseRouteTestCase
+
+
+class TestOriginPolicy(unittest.TestCase):
+
+    def test_is_allowed(self):
+        policy = OriginPolicy(r'(.*\.geo\.admin\.ch|http://localhost)', memo_size=2)
+        self.assertTrue(policy.is_allowed('map.geo.admin.ch'))
+        self.assertTrue(policy.is_allowed('map.geo.admin.ch'))
+        self.assertTrue(policy.is_allowed('http://localhost:8080'))
+        self.assertFalse(policy.is_allowed('big-bad-wolf.com'))
+        info = policy.is_allowed.cache_info()
+        self.assertEqual(info.hits, 1)
+        self.assertEqual(info.currsize, 2)
+
+    def test_allowed_methods(self):
+        policy = OriginPolicy(r'.*')
+        rule = next(rule for rule in app.url_map.iter_rules() if rule.endpoint == 'create_kml')
+        self.assertEqual(policy.allowed_methods(app, rule), 'GET, HEAD, OPTIONS, POST')
+        self.assertEqual(policy.allowed_methods(app, None), '')
+
+
+class TestPreflight(BaseRouteTestCase):
+
+    def preflight(self, headers):
+        return self.app.options(
+            url_for('create_kml'), headers={
+                **headers, 'Access-Control-Request-Method': 'POST'
+            }
+        )
+
+    def test_preflight(self):
+        response = self.preflight(self.origin_headers["allowed"])
+        self.assertEqual(response.status_code, 200)
+        self.assertCors(response, ['GET', 'HEAD', 'POST', 'OPTIONS'])
+        self.assertEqual(response.headers['Access-Control-Allow-Origin'], 'map.geo.admin.ch')
+        self.assertEqual(response.headers['Access-Control-Max-Age'], str(CORS_MAX_AGE))
+        self.assertEqual(response.headers['Vary'], 'Origin')
+
+    def test_preflight_non_allowed_origin(self):
+        response = self.preflight(self.origin_headers["bad"])
+        self.assertEqual(response.status_code, 403)
+        self.assertNotIn('Access-Control-Max-Age', response.headers)
+
+    def test_no_max_age_without_preflight(self):
+        response = self.app.get(url_for('checker'), headers=self.origin_headers["allowed"])
+        self.assertNotIn('Access-Control-Max-Age', response.headers)
@@ -0,0 +1,255 @@
+from datetime import timedelta
+from unittest.mock import patch
+
+from flask import url_for
+
+from app.helpers.bulk import get_clients
+from app.helpers.dynamodb import get_db
+from app.helpers.s3 import get_storage
+from app.helpers.sweeper import Sweeper
+from app.settings import AWS_DB_REGION_NAME
+from app.settings import AWS_DB_TABLE_NAME
+from app.settings import AWS_S3_BUCKET_NAME
+from app.settings import AWS_S3_REGION_NAME
+from tests.unit_tests.base import BaseRouteTestCase
+from tests.unit_tests.base import prepare_kml_payload
+
+
+class TestDeduplication(BaseRouteTestCase):
+
+    def setUp(self):
+        super().setUp()
+        for target, value in [
+            ('app.helpers.compression.SIDECAR_ENCODINGS', ['br']),
+            ('app.routes.KML_STORAGE_DEDUPLICATION', True),
+        ]:
+            patcher = patch(target, value)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        storage = get_storage()
+        patcher = patch.object(storage.s3, 'put_object', wraps=storage.s3.put_object)
+        self.put_object = patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def get_item(self, kml_id):
+        return get_db().get_item(kml_id, cached=False)
+
+    def update_kml(self, kml_id, admin_id, kml_file):
+        response = self.app.put(
+            url_for('update_kml', kml_id=kml_id),
+            data=prepare_kml_payload(kml_file=kml_file, admin_id=admin_id),
+            content_type="multipart/form-data",
+            headers=self.origin_headers["allowed"]
+        )
+        self.assertEqual(response.status_code, 200)
+        return response
+
+    def test_identical_kmls_share_blob(self):
+        response = self.create_test_kml('valid-kml.xml', author='mf-geoadmin3')
+        kml_id = response.json['id']
+        self.assertTrue(response.json['links']['kml'].endswith(f'files/{kml_id}'))
+        item = self.get_item(kml_id)
+        self.assertEqual(item['file_key'], f'files/{kml_id}')
+        self.assertTrue(item['blob_key'].startswith('blobs/'))
+        self.assertIsNotNone(self.get_s3_object(item['blob_key']))
+        self.assertIsNotNone(self.get_s3_object(f'{item["blob_key"]}.br'))
+        self.assertIsNone(self.get_s3_object(item['file_key']))
+        self.put_object.reset_mock()
+
+        # The same kml gzipped has the same content, nothing is written to S3
+        with patch.object(get_storage().s3, 'copy_object') as copy_object:
+            response = self.create_test_kml('valid-kml.xml.gz', author='mf-geoadmin3')
+        self.assertEqual(self.get_item(response.json['id'])['blob_key'], item['blob_key'])
+        self.put_object.assert_not_called()
+        copy_object.assert_not_called()
+
+    def test_blob_deleted_before_item_written(self):
+        kml = self.create_test_kml('valid-kml.xml', author='mf-geoadmin3').json
+        blob_key = self.get_item(kml['id'])['blob_key']
+        self.assertEqual(self.delete_test_kml(kml['id'], kml['admin_id']).status_code, 200)
+        db = get_db()
+        save_item = db.save_item
+        storage = get_storage()
+        file_exists_in_bucket = storage.file_exists_in_bucket
+        checks = []
+
+        def file_exists(file_key):
+            # The blob and its sidecar are found before the sweeper deletes them
+            checks.append(file_key)
+            return len(checks) <= 2 or file_exists_in_bucket(file_key)
+
+        def sweep_and_save(*args, **kwargs):
+            storage.delete_file_in_bucket(blob_key)
+            storage.delete_sidecars_in_bucket(blob_key, ['br'])
+            return save_item(*args, **kwargs)
+
+        with patch.object(storage, 'file_exists_in_bucket', file_exists), \
+            patch.object(db, 'save_item', sweep_and_save):
+            kml = self.create_test_kml('valid-kml.xml', author='mf-geoadmin3').json
+        self.assertEqual(len(checks), 4)
+        self.assertEqual(self.get_item(kml['id'])['blob_key'], blob_key)
+        self.assertIsNotNone(self.get_s3_object(blob_key))
+        self.assertIsNotNone(self.get_s3_object(f'{blob_key}.br'))
+
+    def test_update_to_identical_content(self):
+        response = self.create_test_kml('valid-kml.xml', author='mf-geoadmin3')
+        kml_id = response.json['id']
+        admin_id = response.json['admin_id']
+        blob_key = self.get_item(kml_id)['blob_key']
+        other_blob_key = self.get_item(
+            self.create_test_kml('updated-kml.xml', author='mf-geoadmin3').json['id']
+        )['blob_key']
+        self.put_object.reset_mock()
+
+        self.update_kml(kml_id, admin_id, 'updated-kml.xml')
+        self.assertEqual(self.get_item(kml_id)['blob_key'], other_blob_key)
+        self.put_object.assert_not_called()
+        # The previous blob is not deleted, it might be shared
+        self.assertIsNotNone(self.get_s3_object(blob_key))
+
+    def test_delete_keeps_shared_blob(self):
+        kmls = [self.create_test_kml('valid-kml.xml', author='mf-geoadmin3').json for _ in range(2)]
+        blob_key = self.get_item(kmls[0]['id'])['blob_key']
+        self.assertEqual(self.delete_test_kml(kmls[0]['id'], kmls[0]['admin_id']).status_code, 200)
+        self.assertIsNotNone(self.get_s3_object(blob_key))
+        self.assertEqual(self.delete_test_kml(kmls[1]['id'], kmls[1]['admin_id']).status_code, 200)
+        self.assertIsNotNone(self.get_s3_object(blob_key))
+
+        # The unreferenced blob is removed by the sweeper
+        report = self.make_sweeper().run()
+        self.assertIn(blob_key, report.orphan_objects)
+        self.assertIsNone(self.get_s3_object(blob_key))
+        self.assertIsNone(self.get_s3_object(f'{blob_key}.br'))
+
+    def test_sweeper_keeps_reused_blob(self):
+        # Identical kml created after the scan preceding the deletion of the blob (found by the
+        # request, then deleted and restored), or after its deletion (uploaded again by the
+        # request, or restored)
+        for reused_at, after_scan in [(2, True), (3, False), (3, True)]:
+            with self.subTest(reused_at=reused_at, after_scan=after_scan):
+                kml = self.create_test_kml('valid-kml.xml', author='mf-geoadmin3').json
+                blob_key = self.get_item(kml['id'])['blob_key']
+                self.assertEqual(self.delete_test_kml(kml['id'], kml['admin_id']).status_code, 200)
+                report = self.sweep_while_reusing(reused_at, after_scan)
+                if reused_at == 2 or not after_scan:
+                    # Restored, not deleted
+                    self.assertNotIn(blob_key, report.orphan_objects)
+                self.assertIsNotNone(self.get_s3_object(blob_key))
+                self.assertIsNotNone(self.get_s3_object(f'{blob_key}.br'))
+                self.assertIsNone(self.get_s3_object(blob_key.replace('blobs/', 'blobs-trash/')))
+                reused = self.kmls[-1]
+                self.assertEqual(
+                    self.delete_test_kml(reused['id'], reused['admin_id']).status_code, 200
+                )
+
+    def sweep_while_reusing(self, reused_at, after_scan):
+        sweeper = self.make_sweeper()
+        scan = sweeper._scan  # pylint: disable=protected-access
+        scans = []
+        url = url_for('create_kml')
+
+        def scan_and_reuse(segment):
+            items = scan(segment) if after_scan else None
+            scans.append(segment)
+            if len(scans) == reused_at:
+                response = self.app.post(
+                    url,
+                    data=prepare_kml_payload(kml_file='valid-kml.xml', author='mf-geoadmin3'),
+                    content_type="multipart/form-data",
+                    headers=self.origin_headers["allowed"]
+                )
+                self.kmls.append({'id': response.json['id'], 'admin_id': response.json['admin_id']})
+            return items if after_scan else scan(segment)
+
+        with patch.object(sweeper, '_scan', scan_and_reuse):
+            report = sweeper.run()
+        self.assertEqual(len(scans), 3)
+        return report
+
+    def test_sweeper_empties_trash(self):
+        kml = self.create_test_kml('valid-kml.xml', author='mf-geoadmin3').json
+        blob_key = self.get_item(kml['id'])['blob_key']
+        storage = get_storage()
+        # Left by an interrupted sweep: a referenced blob moved to the trash and an orphan one
+        trash_key = blob_key.replace('blobs/', 'blobs-trash/')
+        storage.s3.copy_object(
+            Bucket=AWS_S3_BUCKET_NAME,
+            Key=trash_key,
+            CopySource={
+                'Bucket': AWS_S3_BUCKET_NAME, 'Key': blob_key
+            }
+        )
+        storage.delete_file_in_bucket(blob_key)
+        storage.upload_object_to_bucket('blobs-trash/0000', b'orphan')
+
+        report = self.make_sweeper().run()
+        self.assertEqual(report.items_without_file, [])
+        self.assertIsNotNone(self.get_s3_object(blob_key))
+        self.assertIsNone(self.get_s3_object(trash_key))
+        self.assertIsNone(self.get_s3_object('blobs-trash/0000'))
+
+    def make_sweeper(self):
+        s3, client = get_clients(  # pylint: disable=invalid-name
+            AWS_S3_REGION_NAME, None, AWS_DB_REGION_NAME, None, max_connections=10
+        )
+        return Sweeper(
+            s3,
+            client,
+            AWS_DB_TABLE_NAME,
+            AWS_S3_BUCKET_NAME,
+            'files/',
+            blobs_prefix='blobs/',
+            grace_period=timedelta(0),
+            dry_run=False,
+            segments=1
+        )
+
+    def test_get_kml_file_redirects_to_blob(self):
+        kml_id = self.create_test_kml('valid-kml.xml', author='mf-geoadmin3').json['id']
+        # The kml files are public, no origin is required
+        with patch('app.routes.KML_STORAGE_HOST_URL', 'http://storage'), \
+            patch('app.helpers.utils.KML_STORAGE_HOST_URL', 'http://storage'):
+            response = self.app.get(url_for('get_kml_file', kml_id=kml_id))
+        self.assertEqual(response.status_code, 302)
+        self.assertEqual(
+            response.headers['Location'], f'http://storage/{self.get_item(kml_id)["blob_key"]}'
+        )
+        self.assertEqual(response.headers['Cache-Control'], 'no-cache')
+
+        self.assertEqual(self.app.get(url_for('get_kml_file', kml_id='unknown')).status_code, 404)
+
+    def test_get_kml_file_streams_blob(self):
+        kml_id = self.create_test_kml('valid-kml.xml', author='mf-geoadmin3').json['id']
+        # Without public blob URL, the blob is served by the service
+        with patch('app.routes.KML_STORAGE_HOST_URL', None):
+            response = self.app.get(url_for('get_kml_file', kml_id=kml_id))
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.headers['Content-Encoding'], 'gzip')
+        self.assertEqual(
+            response.data, self.get_s3_object(self.get_item(kml_id)['blob_key'])['Body'].read()
+        )
+
+    def test_kml_stored_before_deduplication(self):
+        with patch('app.routes.KML_STORAGE_DEDUPLICATION', False):
+            response = self.create_test_kml('valid-kml.xml', author='mf-geoadmin3')
+        kml_id = response.json['id']
+        admin_id = response.json['admin_id']
+        file_key = f'files/{kml_id}'
+        self.assertNotIn('blob_key', self.get_item(kml_id))
+
+        response = self.app.get(url_for('get_kml_file', kml_id=kml_id))
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.headers['Content-Encoding'], 'gzip')
+        self.assertEqual(response.data, self.get_s3_object(file_key)['Body'].read())
+
+        # The kml is moved to a blob on its next update
+        self.update_kml(kml_id, admin_id, 'updated-kml.xml')
+        self.assertIn('blob_key', self.get_item(kml_id))
+        self.assertIsNone(self.get_s3_object(file_key))
+        self.assertIsNone(self.get_s3_object(f'{file_key}.br'))
+
+        # And back to its file_key when the deduplication is disabled
+        with patch('app.routes.KML_STORAGE_DEDUPLICATION', False):
+            self.update_kml(kml_id, admin_id, 'valid-kml.xml')
+        self.assertNotIn('blob_key', self.get_item(kml_id))
+        self.assertIsNotNone(self.get_s3_object(file_key))
@@ -0,0 +1,264 @@
+import os
+import tempfile
+import time
+import unittest
+from unittest.mock import patch
+
+from flask import url_for
+
+from app.helpers.dynamodb import get_db
+from app.helpers.file_cache import FileCache
+from app.helpers.s3 import get_storage
+from tests.unit_tests.base import BaseRouteTestCase
+from tests.unit_tests.base import prepare_kml_payload
+
+
+def make_headers(size):
+    return {
+        'size': size,
+        'content_type': 'application/vnd.google-earth.kml+xml',
+        'content_encoding': 'gzip',
+        'cache_control': 'no-cache',
+        'etag': 'etag',
+        'last_modified': '2024-01-01T00:00:00+00:00',
+    }
+
+
+class TestFileCache(unittest.TestCase):
+
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()  # pylint: disable=consider-using-with
+        self.addCleanup(directory.cleanup)
+        self.cache = FileCache(directory.name, max_size=1000)
+
+    def add(self, key, data, version=''):
+        return b''.join(
+            self.cache.fill(key, version, make_headers(len(data)), [data[:50], data[50:]])
+        )
+
+    def read(self, key, version=''):
+        cached = self.cache.open(key, version)
+        if cached is None:
+            return None
+        fd, headers = cached
+        with fd:
+            return fd.read(), headers
+
+    def test_fill(self):
+        self.assertIsNone(self.read('files/a'))
+        self.assertEqual(self.add('files/a', b'a' * 100), b'a' * 100)
+        self.assertEqual(self.read('files/a'), (b'a' * 100, make_headers(100)))
+        self.assertIsNone(self.read('files/a', version='2024-01-02'))
+        self.assertEqual((self.cache.hits, self.cache.misses), (1, 2))
+
+    def test_not_cached(self):
+        # Too big
+        self.add('files/a', b'a' * 101)
+        # Partially read
+        chunks = self.cache.fill('files/b', '', make_headers(100), [b'b' * 50, b'b' * 50])
+        next(chunks)
+        chunks.close()
+        self.assertIsNone(self.read('files/a'))
+        self.assertIsNone(self.read('files/b'))
+        self.assertEqual(os.listdir(self.cache.directory), [])
+
+    def test_eviction(self):
+        for index in range(10):
+            self.add(f'files/{index}', b'x' * 100)
+            path = self.cache._get_path(f'files/{index}', '')  # pylint: disable=protected-access
+            os.utime(path, (index, index))
+        # Recently read
+        self.assertIsNotNone(self.read('files/0'))
+        self.add('files/10', b'x' * 100)
+        self.assertIsNotNone(self.read('files/0'))
+        self.assertIsNone(self.read('files/1'))
+        self.assertIsNone(self.read('files/2'))
+        self.assertIsNotNone(self.read('files/3'))
+        self.assertIsNotNone(self.read('files/10'))
+
+    def test_stale_temporary_files(self):
+        for name, age in [('stale.tmp', 600), ('stale.tmp.json', 600), ('filling.tmp', 10)]:
+            path = os.path.join(self.cache.directory, name)
+            with open(path, 'wb'):
+                pass
+            os.utime(path, (time.time() - age, time.time() - age))
+        # The first entry added by a worker scans the directory
+        self.add('files/a', b'a' * 100)
+        path = self.cache._get_path('files/a', '')  # pylint: disable=protected-access
+        entry = os.path.basename(path)
+        self.assertListEqual(
+            sorted(os.listdir(self.cache.directory)),
+            sorted([entry, f'{entry}.json', 'filling.tmp'])
+        )
+
+
+class TestFileProxy(BaseRouteTestCase):
+
+    def setUp(self):
+        super().setUp()
+        directory = tempfile.TemporaryDirectory()  # pylint: disable=consider-using-with
+        self.addCleanup(directory.cleanup)
+        self.cache = FileCache(directory.name, max_size=10 * 1024 * 1024)
+        storage = get_storage()
+        for target, value in [
+            ('app.routes.KML_STORAGE_DEDUPLICATION', True),
+            ('app.routes.KML_FILE_PROXY', True),
+            ('app.routes.get_file_cache', lambda: self.cache),
+            (storage.s3, 'get_object'),
+        ]:
+            if isinstance(target, str):
+                patcher = patch(target, value)
+            else:
+                patcher = patch.object(target, value, wraps=getattr(target, value))
+            mock = patcher.start()
+            self.addCleanup(patcher.stop)
+        self.get_object = mock
+
+    def get_file(self, kml_id, headers=None):
+        # The kml files are public, no origin is required
+        return self.app.get(url_for('get_kml_file', kml_id=kml_id), headers=headers)
+
+    def get_object_conditions(self):
+        return [
+            {
+                name: value for name, value in call.kwargs.items() if name not in ['Bucket', 'Key']
+            } for call in self.get_object.call_args_list
+        ]
+
+    def get_stored_file(self, kml_id):
+        db_item = get_db().get_item(kml_id, cached=False)
+        return self.get_s3_object(db_item.get('blob_key', db_item['file_key']))
+
+    def test_get_kml_file(self):
+        kml_id = self.create_test_kml('valid-kml.xml', author='mf-geoadmin3').json['id']
+        s3_object = self.get_stored_file(kml_id)
+        data = s3_object['Body'].read()
+        for hit in [False, True]:
+            with self.subTest(hit=hit):
+                response = self.get_file(kml_id)
+                self.assertEqual(response.status_code, 200)
+                self.assertEqual(response.data, data)
+                self.assertEqual(response.headers['Content-Encoding'], 'gzip')
+                self.assertEqual(response.headers['Content-Length'], str(len(data)))
+                self.assertEqual(response.headers['ETag'], s3_object['ETag'])
+                self.assertEqual(response.headers['Accept-Ranges'], 'bytes')
+                self.assertEqual(response.content_type, 'application/vnd.google-earth.kml+xml')
+                self.assertEqual(response.headers['Cache-Control'], s3_object['CacheControl'])
+        self.get_object.assert_called_once()
+        self.assertEqual((self.cache.hits, self.cache.misses), (1, 1))
+
+    def test_conditional_and_range(self):
+        kml_id = self.create_test_kml('valid-kml.xml', author='mf-geoadmin3').json['id']
+        s3_object = self.get_stored_file(kml_id)
+        data = s3_object['Body'].read()
+        last_modified = s3_object['LastModified'].strftime('%a, %d %b %Y %H:%M:%S GMT')
+        # Before and after the file has been cached
+        for _ in range(2):
+            response = self.get_file(kml_id, headers={'If-None-Match': s3_object['ETag']})
+            self.assertEqual(response.status_code, 304)
+            self.assertEqual(response.data, b'')
+            response = self.get_file(kml_id, headers={'If-Modified-Since': last_modified})
+            self.assertEqual(response.status_code, 304)
+            response = self.get_file(kml_id, headers={'If-None-Match': '"other"'})
+            self.assertEqual(response.status_code, 200)
+            self.assertEqual(response.data, data)
+
+            response = self.get_file(kml_id, headers={'Range': 'bytes=10-19'})
+            self.assertEqual(response.status_code, 206)
+            self.assertEqual(response.data, data[10:20])
+            self.assertEqual(response.headers['Content-Range'], f'bytes 10-19/{len(data)}')
+            response = self.get_file(kml_id, headers={'Range': f'bytes={len(data)}-'})
+            self.assertEqual(response.status_code, 416)
+        # The file is cached by the first complete response, the previous conditions are
+        # evaluated by S3
+        self.assertEqual((self.cache.hits, self.cache.misses), (7, 3))
+        self.assertListEqual(
+            self.get_object_conditions(),
+            [
+                {
+                    'IfNoneMatch': s3_object['ETag']
+                },
+                {
+                    'IfModifiedSince': s3_object['LastModified']
+                },
+                {
+                    'IfNoneMatch': '"other"'
+                },
+            ],
+        )
+
+    def test_not_cached_range(self):
+        kml_id = self.create_test_kml('valid-kml.xml', author='mf-geoadmin3').json['id']
+        s3_object = self.get_stored_file(kml_id)
+        data = s3_object['Body'].read()
+        with patch('app.routes.get_file_cache', lambda: None):
+            response = self.get_file(kml_id, headers={'Range': 'bytes=10-19'})
+            self.assertEqual(response.status_code, 206)
+            self.assertEqual(response.data, data[10:20])
+            self.assertEqual(response.headers['Content-Range'], f'bytes 10-19/{len(data)}')
+            self.assertEqual(response.headers['Content-Length'], '10')
+            self.assertEqual(response.headers['Content-Encoding'], 'gzip')
+            self.assertEqual(response.headers['ETag'], s3_object['ETag'])
+            response = self.get_file(kml_id, headers={'Range': f'bytes={len(data)}-'})
+            self.assertEqual(response.status_code, 416)
+            response = self.get_file(
+                kml_id, headers={
+                    'Range': 'bytes=10-19', 'If-None-Match': s3_object['ETag']
+                }
+            )
+            self.assertEqual(response.status_code, 304)
+            # Not supported by S3, the range is answered from the complete object
+            response = self.get_file(
+                kml_id, headers={
+                    'Range': 'bytes=10-19', 'If-Range': s3_object['ETag']
+                }
+            )
+            self.assertEqual(response.status_code, 206)
+            self.assertEqual(response.data, data[10:20])
+        self.assertListEqual(
+            self.get_object_conditions(),
+            [
+                {
+                    'Range': 'bytes=10-19'
+                },
+                {
+                    'Range': f'bytes={len(data)}-'
+                },
+                {
+                    'IfNoneMatch': s3_object['ETag'], 'Range': 'bytes=10-19'
+                },
+                {},
+            ],
+        )
+
+    def test_kml_stored_before_deduplication(self):
+        with patch('app.routes.KML_STORAGE_DEDUPLICATION', False):
+            response = self.create_test_kml('valid-kml.xml', author='mf-geoadmin3')
+            kml_id = response.json['id']
+            self.assertEqual(
+                self.get_file(kml_id).data, self.get_stored_file(kml_id)['Body'].read()
+            )
+
+            # The cached file of the previous version is not served
+            response = self.app.put(
+                url_for('update_kml', kml_id=kml_id),
+                data=prepare_kml_payload(
+                    kml_file='updated-kml.xml', admin_id=response.json['admin_id']
+                ),
+                content_type="multipart/form-data",
+                headers=self.origin_headers["allowed"]
+            )
+            self.assertEqual(response.status_code, 200)
+            self.assertEqual(
+                self.get_file(kml_id).data, self.get_stored_file(kml_id)['Body'].read()
+            )
+        self.assertEqual(self.get_object.call_count, 2)
+
+    def test_without_proxy(self):
+        kml_id = self.create_test_kml('valid-kml.xml', author='mf-geoadmin3').json['id']
+        with patch('app.routes.KML_FILE_PROXY', False), \
+            patch('app.routes.KML_STORAGE_HOST_URL', 'http://storage'), \
+            patch('app.helpers.utils.KML_STORAGE_HOST_URL', 'http://storage'):
+            response = self.get_file(kml_id)
+        self.assertEqual(response.status_code, 302)
+        self.get_object.assert_not_called()
@@ -0,0 +1,408 @@
+import gzip
+import random
+import re
+import time
+import unittest
+import zlib
+from unittest.mock import patch
+from urllib.parse import unquote_plus
+
+from werkzeug.exceptions import HTTPException
+
+from app.helpers.kml import GzipDecoder
+from app.helpers.kml import KmlProcessor
+from app.helpers.kml import KmlSanitizer
+from app.helpers.kml import KmlValidator
+from app.helpers.kml import unquote_split_index
+from app.helpers.kml_patch import patch_kml
+from app.helpers.utils import decompress_if_gzipped
+
+
+def chunked(data, size):
+    return [data[i:i + size] for i in range(0, len(data), size)]
+
+
+class TestKmlProcessor(unittest.TestCase):
+
+    def setUp(self):
+        with open('./tests/samples/valid-kml.xml', 'rb') as fd:
+            self.kml_data = fd.read()
+
+    def process(self, data, chunk_size, charset='utf-8'):
+        kml_gzip, empty = KmlProcessor(charset).process(chunked(data, chunk_size))
+        return gzip.decompress(kml_gzip).decode('utf-8'), empty
+
+    def test_process_chunk_sizes(self):
+        for data in [self.kml_data, gzip.compress(self.kml_data)]:
+            for chunk_size in [1, 2, 3, 7, 64, len(data)]:
+                with self.subTest(gzipped=data != self.kml_data, chunk_size=chunk_size):
+                    kml, empty = self.process(data, chunk_size)
+                    self.assertEqual(kml, self.kml_data.decode('utf-8'))
+                    self.assertFalse(empty)
+
+    def test_process_multi_members_gzip(self):
+        data = gzip.compress(self.kml_data[:100]) + gzip.compress(self.kml_data[100:])
+        kml, _ = self.process(data, 10)
+        self.assertEqual(kml, self.kml_data.decode('utf-8'))
+
+    def test_process_quoted_kml(self):
+        text = '<kml><name>café € \U0001F600 100%</name></kml>'
+        quoted = ''.join(f'%{b:02X}' for b in text.encode('utf-8')).encode('ascii')
+        for chunk_size in [1, 2, 4, 5, 8]:
+            with self.subTest(chunk_size=chunk_size):
+                kml, _ = self.process(quoted, chunk_size)
+                self.assertEqual(kml, text)
+
+    def test_process_gzip_passthrough(self):
+        data = gzip.compress(self.kml_data)
+        kml_gzip, empty = KmlProcessor().process(chunked(data, 100))
+        self.assertEqual(kml_gzip, data)
+        self.assertFalse(empty)
+
+    def test_process_gzip_recompressed(self):
+        for text, expected, charset in [
+            ('<kml><name>a<script>x</script></name></kml>', '<kml><name>a </name></kml>', 'utf-8'),
+            ('<kml><name>a+b%20c</name></kml>', '<kml><name>a b c</name></kml>', 'utf-8'),
+            ('<kml><name>café</name></kml>', '<kml><name>café</name></kml>', 'latin-1'),
+        ]:
+            with self.subTest(text=text, charset=charset):
+                data = gzip.compress(text.encode(charset))
+                kml_gzip, _ = KmlProcessor(charset).process(chunked(data, 7))
+                self.assertNotEqual(kml_gzip, data)
+                self.assertEqual(gzip.decompress(kml_gzip).decode('utf-8'), expected)
+        # multi members gzip are compressed again in a single member
+        data = gzip.compress(self.kml_data[:100]) + gzip.compress(self.kml_data[100:])
+        kml_gzip, _ = KmlProcessor().process(chunked(data, 7))
+        decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+        self.assertEqual(decompressor.decompress(kml_gzip), self.kml_data)
+        self.assertTrue(decompressor.eof)
+        self.assertEqual(decompressor.unused_data, b'')
+
+    def test_process_gzip_changed_single_pass(self):
+        text = self.kml_data.decode('utf-8')
+        middle = text.index('<Point>')
+        for changed, expected in [
+            (
+                text.replace('<Placemark>', '<Placemark onload="x">', 1),
+                text.replace('<Placemark>', '<Placemark >', 1),
+            ),
+            (
+                text[:middle] + '<script>x</script>' + text[middle:],
+                text[:middle] + ' ' + text[middle:],
+            ),
+            (
+                text.replace('</kml>', '<name>a+b</name></kml>'),
+                text.replace('</kml>', '<name>a b</name></kml>'),
+            ),
+        ]:
+            data = gzip.compress(changed.encode('utf-8'))
+            for chunk_size in [7, 100, len(data)]:
+                with self.subTest(changed=changed[-30:], chunk_size=chunk_size):
+                    with patch('app.helpers.kml.KmlValidator', wraps=KmlValidator) as validator:
+                        processor = KmlProcessor()
+                        kml_gzip, _ = processor.process(chunked(data, chunk_size))
+                    # The upload is not processed a second time
+                    validator.assert_called_once()
+                    self.assertFalse(processor.unchanged)
+                    self.assertEqual(gzip.decompress(kml_gzip), expected.encode('utf-8'))
+
+    def test_process_charset(self):
+        text = '<kml><name>café</name></kml>'
+        kml, _ = self.process(text.encode('utf-16'), 3, charset='utf-16')
+        self.assertEqual(kml, text)
+
+    def test_process_empty_kml(self):
+        _, empty = self.process(b'<kml>  </kml>', 3)
+        self.assertTrue(empty)
+
+    def test_process_invalid(self):
+        for data in [
+            b'<kml><Placemark></kml>',
+            b'',
+            gzip.compress(self.kml_data)[:-10],
+            b'\x1f\x8b' + b'not gzipped',
+            b'<kml>\xff</kml>',
+        ]:
+            with self.subTest(data=data):
+                with self.assertRaises(HTTPException) as context:
+                    self.process(data, 7)
+                self.assertEqual(context.exception.code, 400)
+
+    def test_process_sanitized(self):
+        data = b'<kml><Placemark onclick="alert(1)"><name>a<script>alert(2)</script></name>' \
+            b'</Placemark></kml>'
+        kml, _ = self.process(data, 3)
+        self.assertEqual(kml, '<kml><Placemark ><name>a </name></Placemark></kml>')
+
+    def test_unquote_split_index(self):
+        text = 'a+b%20c%C3%A9%E2%82%AC%F0%9F%98%80%41%'
+        for end in range(len(text) + 1):
+            with self.subTest(text=text[:end]):
+                split = unquote_split_index(text[:end])
+                self.assertEqual(
+                    unquote_plus(text[:split]) + unquote_plus(text[split:]), unquote_plus(text)
+                )
+
+
+class TestGzipDecoder(unittest.TestCase):
+
+    def decompress(self, decoder, data, chunk_size):
+        pieces = [piece for chunk in chunked(data, chunk_size) for piece in decoder.feed(chunk)]
+        pieces.append(decoder.close())
+        return pieces
+
+    def test_decompress_pieces(self):
+        data = b'<kml>' + bytes(range(256)) * 100 + b' ' * 100000 + b'</kml>'
+        for max_piece in [1, 7, 1024]:
+            for chunk_size in [3, 1000, len(data)]:
+                with self.subTest(max_piece=max_piece, chunk_size=chunk_size):
+                    decoder = GzipDecoder(max_piece=max_piece)
+                    pieces = self.decompress(decoder, gzip.compress(data), chunk_size)
+                    self.assertEqual(b''.join(pieces), data)
+                    self.assertLessEqual(max(len(piece) for piece in pieces), max_piece)
+                    self.assertEqual(decoder.members, 1)
+
+    def test_decompress_too_large(self):
+        data = gzip.compress(b' ' * 1024 * 1024)
+        with self.assertRaises(HTTPException) as context:
+            self.decompress(GzipDecoder(max_size=1000, max_ratio=10000), data, 1024)
+        self.assertEqual(context.exception.code, 413)
+
+    def test_decompress_ratio_too_high(self):
+        data = gzip.compress(b' ' * 1024 * 1024)
+        with self.assertRaises(HTTPException) as context:
+            self.decompress(GzipDecoder(max_ratio=100, ratio_threshold=1024), data, 1024)
+        self.assertEqual(context.exception.code, 413)
+        # The ratio is not checked below the threshold
+        pieces = self.decompress(
+            GzipDecoder(max_ratio=100, ratio_threshold=2 * 1024 * 1024), data, 1024
+        )
+        self.assertEqual(len(b''.join(pieces)), 1024 * 1024)
+
+    def test_decompress_if_gzipped(self):
+        data = b'<kml>100%+</kml>'
+        self.assertEqual(decompress_if_gzipped(gzip.compress(data)), data)
+        with self.assertNoLogs('app.helpers', level='INFO'):
+            self.assertEqual(decompress_if_gzipped(data), data)
+        with self.assertRaises(HTTPException) as context:
+            decompress_if_gzipped(gzip.compress(data), max_length=10)
+        self.assertEqual(context.exception.code, 413)
+
+
+class TestKmlValidator(unittest.TestCase):
+
+    def test_invalid_kml_position(self):
+        validator = KmlValidator()
+        with self.assertLogs('app.helpers.kml', level='ERROR') as logs:
+            with self.assertRaises(HTTPException) as context:
+                validator.feed('<kml>\n  <Placemark>\n</kml>')
+                validator.close()
+        self.assertEqual(context.exception.code, 400)
+        self.assertIn('line 3, column 2', logs.output[0])
+
+    def test_empty_detection(self):
+        for kml_string, expected in [
+            ('<kml></kml>', True),
+            ('<?xml version="1.0"?><!-- comment --><kml> <!-- comment --> </kml>', True),
+            ('<kml><!-- comment -->text</kml>', False),
+            ('<kml><Document/></kml>', False),
+        ]:
+            with self.subTest(kml_string=kml_string):
+                validator = KmlValidator()
+                for char in kml_string:
+                    validator.feed(char)
+                self.assertEqual(validator.close(), expected)
+
+    def test_undefined_entity(self):
+        for kml_string in [
+            '<kml><Document/>&foo;</kml>',
+            '<!DOCTYPE kml SYSTEM "kml.dtd"><kml><Document/>&foo;</kml>',
+        ]:
+            with self.subTest(kml_string=kml_string):
+                validator = KmlValidator()
+                with self.assertRaises(HTTPException) as context:
+                    for char in kml_string:
+                        validator.feed(char)
+                    validator.close()
+                self.assertEqual(context.exception.code, 400)
+
+
+def reference_sanitize(text):
+    text = re.sub(r'''(?<![\w.:-])on\w+\s*=\s*(?:"[^"]*"|'[^']*')''', '', text, flags=re.IGNORECASE)
+    return re.sub(
+        r'(<|&lt;)\s*\bscript\b.*?(>|&gt;).*?(<|&lt;)/\s*\bscript\b\s*(>|&gt;)',
+        ' ',
+        text,
+        flags=re.IGNORECASE | re.DOTALL
+    )
+
+
+class TestKmlSanitizer(unittest.TestCase):
+
+    def sanitize(self, chunks):
+        sanitizer = KmlSanitizer()
+        output = ''.join(sanitizer.feed(chunk) for chunk in chunks) + sanitizer.close()
+        return output, sanitizer.changed
+
+    def test_sanitize(self):
+        for text, expected in [
+            (
+                '<?xml version="1.0" encoding="UTF-8"?><kml></kml>',
+                '<?xml version="1.0" encoding="UTF-8"?><kml></kml>',
+            ),
+            ('<a onClick = "x" onload=\'y\' name="b"/>', '<a   name="b"/>'),
+            ('&lt;svg/onload="x"&gt;', '&lt;svg/&gt;'),
+            (
+                '<![CDATA[<img src="x"onerror="alert(1)">]]>',
+                '<![CDATA[<img src="x">]]>',
+            ),
+            ("<![CDATA[<svg id='x'onload='alert(1)'>]]>", "<![CDATA[<svg id='x'>]]>"),
+            ('&lt;img src="x"onerror="alert(1)"&gt;', '&lt;img src="x"&gt;'),
+            ("&lt;svg id='x'onload='alert(1)'&gt;", "&lt;svg id='x'&gt;"),
+            (
+                '<a xml:onx="x" data-onx="y" b.onx="z" noon="w"/>',
+                '<a xml:onx="x" data-onx="y" b.onx="z" noon="w"/>',
+            ),
+            ('<name>a &lt;script&gt;x&lt;/script&gt; b</name>', '<name>a   b</name>'),
+            ('<a>< SCRIPT type="js">x</script ></a>', '<a> </a>'),
+            ('<a><scripts>x</scripts></a>', '<a><scripts>x</scripts></a>'),
+            ('<a><script>x</a>', '<a><script>x</a>'),
+        ]:
+            for chunk_size in [1, 2, 5, len(text)]:
+                with self.subTest(text=text, chunk_size=chunk_size):
+                    output, changed = self.sanitize(chunked(text, chunk_size))
+                    self.assertEqual(output, expected)
+                    self.assertEqual(changed, text != expected)
+
+    def test_sanitize_random(self):
+        tokens = '< > &lt; &gt; / script SCRIPT o n on x = " \' & l t - :'.split(' ') + [' ', '\n']
+        rand = random.Random(42)
+        for _ in range(500):
+            text = ''.join(rand.choice(tokens) for _ in range(rand.randint(0, 60)))
+            chunk_size = rand.randint(1, 8)
+            with self.subTest(text=text, chunk_size=chunk_size):
+                output, _ = self.sanitize(chunked(text, chunk_size))
+                self.assertEqual(output, reference_sanitize(text))
+
+    def test_sanitize_linear_time(self):
+        for text in [
+            '<script>' * 100000,
+            ' onx="' * 100000,
+            '<script>x' + '&lt;/script' * 100000,
+        ]:
+            with self.subTest(text=text[:20]):
+                start = time.perf_counter()
+                self.sanitize(chunked(text, 64 * 1024))
+                self.assertLess(time.perf_counter() - start, 2)
+
+
+class TestKmlPatch(unittest.TestCase):
+
+    document = (
+        b'<?xml version="1.0" encoding="UTF-8"?>\n'
+        b'<kml xmlns="http://www.opengis.net/kml/2.2" '
+        b'xmlns:gx="http://www.google.com/kml/ext/2.2"><Document><name>Drawing</name>'
+        b'<Placemark id="a" name=">"><name>A</name></Placemark>'
+        b'<Placemark id="b"/>'
+        b'</Document></kml>'
+    )
+
+    def patch(self, operations, document=None):
+        return patch_kml(document or self.document, operations)
+
+    def assertPatchRejected(self, operations, document=None):  # pylint: disable=invalid-name
+        with self.assertRaises(HTTPException) as context:
+            self.patch(operations, document)
+        self.assertEqual(context.exception.code, 400)
+
+    def test_patch_placemarks(self):
+        patched, empty = self.patch([
+            {
+                'op': 'upsert', 'id': 'a', 'kml': '<Placemark id="a"><gx:Track/></Placemark>'
+            },
+            {
+                'op': 'delete', 'id': 'b'
+            },
+            {
+                'op': 'upsert', 'id': 'c', 'kml': '<Placemark id="c"><name>C</name></Placemark>'
+            },
+        ])
+        self.assertFalse(empty)
+        self.assertEqual(
+            patched,
+            self.document.replace(
+                b'<Placemark id="a" name=">"><name>A</name></Placemark><Placemark id="b"/>',
+                b'<Placemark id="a"><gx:Track/></Placemark>'
+                b'<Placemark id="c"><name>C</name></Placemark>'
+            )
+        )
+
+    def test_patch_operations_order(self):
+        patched, _ = self.patch([
+            {
+                'op': 'upsert', 'id': 'c', 'kml': '<Placemark id="c"/>'
+            },
+            {
+                'op': 'delete', 'id': 'c'
+            },
+            {
+                'op': 'delete', 'id': 'a'
+            },
+            {
+                'op': 'upsert', 'id': 'a', 'kml': '<Placemark id="a"/>'
+            },
+        ])
+        self.assertEqual(
+            patched,
+            self.document.replace(
+                b'<Placemark id="a" name=">"><name>A</name></Placemark>', b'<Placemark id="a"/>'
+            )
+        )
+
+    def test_patch_sanitized(self):
+        patched, _ = self.patch([{
+            'op': 'upsert',
+            'id': 'b',
+            'kml': '<Placemark id="b" onclick="alert(1)"><script>alert(2)</script></Placemark>'
+        }])
+        self.assertNotIn(b'alert', patched)
+
+    def test_patch_empty_kml(self):
+        patched, empty = self.patch([{
+            'op': 'upsert', 'id': 'a', 'kml': '<Placemark id="a"/>'
+        }], b'<kml></kml>')
+        self.assertEqual(patched, b'<kml><Placemark id="a"/></kml>')
+        self.assertFalse(empty)
+        patched, empty = self.patch([{'op': 'delete', 'id': 'a'}], patched)
+        self.assertEqual(patched, b'<kml></kml>')
+        self.assertTrue(empty)
+
+    def test_patch_invalid(self):
+        for kml in [
+            '<Placemark id="a">',
+            '<Placemark id="other"/>',
+            '<Placemark id="a"/><Placemark id="a"/>',
+            '<Folder id="a"/>',
+            'text<Placemark id="a"/>',
+            '<Placemark id="a"><unknown:x/></Placemark>',
+            '<!DOCTYPE x [<!ENTITY e "e">]><Placemark id="a"/>',
+        ]:
+            with self.subTest(kml=kml):
+                self.assertPatchRejected([{'op': 'upsert', 'id': 'a', 'kml': kml}])
+        self.assertPatchRejected([{'op': 'delete', 'id': 'unknown'}])
+        self.assertPatchRejected(
+            [{
+                'op': 'delete', 'id': 'a'
+            }], b'<kml><Placemark id="a"/><Placemark id="a"/></kml>'
+        )
+
+    def test_patch_stored_kml_not_sanitized(self):
+        # Files stored before the uploads were sanitized are parsed with the defused parser
+        for document in [
+            b'<!DOCTYPE kml [<!ENTITY a "aaaaaaaaaa"><!ENTITY b "&a;&a;&a;&a;&a;&a;&a;&a;">]>'
+            b'<kml><Placemark id="a"><name>&b;</name></Placemark></kml>',
+            b'<!DOCTYPE kml [<!ENTITY e SYSTEM "file:///etc/passwd">]>'
+            b'<kml><Placemark id="a"><name>&e;</name></Placemark></kml>',
+        ]:
+            with self.subTest(document=document):
+                self.assertPatchRejected([{'op': 'delete', 'id': 'a'}], document)
@@ -0,0 +1,131 @@
+import json
+import os
+import tempfile
+import time
+import unittest
+
+from flask import url_for
+
+from app.helpers.metrics import Registry
+from app.helpers.metrics import SnapshotWriter
+from app.helpers.metrics import format_metrics
+from app.helpers.metrics import merge_snapshots
+from tests.unit_tests.base import BaseRouteTestCase
+
+
+class TestRegistry(unittest.TestCase):
+
+    def test_format(self):
+        registry = Registry()
+        registry.inc('kml_http_requests_total', endpoint='checker', method='GET', status=200)
+        registry.inc('kml_http_requests_total', 2, endpoint='checker', method='GET', status=200)
+        registry.add('kml_http_requests_in_flight', 1)
+        registry.observe('kml_stage_duration_seconds', 0.003, stage='validate')
+        registry.observe('kml_stage_duration_seconds', 20, stage='validate')
+        registry.register_collector(
+            lambda: [('gauge', 'kml_backend_pool_connections', {
+                'service': 's3'
+            }, 4)]
+        )
+        lines = format_metrics(merge_snapshots([registry.snapshot()])).splitlines()
+        self.assertIn('# TYPE kml_http_requests_total counter', lines)
+        self.assertIn(
+            'kml_http_requests_total{endpoint="checker",method="GET",status="200"} 3', lines
+        )
+        self.assertIn('kml_http_requests_in_flight 1', lines)
+        self.assertIn('kml_backend_pool_connections{service="s3"} 4', lines)
+        self.assertIn('# TYPE kml_stage_duration_seconds histogram', lines)
+        self.assertIn('kml_stage_duration_seconds_bucket{stage="validate",le="0.0025"} 0', lines)
+        self.assertIn('kml_stage_duration_seconds_bucket{stage="validate",le="0.005"} 1', lines)
+        self.assertIn('kml_stage_duration_seconds_bucket{stage="validate",le="10.0"} 1', lines)
+        self.assertIn('kml_stage_duration_seconds_bucket{stage="validate",le="+Inf"} 2', lines)
+        self.assertIn('kml_stage_duration_seconds_sum{stage="validate"} 20.003', lines)
+        self.assertIn('kml_stage_duration_seconds_count{stage="validate"} 2', lines)
+
+    def test_label_escaping(self):
+        registry = Registry()
+        registry.inc('kml_http_requests_total', endpoint='a"b\\c\nd')
+        self.assertIn(
+            r'kml_http_requests_total{endpoint="a\"b\\c\nd"} 1',
+            format_metrics(merge_snapshots([registry.snapshot()]))
+        )
+
+    def test_workers_snapshots(self):
+        with tempfile.TemporaryDirectory() as directory:
+            worker = Registry()
+            writer = SnapshotWriter(worker, directory, interval=5)
+            others = []
+            for pid, exited in [(1, False), (2, True), (3, False)]:
+                other = Registry()
+                other.inc('kml_http_requests_total', pid)
+                other.add('kml_http_requests_in_flight', pid)
+                other.observe('kml_http_request_duration_seconds', 0.1 * pid)
+                path = os.path.join(directory, f'worker-{pid}.json')
+                with open(path, 'w', encoding='utf-8') as fd:
+                    json.dump(other.snapshot(gauges=not exited), fd)
+                others.append(path)
+            # The worker 3 has been killed without writing its final snapshot
+            expired = time.time() - 60
+            os.utime(others[2], (expired, expired))
+            worker.inc('kml_http_requests_total', 10)
+            worker.add('kml_http_requests_in_flight', 10)
+            writer.write()
+
+            merged = merge_snapshots([worker.snapshot(), *writer.read_others()])
+        self.assertEqual(merged[('kml_http_requests_total', ())], 16)
+        self.assertEqual(merged[('kml_http_requests_in_flight', ())], 11)
+        histogram = merged[('kml_http_request_duration_seconds', ())]
+        self.assertEqual(sum(histogram[:-1]), 3)
+        self.assertAlmostEqual(histogram[-1], 0.6)
+
+
+class TestMetricsEndpoint(BaseRouteTestCase):
+
+    def scrape(self):
+        # Scraped without Origin header
+        response = self.app.get(url_for('metrics'))
+        self.assertEqual(response.status_code, 200)
+        return response
+
+    def get_sample(self, response, sample):
+        for line in response.get_data(as_text=True).splitlines():
+            if line.startswith(f'{sample} '):
+                return float(line.rpartition(' ')[2])
+        return 0
+
+    def test_metrics(self):
+        metadata_requests = 'kml_http_requests_total{endpoint="get_kml_metadata",method="GET",' \
+            'status="200"}'
+        previous = self.get_sample(self.scrape(), metadata_requests)
+        kml_id = self.create_test_kml('valid-kml.xml', author='mf-geoadmin3').json['id']
+        response = self.app.get(
+            url_for('get_kml_metadata', kml_id=kml_id), headers=self.origin_headers["allowed"]
+        )
+        self.assertEqual(response.status_code, 200)
+
+        response = self.scrape()
+        self.assertEqual(self.get_sample(response, metadata_requests), previous + 1)
+        self.assertEqual(response.mimetype, 'text/plain')
+        self.assertNotIn('Access-Control-Allow-Origin', response.headers)
+        lines = response.get_data(as_text=True).splitlines()
+        self.assertTrue(
+            any(
+                line.startswith('kml_http_request_bytes_total{endpoint="create_kml"}')
+                for line in lines
+            )
+        )
+        for stage in [
+            'multipart_parse', 'decode', 'sanitize', 'validate', 'compress', 's3', 'dynamodb'
+        ]:
+            with self.subTest(stage=stage):
+                self.assertTrue(
+                    any(
+                        line.startswith(f'kml_stage_duration_seconds_count{{stage="{stage}"}}')
+                        for line in lines
+                    )
+                )
+        self.assertTrue(
+            any(line.startswith('kml_backend_pool_connections{service="s3"') for line in lines)
+        )
+        # The scrape itself is in flight
+        self.assertIn('kml_http_requests_in_flight 1', lines)
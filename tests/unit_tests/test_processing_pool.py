@@ -0,0 +1,108 @@
+import threading
+import unittest
+from unittest.mock import patch
+
+from werkzeug.exceptions import HTTPException
+
+from flask import abort
+from flask import g
+from flask import url_for
+
+from app import app
+from app.helpers.processing_pool import ProcessingPool
+from app.helpers.processing_pool import close_processing_pool
+from app.helpers.processing_pool import get_processing_pool
+from tests.unit_tests.base import BaseRouteTestCase
+from tests.unit_tests.base import prepare_kml_payload
+
+
+class TestProcessingPool(unittest.TestCase):
+
+    def setUp(self):
+        self.pool = ProcessingPool(1, 1)
+
+    def tearDown(self):
+        self.pool.close()
+
+    def test_run(self):
+        with app.test_request_context():
+            self.assertNotEqual(self.pool.run(threading.get_ident), threading.get_ident())
+            self.assertEqual(set(g.kml_processing.keys()), {'queued', 'executing'})
+
+    def test_run_abort(self):
+        with app.test_request_context():
+            with self.assertRaises(HTTPException) as context:
+                self.pool.run(abort, 400, 'Invalid kml file')
+            self.assertEqual(context.exception.code, 400)
+            self.assertIn('executing', g.kml_processing)
+
+    def test_run_saturated(self):
+        started = threading.Event()
+        release = threading.Event()
+
+        def blocking_task():
+            started.set()
+            release.wait(5)
+
+        def run_blocking_task():
+            with app.test_request_context():
+                self.pool.run(blocking_task)
+
+        threads = [threading.Thread(target=run_blocking_task) for _ in range(2)]
+        for thread in threads:
+            thread.start()
+        started.wait(5)
+        try:
+            with app.test_request_context():
+                with self.assertRaises(HTTPException) as context:
+                    self.pool.run(int)
+                self.assertEqual(context.exception.code, 503)
+        finally:
+            release.set()
+            for thread in threads:
+                thread.join()
+        with app.test_request_context():
+            self.assertEqual(self.pool.run(int), 0)
+
+
+class TestProcessingPoolRoutes(BaseRouteTestCase):
+
+    def setUp(self):
+        super().setUp()
+        close_processing_pool()
+        for patcher in [
+            patch('app.helpers.processing_pool.KML_PROCESSING_POOL_SIZE', 1),
+            patch('app.helpers.processing_pool.KML_PROCESSING_QUEUE_SIZE', 0),
+        ]:
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        self.addCleanup(close_processing_pool)
+
+    def post_kml(self, kml_file):
+        return self.app.post(
+            url_for('create_kml'),
+            data=prepare_kml_payload(kml_file=kml_file, author='mf-geoadmin3'),
+            content_type="multipart/form-data",
+            headers=self.origin_headers["allowed"]
+        )
+
+    def test_create_kml_in_pool(self):
+        with self.assertLogs('app.helpers.processing_pool', level='DEBUG') as logs:
+            response = self.create_test_kml('valid-kml.xml', author='mf-geoadmin3')
+        self.assertKml(response, 'valid-kml.xml', with_admin_id=True)
+        self.assertIn('KML processing durations', logs.output[0])
+
+    def test_create_invalid_kml_in_pool(self):
+        response = self.post_kml('invalid-kml.xml')
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(response.json['error']['message'], 'Invalid kml file')
+
+    def test_create_kml_pool_saturated(self):
+        get_processing_pool()._slots.acquire()  # pylint: disable=protected-access
+        response = self.post_kml('valid-kml.xml')
+        self.assertEqual(response.status_code, 503)
+        self.assertEqual(
+            response.json['error']['message'], 'Service overloaded, please retry later'
+        )
+        response = self.app.get(url_for('checker'), headers=self.origin_headers["allowed"])
+        self.assertEqual(response.status_code, 200)
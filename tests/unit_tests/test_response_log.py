@@ -0,0 +1,74 @@
+import io
+import json
+import logging
+import unittest
+from unittest.mock import MagicMock
+
+from logging_utilities.formatters.json_formatter import JsonFormatter
+
+from flask import jsonify
+
+from app.app import app
+from app.helpers.response_log import LazyResponseExtra
+from app.helpers.response_log import is_response_sampled
+
+
+class TestLazyResponseExtra(unittest.TestCase):
+
+    def setUp(self):
+        self.context = app.test_request_context()
+        self.context.push()
+        self.addCleanup(self.context.pop)
+        self.response = jsonify({'success': True, 'id': 'abc'})
+        self.response.headers['X-Test'] = 'test'
+
+    def log(self, extra, level=logging.DEBUG):
+        '''Log a record with the response extra and returns what the json handler emitted'''
+        stream = io.StringIO()
+        handler = logging.StreamHandler(stream)
+        handler.setLevel(level)
+        handler.setFormatter(
+            JsonFormatter(
+                {
+                    'message': 'message',
+                    'response':
+                        {
+                            'statusCode': 'response.status_code',
+                            'headers': 'response.headers.',
+                            'payload': 'response.json'
+                        }
+                },
+                remove_empty=True,
+                ignore_missing=True
+            )
+        )
+        logger = logging.getLogger('tests.response_log')
+        logger.propagate = False
+        logger.addHandler(handler)
+        try:
+            logger.info('GET / - 200', extra={'response': extra})
+        finally:
+            logger.removeHandler(handler)
+        return json.loads(stream.getvalue()) if stream.getvalue() else None
+
+    def test_formatted(self):
+        record = self.log(LazyResponseExtra(self.response, headers=None))
+        self.assertEqual(record['response']['statusCode'], 200)
+        self.assertEqual(record['response']['headers']['X-Test'], 'test')
+        self.assertEqual(record['response']['headers']['Content-Type'], 'application/json')
+        self.assertEqual(record['response']['payload'], {'id': 'abc', 'success': True})
+
+    def test_allowed_headers(self):
+        record = self.log(LazyResponseExtra(self.response, headers=['x-test']))
+        self.assertEqual(record['response']['headers'], {'X-Test': 'test'})
+
+    def test_not_built_if_dropped(self):
+        response = MagicMock(status_code=200)
+        self.assertIsNone(self.log(LazyResponseExtra(response), level=logging.WARNING))
+        response.headers.items.assert_not_called()
+
+    def test_sampling(self):
+        self.assertFalse(is_response_sampled(self.response, rate=0))
+        self.assertTrue(is_response_sampled(self.response, rate=1))
+        self.response.status_code = 404
+        self.assertTrue(is_response_sampled(self.response, rate=0))
@@ -1,5 +1,7 @@
 import base64
 import datetime
+import gzip
+import json
 import logging
 import uuid
 from datetime import timedelta
@@ -9,7 +11,10 @@ from nose2.tools import params
 
 from flask import url_for
 
+from app.helpers.dynamodb import get_db
+from app.helpers.s3 import get_storage
 from app.settings import AWS_DB_TABLE_NAME
+from app.settings import AWS_S3_BUCKET_NAME
 from app.settings import KML_FILE_CONTENT_TYPE
 from app.version import APP_VERSION
 from tests.unit_tests.base import BaseRouteTestCase
@@ -74,6 +79,17 @@ class TestPostEndpoint(BaseRouteTestCase):
         self.assertEqual(response.content_type, "application/json")  # pylint: disable=no-member
         self.assertKml(response, kml_file, with_admin_id=True)
 
+    def test_valid_gzipped_kml_post_stored_as_is(self):
+        kml_file = 'valid-kml.xml.gz'
+        response = self.create_test_kml(kml_file, author="mf-geoadmin3")
+        self.assertEqual(response.status_code, 201)
+        db_item = self.assertKmlInDb(response)
+        obj = self.s3bucket.meta.client.get_object(
+            Bucket=AWS_S3_BUCKET_NAME, Key=db_item['file_key']
+        )
+        with open(f'./tests/samples/{kml_file}', 'rb') as fd:
+            self.assertEqual(obj['Body'].read(), fd.read())
+
     @patch('app.helpers.utils.KML_MAX_SIZE', 10)
     def test_too_big_kml_post(self):
         kml_file = 'valid-kml.xml'
@@ -87,6 +103,21 @@ class TestPostEndpoint(BaseRouteTestCase):
         self.assertCors(response, ['GET', 'HEAD', 'POST', 'OPTIONS'])
         self.assertEqual(response.content_type, "application/json")  # pylint: disable=no-member
 
+    def test_gzip_bomb_kml_post(self):
+        kml_data = gzip.compress(b'<kml>' + b' ' * 5 * 1024 * 1024 + b'</kml>')
+        response = self.app.post(
+            url_for('create_kml'),
+            data=prepare_kml_payload(kml_data=kml_data, author="mf-geoadmin3"),
+            content_type="multipart/form-data",
+            headers=self.origin_headers["allowed"]
+        )
+        self.assertEqual(response.status_code, 413)
+        self.assertCors(response, ['GET', 'HEAD', 'POST', 'OPTIONS'])
+        self.assertEqual(
+            response.json['error']['message'],
+            'KML file compression ratio too high, max allowed=100'
+        )
+
     def test_invalid_kml_post(self):
         response = self.app.post(
             url_for('create_kml'),
@@ -165,9 +196,9 @@ class TestGetEndpoint(BaseRouteTestCase):
             url_for('get_kml_metadata', kml_id=id_to_fetch), headers=self.origin_headers["allowed"]
         )
         self.assertEqual(response.status_code, 200)
-        self.assertCors(response, ['DELETE', 'GET', 'HEAD', 'OPTIONS', 'PUT'])
+        self.assertCors(response, ['DELETE', 'GET', 'HEAD', 'OPTIONS', 'PATCH', 'PUT'])
         self.assertIn('Cache-Control', response.headers)
-        self.assertIn('no-cache', response.headers['Cache-Control'])
+        self.assertEqual(response.headers['Cache-Control'], 'private, no-cache')
         self.assertIn('Expire', response.headers)
         self.assertEqual(response.headers['Expire'], '0')
         self.assertEqual(response.content_type, "application/json")
@@ -187,7 +218,7 @@ class TestGetEndpoint(BaseRouteTestCase):
             url_for('get_kml_metadata', kml_id=id_to_fetch), headers=self.origin_headers["allowed"]
         )
         self.assertEqual(response.status_code, 200)
-        self.assertCors(response, ['DELETE', 'GET', 'HEAD', 'OPTIONS', 'PUT'])
+        self.assertCors(response, ['DELETE', 'GET', 'HEAD', 'OPTIONS', 'PATCH', 'PUT'])
         self.assertIn('Cache-Control', response.headers)
         self.assertIn('no-cache', response.headers['Cache-Control'])
         self.assertIn('Expire', response.headers)
@@ -209,6 +240,8 @@ class TestGetEndpoint(BaseRouteTestCase):
         self.assertCors(response, ['GET', 'HEAD', 'OPTIONS', 'POST'])
         self.assertIn('Cache-Control', response.headers)
         self.assertIn('no-cache', response.headers['Cache-Control'])
+        # The admin_id must not be stored by the clients
+        self.assertIn('no-store', response.headers['Cache-Control'])
         self.assertIn('Expire', response.headers)
         self.assertEqual(response.headers['Expire'], '0')
         self.assertEqual(response.content_type, "application/json")
@@ -216,6 +249,59 @@ class TestGetEndpoint(BaseRouteTestCase):
         self.assertEqual(stored_kml_admin_link, response.json['links']['self'])
         self.assertKml(response, 'valid-kml.xml', with_admin_id=True)
 
+    def test_get_metadata_conditional(self):
+        url = url_for('get_kml_metadata', kml_id=self.sample_kml['id'])
+        response = self.app.get(url, headers=self.origin_headers["allowed"])
+        self.assertEqual(response.status_code, 200)
+        etag = response.headers['ETag']
+        last_modified = response.headers['Last-Modified']
+        self.assertTrue(etag.startswith('"'), msg=f'ETag {etag} is not a strong ETag')
+
+        response = self.app.get(
+            url, headers={
+                **self.origin_headers["allowed"], 'If-None-Match': etag
+            }
+        )
+        self.assertEqual(response.status_code, 304)
+        self.assertEqual(response.data, b'')
+        self.assertEqual(response.headers['ETag'], etag)
+        self.assertCors(response, ['DELETE', 'GET', 'HEAD', 'OPTIONS', 'PATCH', 'PUT'])
+        self.assertIn('no-cache', response.headers['Cache-Control'])
+
+        response = self.app.get(
+            url, headers={
+                **self.origin_headers["allowed"], 'If-Modified-Since': last_modified
+            }
+        )
+        self.assertEqual(response.status_code, 304)
+
+        response = self.app.get(
+            url_for('get_kml_metadata_by_admin_id', admin_id=self.sample_kml['admin_id']),
+            headers={
+                **self.origin_headers["allowed"], 'If-None-Match': etag
+            }
+        )
+        self.assertEqual(response.status_code, 304)
+
+        response = self.app.put(
+            url_for('update_kml', kml_id=self.sample_kml['id']),
+            data=prepare_kml_payload(
+                kml_file='updated-kml.xml', admin_id=self.sample_kml['admin_id']
+            ),
+            content_type="multipart/form-data",
+            headers=self.origin_headers["allowed"]
+        )
+        self.assertEqual(response.status_code, 200)
+        self.assertNotEqual(response.headers['ETag'], etag)
+
+        response = self.app.get(
+            url, headers={
+                **self.origin_headers["allowed"], 'If-None-Match': etag
+            }
+        )
+        self.assertEqual(response.status_code, 200)
+        self.assertKml(response, 'updated-kml.xml')
+
     def test_get_metadata_by_admin_id_invalid(self):
         response = self.app.get(
             url_for('get_kml_metadata_by_admin_id'), headers=self.origin_headers["allowed"]
@@ -256,7 +342,7 @@ class TestGetEndpoint(BaseRouteTestCase):
             url_for('get_kml_metadata', kml_id=id_to_fetch), headers=self.origin_headers["allowed"]
         )
         self.assertEqual(response.status_code, 404)
-        self.assertCors(response, ['DELETE', 'GET', 'HEAD', 'OPTIONS', 'PUT'])
+        self.assertCors(response, ['DELETE', 'GET', 'HEAD', 'OPTIONS', 'PATCH', 'PUT'])
         self.assertIn('Cache-Control', response.headers)
         self.assertIn('max-age=3600', response.headers['Cache-Control'])
         self.assertNotIn('Expire', response.headers)
@@ -271,7 +357,7 @@ class TestGetEndpoint(BaseRouteTestCase):
             url_for('get_kml_metadata', kml_id=id_to_fetch), headers=self.origin_headers["bad"]
         )
         self.assertEqual(response.status_code, 403)
-        self.assertCors(response, ['DELETE', 'GET', 'HEAD', 'OPTIONS', 'PUT'])
+        self.assertCors(response, ['DELETE', 'GET', 'HEAD', 'OPTIONS', 'PATCH', 'PUT'])
         self.assertIn('Cache-Control', response.headers)
         self.assertIn('max-age=3600', response.headers['Cache-Control'])
         self.assertNotIn('Expire', response.headers)
@@ -298,7 +384,7 @@ class TestGetEndpoint(BaseRouteTestCase):
         id_to_fetch = self.sample_kml['id']
         response = self.app.get(url_for('get_kml_metadata', kml_id=id_to_fetch), headers=headers)
         self.assertEqual(response.status_code, 403)
-        self.assertCors(response, ['DELETE', 'GET', 'HEAD', 'OPTIONS', 'PUT'])
+        self.assertCors(response, ['DELETE', 'GET', 'HEAD', 'OPTIONS', 'PATCH', 'PUT'])
 
     @params(
         {'Origin': 'map.geo.admin.ch'},
@@ -320,7 +406,7 @@ class TestGetEndpoint(BaseRouteTestCase):
         id_to_fetch = self.sample_kml['id']
         response = self.app.get(url_for('get_kml_metadata', kml_id=id_to_fetch), headers=headers)
         self.assertEqual(response.status_code, 200)
-        self.assertCors(response, ['DELETE', 'GET', 'HEAD', 'OPTIONS', 'PUT'])
+        self.assertCors(response, ['DELETE', 'GET', 'HEAD', 'OPTIONS', 'PATCH', 'PUT'])
 
 
 class TestPutEndpoint(BaseRouteTestCase):
@@ -339,7 +425,7 @@ class TestPutEndpoint(BaseRouteTestCase):
             headers=self.origin_headers["allowed"]
         )
         self.assertEqual(response.status_code, 200)
-        self.assertCors(response, ['DELETE', 'GET', 'HEAD', 'OPTIONS', 'PUT'])
+        self.assertCors(response, ['DELETE', 'GET', 'HEAD', 'OPTIONS', 'PATCH', 'PUT'])
         self.assertEqual(response.content_type, "application/json")
         for key in self.sample_kml:
             # values for "updated" should and may differ, so ignore them in
@@ -369,7 +455,7 @@ class TestPutEndpoint(BaseRouteTestCase):
             headers=self.origin_headers["allowed"]
         )
         self.assertEqual(response.status_code, 200)
-        self.assertCors(response, ['DELETE', 'GET', 'HEAD', 'OPTIONS', 'PUT'])
+        self.assertCors(response, ['DELETE', 'GET', 'HEAD', 'OPTIONS', 'PATCH', 'PUT'])
         self.assertEqual(response.content_type, "application/json")
         for key in self.sample_kml:
             # values for "updated" should and may differ, so ignore them in
@@ -400,7 +486,7 @@ class TestPutEndpoint(BaseRouteTestCase):
             headers=self.origin_headers["allowed"]
         )
         self.assertEqual(response.status_code, 200)
-        self.assertCors(response, ['DELETE', 'GET', 'HEAD', 'OPTIONS', 'PUT'])
+        self.assertCors(response, ['DELETE', 'GET', 'HEAD', 'OPTIONS', 'PATCH', 'PUT'])
         self.assertEqual(response.content_type, "application/json")
         for key in self.sample_kml:
             # values for "updated" should and may differ, so ignore them in
@@ -430,7 +516,7 @@ class TestPutEndpoint(BaseRouteTestCase):
             headers=self.origin_headers["allowed"]
         )
         self.assertEqual(response.status_code, 400)
-        self.assertCors(response, ['DELETE', 'GET', 'HEAD', 'OPTIONS', 'PUT'])
+        self.assertCors(response, ['DELETE', 'GET', 'HEAD', 'OPTIONS', 'PATCH', 'PUT'])
         self.assertEqual(response.json['error']['message'], 'Invalid kml file')
         self.assertEqual(response.content_type, "application/json")
 
@@ -446,7 +532,7 @@ class TestPutEndpoint(BaseRouteTestCase):
             headers=self.origin_headers["allowed"]
         )
         self.assertEqual(response.status_code, 400)
-        self.assertCors(response, ['DELETE', 'GET', 'HEAD', 'OPTIONS', 'PUT'])
+        self.assertCors(response, ['DELETE', 'GET', 'HEAD', 'OPTIONS', 'PATCH', 'PUT'])
         self.assertEqual(response.json['error']['message'], 'Invalid kml file')
         self.assertEqual(response.content_type, "application/json")
 
@@ -461,7 +547,7 @@ class TestPutEndpoint(BaseRouteTestCase):
             headers=self.origin_headers["allowed"]
         )
         self.assertEqual(response.status_code, 404)
-        self.assertCors(response, ['DELETE', 'GET', 'HEAD', 'OPTIONS', 'PUT'])
+        self.assertCors(response, ['DELETE', 'GET', 'HEAD', 'OPTIONS', 'PATCH', 'PUT'])
         self.assertEqual(
             response.json['error']['message'],
             f'Could not find {id_to_update} within the database.'
@@ -479,7 +565,7 @@ class TestPutEndpoint(BaseRouteTestCase):
             headers=self.origin_headers["bad"]
         )
         self.assertEqual(response.status_code, 403)
-        self.assertCors(response, ['DELETE', 'GET', 'HEAD', 'OPTIONS', 'PUT'])
+        self.assertCors(response, ['DELETE', 'GET', 'HEAD', 'OPTIONS', 'PATCH', 'PUT'])
         self.assertEqual(response.content_type, "application/json")
         self.assertEqual(response.json["error"]["message"], "Permission denied")
 
@@ -492,7 +578,7 @@ class TestPutEndpoint(BaseRouteTestCase):
             headers=self.origin_headers["bad"]
         )
         self.assertEqual(response.status_code, 403)
-        self.assertCors(response, ['DELETE', 'GET', 'HEAD', 'OPTIONS', 'PUT'])
+        self.assertCors(response, ['DELETE', 'GET', 'HEAD', 'OPTIONS', 'PATCH', 'PUT'])
         self.assertEqual(response.content_type, "application/json")
         self.assertEqual(response.json["error"]["message"], "Permission denied")
 
@@ -505,10 +591,386 @@ class TestPutEndpoint(BaseRouteTestCase):
             headers=self.origin_headers["bad"]
         )
         self.assertEqual(response.status_code, 403)
-        self.assertCors(response, ['DELETE', 'GET', 'HEAD', 'OPTIONS', 'PUT'])
+        self.assertCors(response, ['DELETE', 'GET', 'HEAD', 'OPTIONS', 'PATCH', 'PUT'])
         self.assertEqual(response.content_type, "application/json")
         self.assertEqual(response.json["error"]["message"], "Permission denied")
 
+    def put_kml(self, kml_file='updated-kml.xml', admin_id=None, if_match=None):
+        headers = dict(self.origin_headers["allowed"])
+        if if_match is not None:
+            headers['If-Match'] = if_match
+        return self.app.put(
+            url_for('update_kml', kml_id=self.sample_kml['id']),
+            data=prepare_kml_payload(
+                kml_file=kml_file, admin_id=admin_id or self.sample_kml['admin_id']
+            ),
+            content_type="multipart/form-data",
+            headers=headers
+        )
+
+    def get_db_item(self):
+        return self.dynamodb.Table(AWS_DB_TABLE_NAME).get_item(
+            Key={'kml_id': self.sample_kml['id']}
+        )['Item']
+
+    def test_kml_put_if_match(self):
+        etag = self.app.get(
+            url_for('get_kml_metadata', kml_id=self.sample_kml['id']),
+            headers=self.origin_headers["allowed"]
+        ).headers['ETag']
+        db = get_db()
+        with patch.object(db.table, 'get_item', wraps=db.table.get_item) as get_item:
+            response = self.put_kml(if_match=etag)
+            get_item.assert_not_called()
+        self.assertEqual(response.status_code, 200)
+        self.assertKml(response, 'updated-kml.xml', with_admin_id=True)
+        self.assertNotEqual(response.headers['ETag'], etag)
+        self.assertEqual(self.get_db_item()['version'], 2)
+
+        # The ETag of the response can be used for the next update
+        response = self.put_kml(kml_file='valid-kml.xml', if_match=response.headers['ETag'])
+        self.assertEqual(response.status_code, 200)
+        self.assertKml(response, 'valid-kml.xml', with_admin_id=True)
+        self.assertEqual(self.get_db_item()['version'], 3)
+
+    @params('"1-stale"', '"invalid"', '"1-stale", "2-other"', 'W/"3-weak"')
+    def test_kml_put_if_match_precondition_failed(self, if_match):
+        response = self.put_kml(kml_file='valid-kml.xml', if_match='"1-any"')
+        self.assertEqual(response.status_code, 200)
+
+        response = self.put_kml(if_match=if_match)
+        self.assertEqual(response.status_code, 412)
+        self.assertCors(response, ['DELETE', 'GET', 'HEAD', 'OPTIONS', 'PATCH', 'PUT'])
+        self.assertEqual(self.get_db_item()['version'], 2)
+        self.assertKmlFile(response, 'valid-kml.xml', self.get_db_item())
+
+    def test_kml_put_if_match_star(self):
+        response = self.put_kml(if_match='*')
+        self.assertEqual(response.status_code, 200)
+        self.assertKml(response, 'updated-kml.xml', with_admin_id=True)
+
+    def test_kml_put_if_match_permission_denied(self):
+        response = self.put_kml(admin_id='invalid-admin-id', if_match='"1-any"')
+        self.assertEqual(response.status_code, 403)
+        self.assertEqual(self.get_db_item()['version'], 1)
+
+    def test_kml_put_if_match_not_found(self):
+        response = self.app.put(
+            url_for('update_kml', kml_id='unknown-kml-id'),
+            data=prepare_kml_payload(kml_file='updated-kml.xml', admin_id='invalid-admin-id'),
+            content_type="multipart/form-data",
+            headers={
+                **self.origin_headers["allowed"], 'If-Match': '"1-any"'
+            }
+        )
+        self.assertEqual(response.status_code, 404)
+        response = self.app.get(
+            url_for('get_kml_metadata', kml_id='unknown-kml-id'),
+            headers=self.origin_headers["allowed"]
+        )
+        self.assertEqual(response.status_code, 404)
+
+    def test_kml_put_concurrent_conflict(self):
+        db = get_db()
+        get_item = db.get_item
+
+        def get_item_then_concurrent_update(*args, **kwargs):
+            item = get_item(*args, **kwargs)
+            if item.get('version') == 1:
+                self.dynamodb.Table(AWS_DB_TABLE_NAME).update_item(
+                    Key={'kml_id': self.sample_kml['id']},
+                    UpdateExpression='ADD #version :one',
+                    ExpressionAttributeNames={'#version': 'version'},
+                    ExpressionAttributeValues={':one': 1}
+                )
+            return item
+
+        with patch.object(db, 'get_item', side_effect=get_item_then_concurrent_update):
+            response = self.put_kml()
+        self.assertEqual(response.status_code, 409)
+        self.assertEqual(self.get_db_item()['version'], 2)
+
+    def test_kml_put_overtaking_upload(self):
+        # A later update must not overtake an update whose file is not uploaded yet, its upload
+        # could otherwise land first and be overwritten by the previous kml
+        storage = get_storage()
+        upload = storage.upload_object_to_bucket
+        overtaking = []
+
+        def upload_after_concurrent_update(*args, **kwargs):
+            if not overtaking:
+                self.assertIn('upload_lease', self.get_db_item())
+                overtaking.append(self.put_kml(kml_file='valid-kml.xml'))
+            return upload(*args, **kwargs)
+
+        with patch.object(
+            storage, 'upload_object_to_bucket', side_effect=upload_after_concurrent_update
+        ):
+            response = self.put_kml()
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(overtaking[0].status_code, 409)
+        db_item = self.get_db_item()
+        self.assertEqual(db_item['version'], 2)
+        self.assertNotIn('upload_lease', db_item)
+        self.assertKmlFile(response, 'updated-kml.xml', db_item)
+
+        response = self.put_kml(kml_file='valid-kml.xml')
+        self.assertEqual(response.status_code, 200)
+        self.assertKmlFile(response, 'valid-kml.xml', self.get_db_item())
+
+    def test_kml_put_expired_upload_lease(self):
+        # Lease of an update that never released it, e.g. killed worker
+        self.dynamodb.Table(AWS_DB_TABLE_NAME).update_item(
+            Key={'kml_id': self.sample_kml['id']},
+            UpdateExpression='SET #upload_lease = :upload_lease',
+            ExpressionAttributeNames={'#upload_lease': 'upload_lease'},
+            ExpressionAttributeValues={':upload_lease': '2000-01-01T00:00:00.000+00:00'}
+        )
+        response = self.put_kml()
+        self.assertEqual(response.status_code, 200)
+        self.assertNotIn('upload_lease', self.get_db_item())
+
+    def test_kml_put_unversioned_item(self):
+        # Items written before the versioning have no version attribute
+        self.dynamodb.Table(AWS_DB_TABLE_NAME).update_item(
+            Key={'kml_id': self.sample_kml['id']},
+            UpdateExpression='REMOVE #version',
+            ExpressionAttributeNames={'#version': 'version'}
+        )
+        etag = self.app.get(
+            url_for('get_kml_metadata', kml_id=self.sample_kml['id']),
+            headers=self.origin_headers["allowed"]
+        ).headers['ETag']
+        self.assertTrue(etag.startswith('"0-'))
+        response = self.put_kml()
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(self.get_db_item()['version'], 1)
+
+    def test_kml_put_unchanged(self):
+        # The sample kml has been created gzipped, its content is the same
+        self.assertIn('content_hash', self.get_db_item())
+        db = get_db()
+        s3 = self.s3bucket.meta.client  # pylint: disable=invalid-name
+        with patch.object(db.table, 'update_item') as update_item, \
+            patch.object(s3, 'put_object') as put_object:
+            response = self.put_kml(kml_file='valid-kml.xml')
+            update_item.assert_not_called()
+            put_object.assert_not_called()
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json['updated'], self.sample_kml['updated'])
+        self.assertEqual(self.get_db_item()['version'], 1)
+
+    def test_kml_put_unchanged_file(self):
+        # With a If-Match header or a new author version only the metadata is updated
+        etag = self.app.get(
+            url_for('get_kml_metadata', kml_id=self.sample_kml['id']),
+            headers=self.origin_headers["allowed"]
+        ).headers['ETag']
+        with patch('app.helpers.s3.S3FileHandling.upload_object_to_bucket') as upload:
+            response = self.put_kml(kml_file='valid-kml.xml', if_match=etag)
+            self.assertEqual(response.status_code, 200)
+            self.assertNotEqual(response.json['updated'], self.sample_kml['updated'])
+            self.assertEqual(self.get_db_item()['version'], 2)
+
+            response = self.app.put(
+                url_for('update_kml', kml_id=self.sample_kml['id']),
+                data=prepare_kml_payload(
+                    kml_file='valid-kml.xml',
+                    admin_id=self.sample_kml['admin_id'],
+                    author_version='2.0.0'
+                ),
+                content_type="multipart/form-data",
+                headers=self.origin_headers["allowed"]
+            )
+            self.assertEqual(response.status_code, 200)
+            self.assertEqual(response.json['author_version'], '2.0.0')
+            upload.assert_not_called()
+        self.assertEqual(self.get_db_item()['version'], 3)
+
+
+class TestPatchEndpoint(BaseRouteTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.sample_kml = self.create_test_kml('valid-kml.xml', author='mf-geoadmin3').json
+        self.etag = self.app.get(
+            url_for('get_kml_metadata', kml_id=self.sample_kml['id']),
+            headers=self.origin_headers["allowed"]
+        ).headers['ETag']
+
+    def patch_kml(self, operations, if_match=None, admin_id=None):
+        headers = dict(self.origin_headers["allowed"])
+        if if_match is not None:
+            headers['If-Match'] = if_match
+        return self.app.patch(
+            url_for('patch_kml', kml_id=self.sample_kml['id']),
+            json={
+                'admin_id': admin_id or self.sample_kml['admin_id'], 'operations': operations
+            },
+            headers=headers
+        )
+
+    def get_kml(self):
+        db_item = self.dynamodb.Table(AWS_DB_TABLE_NAME).get_item(
+            Key={'kml_id': self.sample_kml['id']}
+        )['Item']
+        obj = self.s3bucket.meta.client.get_object(
+            Bucket=AWS_S3_BUCKET_NAME, Key=db_item['file_key']
+        )
+        return db_item, gzip.decompress(obj['Body'].read()).decode('utf-8')
+
+    def test_kml_patch(self):
+        _, original = self.get_kml()
+        placemark = '<Placemark id="new"><name>New</name></Placemark>'
+        response = self.patch_kml([{'op': 'upsert', 'id': 'new', 'kml': placemark}], self.etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertCors(response, ['DELETE', 'GET', 'HEAD', 'OPTIONS', 'PATCH', 'PUT'])
+        self.assertNotEqual(response.headers['ETag'], self.etag)
+        db_item, kml = self.get_kml()
+        self.assertEqual(kml, original.replace('</kml>', f'{placemark}</kml>'))
+        self.assertEqual(db_item['version'], 2)
+
+        response = self.patch_kml([{'op': 'delete', 'id': 'new'}], response.headers['ETag'])
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(self.get_kml()[1], original)
+
+    def test_kml_patch_if_match_required(self):
+        response = self.patch_kml([{'op': 'delete', 'id': 'new'}])
+        self.assertEqual(response.status_code, 428)
+        response = self.patch_kml([{'op': 'delete', 'id': 'new'}], '*')
+        self.assertEqual(response.status_code, 428)
+
+    def test_kml_patch_precondition_failed(self):
+        operations = [{'op': 'upsert', 'id': 'new', 'kml': '<Placemark id="new"/>'}]
+        response = self.patch_kml(operations, '"1-stale"')
+        self.assertEqual(response.status_code, 412)
+        self.assertEqual(self.get_kml()[0]['version'], 1)
+
+    def test_kml_patch_permission_denied(self):
+        operations = [{'op': 'upsert', 'id': 'new', 'kml': '<Placemark id="new"/>'}]
+        response = self.patch_kml(operations, self.etag, admin_id='invalid-admin-id')
+        self.assertEqual(response.status_code, 403)
+
+    @params(
+        [],
+        [{
+            'op': 'move', 'id': 'a'
+        }],
+        [{
+            'op': 'upsert', 'id': 'a'
+        }],
+        [{
+            'op': 'upsert', 'id': 'a', 'kml': '<Placemark id="b"/>'
+        }],
+        [{
+            'op': 'delete', 'id': 'unknown'
+        }],
+    )
+    def test_kml_patch_invalid(self, operations):
+        response = self.patch_kml(operations, self.etag)
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(self.get_kml()[0]['version'], 1)
+
+
+class TestBatchEndpoint(BaseRouteTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.kml_ids = [
+            self.create_test_kml('valid-kml.xml', author='mf-geoadmin3').json['id']
+            for _ in range(3)
+        ]
+
+    def post_batch(self, data):
+        return self.app.post(
+            url_for('get_kml_metadata_batch'),
+            data=json.dumps(data),
+            content_type="application/json",
+            headers=self.origin_headers["allowed"]
+        )
+
+    def test_batch_metadata(self):
+        response = self.post_batch({'ids': self.kml_ids + ['unknown-kml-id', self.kml_ids[0]]})
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(response.is_streamed)
+        self.assertCors(response, ['OPTIONS', 'POST'])
+        self.assertEqual(response.content_type, "application/json")
+        self.assertTrue(response.json['success'])
+        self.assertEqual(
+            sorted(item['id'] for item in response.json['items']), sorted(self.kml_ids)
+        )
+        for item in response.json['items']:
+            self.assertKmlMetadata(item, author='mf-geoadmin3')
+            self.assertNotIn('admin_id', item)
+        self.assertEqual(response.json['not_found'], ['unknown-kml-id'])
+        self.assertEqual(response.json['unprocessed'], [])
+
+    @params(
+        {'ids': []},
+        {'ids': 'kml-id'},
+        {'ids': [1, 2]},
+        {'kml_ids': ['kml-id']},
+        ['kml-id'],
+    )
+    def test_batch_metadata_invalid(self, data):
+        response = self.post_batch(data)
+        self.assertEqual(response.status_code, 400)
+        self.assertCors(response, ['OPTIONS', 'POST'])
+
+    @patch('app.helpers.utils.KML_BATCH_MAX_IDS', 2)
+    def test_batch_metadata_too_many_ids(self):
+        response = self.post_batch({'ids': self.kml_ids})
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(response.json['error']['message'], 'Too many kml ids, max allowed=2')
+
+    def mock_unprocessed_keys(self, count):
+        '''Leave the first key of the first count BatchGetItem requests unprocessed'''
+        dynamodb = get_db().dynamodb
+        batch_get_item = dynamodb.batch_get_item
+        calls = []
+
+        def partial_batch_get_item(RequestItems):  # pylint: disable=invalid-name
+            calls.append(RequestItems)
+            if len(calls) > count:
+                return batch_get_item(RequestItems=RequestItems)
+            table, request = next(iter(RequestItems.items()))
+            response = {'Responses': {table: []}}
+            if len(request['Keys']) > 1:
+                response = batch_get_item(RequestItems={table: {'Keys': request['Keys'][1:]}})
+            response['UnprocessedKeys'] = {table: {'Keys': request['Keys'][:1]}}
+            return response
+
+        patcher = patch.object(dynamodb, 'batch_get_item', side_effect=partial_batch_get_item)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        return calls
+
+    @patch('app.helpers.dynamodb.BatchGet.BACKOFF', 0)
+    def test_batch_metadata_unprocessed_keys_retried(self):
+        calls = self.mock_unprocessed_keys(2)
+        response = self.post_batch({'ids': self.kml_ids})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(
+            sorted(item['id'] for item in response.json['items']), sorted(self.kml_ids)
+        )
+        self.assertEqual(response.json['unprocessed'], [])
+        self.assertEqual(len(calls), 3)
+
+    @patch('app.helpers.dynamodb.BatchGet.BACKOFF', 0)
+    @patch('app.helpers.dynamodb.KML_BATCH_MAX_RETRIES', 1)
+    def test_batch_metadata_unprocessed_keys(self):
+        calls = self.mock_unprocessed_keys(2)
+        response = self.post_batch({'ids': self.kml_ids})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(len(response.json['items']), 2)
+        self.assertEqual(len(response.json['unprocessed']), 1)
+        self.assertEqual(
+            sorted([item['id'] for item in response.json['items']] + response.json['unprocessed']),
+            sorted(self.kml_ids)
+        )
+        self.assertEqual(response.json['not_found'], [])
+        self.assertEqual(len(calls), 2)
+
 
 class TestDeleteEndpoint(BaseRouteTestCase):
 
@@ -529,7 +991,7 @@ class TestDeleteEndpoint(BaseRouteTestCase):
             headers=self.origin_headers["allowed"]
         )
         self.assertEqual(response.status_code, 200)
-        self.assertCors(response, ['DELETE', 'GET', 'HEAD', 'OPTIONS', 'PUT'])
+        self.assertCors(response, ['DELETE', 'GET', 'HEAD', 'OPTIONS', 'PATCH', 'PUT'])
         self.assertEqual(response.content_type, "application/json")
 
         response = self.app.get(
@@ -550,7 +1012,7 @@ class TestDeleteEndpoint(BaseRouteTestCase):
         )
 
         self.assertEqual(response.status_code, 404)
-        self.assertCors(response, ['DELETE', 'GET', 'HEAD', 'OPTIONS', 'PUT'])
+        self.assertCors(response, ['DELETE', 'GET', 'HEAD', 'OPTIONS', 'PATCH', 'PUT'])
         self.assertEqual(response.content_type, "application/json")
         self.assertEqual(
             response.json['error']['message'],
@@ -567,7 +1029,7 @@ class TestDeleteEndpoint(BaseRouteTestCase):
             headers=self.origin_headers["bad"]
         )
         self.assertEqual(response.status_code, 403)
-        self.assertCors(response, ['DELETE', 'GET', 'HEAD', 'OPTIONS', 'PUT'])
+        self.assertCors(response, ['DELETE', 'GET', 'HEAD', 'OPTIONS', 'PATCH', 'PUT'])
         self.assertEqual(response.content_type, "application/json")
         self.assertEqual(response.json["error"]["message"], "Permission denied")
 
@@ -581,7 +1043,7 @@ class TestDeleteEndpoint(BaseRouteTestCase):
             headers=self.origin_headers["allowed"]
         )
         self.assertEqual(response.status_code, 403)
-        self.assertCors(response, ['DELETE', 'GET', 'HEAD', 'OPTIONS', 'PUT'])
+        self.assertCors(response, ['DELETE', 'GET', 'HEAD', 'OPTIONS', 'PATCH', 'PUT'])
         self.assertEqual(response.content_type, "application/json")
         self.assertEqual(response.json["error"]["message"], "Permission denied")
 
@@ -594,7 +1056,7 @@ class TestDeleteEndpoint(BaseRouteTestCase):
             headers=self.origin_headers["allowed"]
         )
         self.assertEqual(response.status_code, 403)
-        self.assertCors(response, ['DELETE', 'GET', 'HEAD', 'OPTIONS', 'PUT'])
+        self.assertCors(response, ['DELETE', 'GET', 'HEAD', 'OPTIONS', 'PATCH', 'PUT'])
         self.assertEqual(response.content_type, "application/json")
         self.assertEqual(response.json["error"]["message"], "Permission denied")
 
@@ -608,6 +1070,6 @@ class TestDeleteEndpoint(BaseRouteTestCase):
             headers=self.origin_headers["allowed"]
         )
         self.assertEqual(response.status_code, 415)
-        self.assertCors(response, ['DELETE', 'GET', 'HEAD', 'OPTIONS', 'PUT'])
+        self.assertCors(response, ['DELETE', 'GET', 'HEAD', 'OPTIONS', 'PATCH', 'PUT'])
         self.assertEqual(response.content_type, "application/json")
         self.assertEqual(response.json["error"]["message"], "Unsupported Media Type")
@@ -0,0 +1,156 @@
+import base64
+import json
+from unittest.mock import patch
+
+from werkzeug.exceptions import InternalServerError
+
+from flask import url_for
+
+from app.helpers.dynamodb import get_db
+from app.helpers.s3 import get_storage
+from app.helpers.utils import get_staging_key
+from app.settings import AWS_S3_BUCKET_NAME
+from app.settings import KML_FILE_CONTENT_TYPE
+from app.settings import KML_MAX_SIZE
+from tests.unit_tests.base import BaseRouteTestCase
+
+
+class TestStagingUpload(BaseRouteTestCase):
+
+    def setUp(self):
+        super().setUp()
+        patcher = patch('app.helpers.utils.KML_STAGING_UPLOAD', True)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        storage = get_storage()
+        for method in ['put_object', 'copy_object']:
+            patcher = patch.object(storage.s3, method, wraps=getattr(storage.s3, method))
+            setattr(self, method, patcher.start())
+            self.addCleanup(patcher.stop)
+
+    def start_upload(self):
+        response = self.app.post(url_for('create_upload'), headers=self.origin_headers["allowed"])
+        self.assertEqual(response.status_code, 201)
+        return response.json['id']
+
+    def stage_file(self, upload_id, kml_file, content_type=KML_FILE_CONTENT_TYPE):
+        # Stands for the client upload with the presigned POST
+        with open(f'./tests/samples/{kml_file}', 'rb') as fd:
+            self.s3bucket.meta.client.put_object(
+                Bucket=AWS_S3_BUCKET_NAME,
+                Key=get_staging_key(upload_id),
+                Body=fd.read(),
+                ContentType=content_type
+            )
+        self.put_object.reset_mock()
+
+    def finalize(self, upload_id, data, headers=None):
+        return self.app.post(
+            url_for('finalize_upload', upload_id=upload_id),
+            data=data,
+            content_type="multipart/form-data",
+            headers={
+                **self.origin_headers["allowed"], **(headers or {})
+            }
+        )
+
+    def create_kml(self, kml_file):
+        upload_id = self.start_upload()
+        self.stage_file(upload_id, kml_file)
+        response = self.finalize(upload_id, {'author': 'mf-geoadmin3'})
+        self.assertEqual(response.status_code, 201, msg=response.json)
+        self.kmls.append({'id': response.json['id'], 'admin_id': response.json['admin_id']})
+        self.assertIsNone(self.get_s3_object(get_staging_key(upload_id)))
+        return response
+
+    def get_policy_conditions(self, fields):
+        return json.loads(base64.b64decode(fields['policy']))['conditions']
+
+    def test_disabled(self):
+        with patch('app.helpers.utils.KML_STAGING_UPLOAD', False):
+            response = self.app.post(
+                url_for('create_upload'), headers=self.origin_headers["allowed"]
+            )
+        self.assertEqual(response.status_code, 404)
+
+    def test_start_upload(self):
+        response = self.app.post(url_for('create_upload'), headers=self.origin_headers["allowed"])
+        self.assertEqual(response.status_code, 201)
+        upload_id = response.json['id']
+        upload = response.json['upload']
+        self.assertIn(AWS_S3_BUCKET_NAME, upload['url'])
+        self.assertEqual(upload['fields']['key'], get_staging_key(upload_id))
+        self.assertEqual(upload['fields']['Content-Type'], KML_FILE_CONTENT_TYPE)
+        self.assertIn('policy', upload['fields'])
+        self.assertTrue(response.json['links']['finalize'].endswith(f'/admin/uploads/{upload_id}'))
+        self.assertIn(str(KML_MAX_SIZE), str(self.get_policy_conditions(upload['fields'])))
+
+    def test_finalize_gzipped_kml_copies_staged_object(self):
+        response = self.create_kml('valid-kml.xml.gz')
+        self.assertKml(response, 'valid-kml.xml.gz', with_admin_id=True)
+        self.copy_object.assert_called_once()
+        self.put_object.assert_not_called()
+        s3_object = self.get_s3_object(f'files/{response.json["id"]}')
+        self.assertEqual(s3_object['ContentEncoding'], 'gzip')
+        self.assertEqual(s3_object['ContentType'], KML_FILE_CONTENT_TYPE)
+
+    def test_finalize_processed_kml(self):
+        response = self.create_kml('valid-kml.xml')
+        self.assertKml(response, 'valid-kml.xml', with_admin_id=True)
+        self.copy_object.assert_not_called()
+        self.put_object.assert_called_once()
+
+    def test_finalize_update(self):
+        response = self.create_test_kml('valid-kml.xml', author='mf-geoadmin3')
+        kml_id = response.json['id']
+        admin_id = response.json['admin_id']
+        upload_id = self.start_upload()
+        self.stage_file(upload_id, 'updated-kml.xml.gz')
+
+        response = self.finalize(upload_id, {'kml_id': kml_id, 'admin_id': 'wrong'})
+        self.assertEqual(response.status_code, 403)
+        self.assertIsNotNone(self.get_s3_object(get_staging_key(upload_id)))
+
+        response = self.finalize(upload_id, {'kml_id': kml_id, 'admin_id': admin_id})
+        self.assertEqual(response.status_code, 200, msg=response.json)
+        self.assertKml(response, 'updated-kml.xml.gz', with_admin_id=True)
+        self.copy_object.assert_called_once()
+        self.assertIsNone(self.get_s3_object(get_staging_key(upload_id)))
+
+    def test_finalize_invalid_kml(self):
+        upload_id = self.start_upload()
+        self.stage_file(upload_id, 'invalid-kml.xml')
+        response = self.finalize(upload_id, {'author': 'mf-geoadmin3'})
+        self.assertEqual(response.status_code, 400)
+        self.copy_object.assert_not_called()
+        self.put_object.assert_not_called()
+        self.assertIsNone(self.get_s3_object(get_staging_key(upload_id)))
+
+    def test_finalize_too_big_kml(self):
+        upload_id = self.start_upload()
+        self.stage_file(upload_id, 'valid-kml.xml')
+        with patch('app.helpers.utils.KML_MAX_SIZE', 10):
+            response = self.finalize(upload_id, {'author': 'mf-geoadmin3'})
+        self.assertEqual(response.status_code, 413)
+        self.assertIsNone(self.get_s3_object(get_staging_key(upload_id)))
+
+    def test_finalize_save_failure(self):
+        upload_id = self.start_upload()
+        self.stage_file(upload_id, 'valid-kml.xml')
+        with patch.object(get_db(), 'save_item', side_effect=InternalServerError()):
+            response = self.finalize(upload_id, {'author': 'mf-geoadmin3'})
+        self.assertEqual(response.status_code, 500)
+        self.assertIsNone(self.get_s3_object(get_staging_key(upload_id)))
+
+    def test_finalize_invalid_content_type(self):
+        upload_id = self.start_upload()
+        self.stage_file(upload_id, 'valid-kml.xml', content_type='text/plain')
+        response = self.finalize(upload_id, {'author': 'mf-geoadmin3'})
+        self.assertEqual(response.status_code, 415)
+        self.assertIsNone(self.get_s3_object(get_staging_key(upload_id)))
+
+    def test_finalize_unknown_upload(self):
+        for upload_id in [self.start_upload(), 'not-an-upload-id']:
+            with self.subTest(upload_id=upload_id):
+                response = self.finalize(upload_id, {'author': 'mf-geoadmin3'})
+                self.assertEqual(response.status_code, 404)
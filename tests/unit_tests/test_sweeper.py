@@ -0,0 +1,178 @@
+import unittest
+from datetime import timedelta
+from unittest.mock import patch
+
+from app.helpers.bulk import get_clients
+from app.helpers.sweeper import RateLimiter
+from app.helpers.sweeper import Sweeper
+from app.settings import AWS_DB_REGION_NAME
+from app.settings import AWS_DB_TABLE_NAME
+from app.settings import AWS_S3_BUCKET_NAME
+from app.settings import AWS_S3_REGION_NAME
+from tests.unit_tests.base import BaseRouteTestCase
+
+
+class TestSweeper(BaseRouteTestCase):
+
+    def setUp(self):
+        super().setUp()
+        patcher = patch('app.helpers.compression.SIDECAR_ENCODINGS', ['br'])
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.s3, self.client = get_clients(  # pylint: disable=invalid-name
+            AWS_S3_REGION_NAME, None, AWS_DB_REGION_NAME, None, max_connections=10
+        )
+        self.addCleanup(self.clear)
+        self.created = [
+            self.create_test_kml('valid-kml.xml', author='mf-geoadmin3').json for _ in range(4)
+        ]
+        # kml 0 is consistent, kml 1 lost its file, kml 2 lost its sidecar and kml 3 has been
+        # deleted from the table but not from the bucket
+        self.file_keys = [f'files/{kml["id"]}' for kml in self.created]
+        self.s3.delete_object(Bucket=AWS_S3_BUCKET_NAME, Key=self.file_keys[1])
+        self.s3.delete_object(Bucket=AWS_S3_BUCKET_NAME, Key=f'{self.file_keys[2]}.br')
+        self.client.delete_item(
+            TableName=AWS_DB_TABLE_NAME, Key={'kml_id': {
+                'S': self.created[3]['id']
+            }}
+        )
+
+    def clear(self):
+        for key in self.get_keys():
+            self.s3.delete_object(Bucket=AWS_S3_BUCKET_NAME, Key=key)
+        for item in self.client.scan(TableName=AWS_DB_TABLE_NAME)['Items']:
+            self.client.delete_item(TableName=AWS_DB_TABLE_NAME, Key={'kml_id': item['kml_id']})
+
+    def sweep(self, **kwargs):
+        # NOTE moto ignores the Scan segments, every segment returns all items
+        kwargs = {'grace_period': timedelta(0), 'segments': 1, 'listers': 4, **kwargs}
+        return Sweeper(
+            self.s3, self.client, AWS_DB_TABLE_NAME, AWS_S3_BUCKET_NAME, 'files/', **kwargs
+        ).run()
+
+    def get_keys(self):
+        return sorted(
+            obj['Key']
+            for obj in self.s3.list_objects_v2(Bucket=AWS_S3_BUCKET_NAME).get('Contents', [])
+        )
+
+    def get_item(self, kml_id):
+        return self.client.get_item(TableName=AWS_DB_TABLE_NAME, Key={
+            'kml_id': {
+                'S': kml_id
+            }
+        }).get('Item', None)
+
+    def test_dry_run(self):
+        keys = self.get_keys()
+        report = self.sweep()
+        self.assertEqual(report.items, 3)
+        self.assertEqual(report.objects, 6)
+        self.assertEqual(
+            sorted(report.orphan_objects), [self.file_keys[3], f'{self.file_keys[3]}.br']
+        )
+        self.assertEqual(report.items_without_file, [self.created[1]['id']])
+        self.assertEqual(report.items_without_sidecars, [self.created[2]['id']])
+        self.assertEqual(self.get_keys(), keys)
+        self.assertIsNotNone(self.get_item(self.created[1]['id']))
+
+    def test_delete(self):
+        report = self.sweep(dry_run=False)
+        self.assertEqual(report.failed, 0)
+        self.assertEqual(
+            self.get_keys(),
+            sorted(
+                [
+                    self.file_keys[0],
+                    f'{self.file_keys[0]}.br',
+                    f'{self.file_keys[1]}.br',
+                    self.file_keys[2],
+                ]
+            )
+        )
+        # The items without kml file are only reported
+        self.assertEqual(report.items_without_file, [self.created[1]['id']])
+        self.assertIn('1 items without kml file (reported only)', str(report))
+        self.assertIsNotNone(self.get_item(self.created[1]['id']))
+        self.assertNotIn('sidecars', self.get_item(self.created[2]['id']))
+        self.assertEqual(self.get_item(self.created[0]['id'])['sidecars'], {'L': [{'S': 'br'}]})
+
+        report = self.sweep(dry_run=False)
+        self.assertEqual(report.orphan_objects, [])
+        self.assertEqual(report.items_without_file, [self.created[1]['id']])
+        self.assertEqual(report.items_without_sidecars, [])
+
+    def test_delete_items(self):
+        report = self.sweep(dry_run=False, delete_items=True)
+        self.assertEqual(report.failed, 0)
+        self.assertEqual(
+            self.get_keys(),
+            sorted([self.file_keys[0], f'{self.file_keys[0]}.br', self.file_keys[2]])
+        )
+        self.assertIsNone(self.get_item(self.created[1]['id']))
+        self.assertNotIn('sidecars', self.get_item(self.created[2]['id']))
+        self.assertEqual(self.get_item(self.created[0]['id'])['sidecars'], {'L': [{'S': 'br'}]})
+
+        report = self.sweep(dry_run=False)
+        self.assertEqual(report.orphan_objects, [])
+        self.assertEqual(report.items_without_file, [])
+        self.assertEqual(report.items_without_sidecars, [])
+
+    def test_grace_period(self):
+        report = self.sweep(dry_run=False, grace_period=timedelta(hours=1))
+        self.assertEqual(report.skipped, 4)
+        self.assertEqual(report.orphan_objects, [])
+        self.assertEqual(len(self.get_keys()), 6)
+        self.assertIsNotNone(self.get_item(self.created[1]['id']))
+
+    def test_item_modified_since_scan(self):
+        sweeper = Sweeper(
+            self.s3,
+            self.client,
+            AWS_DB_TABLE_NAME,
+            AWS_S3_BUCKET_NAME,
+            'files/',
+            grace_period=timedelta(0),
+            dry_run=False,
+            delete_items=True,
+            segments=1,
+            listers=4
+        )
+        scan = sweeper._scan  # pylint: disable=protected-access
+
+        def scan_and_update(segment):
+            items = scan(segment)
+            self.client.update_item(
+                TableName=AWS_DB_TABLE_NAME,
+                Key={'kml_id': {
+                    'S': self.created[1]['id']
+                }},
+                UpdateExpression='SET #updated = :updated',
+                ExpressionAttributeNames={'#updated': 'updated'},
+                ExpressionAttributeValues={':updated': {
+                    'S': '2000-01-01T00:00:00.000+00:00'
+                }}
+            )
+            return items
+
+        with patch.object(sweeper, '_scan', scan_and_update):
+            report = sweeper.run()
+        self.assertEqual(report.skipped, 1)
+        self.assertIsNotNone(self.get_item(self.created[1]['id']))
+
+
+class TestRateLimiter(unittest.TestCase):
+
+    def test_rate(self):
+        now = [0.0]
+        sleeps = []
+
+        def sleep(seconds):
+            sleeps.append(seconds)
+            now[0] += seconds
+
+        limiter = RateLimiter(10, clock=lambda: now[0], sleep=sleep)
+        limiter.acquire(5)
+        limiter.acquire(5)
+        limiter.acquire(1)
+        self.assertEqual(sleeps, [0.5, 0.5])
@@ -6,19 +6,86 @@ library), then it could lead to inconsistencies in how the ssl module is used.
 Thus we patch the ssl module through gevent.monkey.patch_all before any other
 import, especially the app import, which would cause the boto module to be
 loaded, which would in turn load the ssl module.
+
+The patch depends on GUNICORN_WORKER_CLASS, which can be set in the ENV_FILE
+loaded by app.settings. As neither app.settings nor python-dotenv (which imports
+logging and threading) can be imported before the patch, the worker class is
+read from the environment and the env file with the builtins only.
 """
 # pylint: disable=wrong-import-position,wrong-import-order
-import gevent.monkey
+import os
 
-gevent.monkey.patch_all()
 
-import os
+def get_worker_class():
+    '''Returns GUNICORN_WORKER_CLASS like app.settings, the env file overrides the environment'''
+    worker_class = os.getenv('GUNICORN_WORKER_CLASS', 'gevent')
+    if os.getenv('ENV_FILE', None):
+        with open(os.environ['ENV_FILE'], 'r', encoding='utf-8') as fd:
+            for line in fd:
+                name, separator, value = line.strip().partition('=')
+                if separator and name.split() in [
+                    ['GUNICORN_WORKER_CLASS'], ['export', 'GUNICORN_WORKER_CLASS']
+                ]:
+                    value = value.strip()
+                    if value[:1] in ['"', "'"]:
+                        value = value[1:value.find(value[0], 1)]
+                    else:
+                        value = value.split(' #')[0].strip()
+                    worker_class = value
+    return worker_class
+
+
+# The other worker classes (e.g. gthread to compare the deployments) must not be patched
+if get_worker_class() == 'gevent':
+    import gevent.monkey
+
+    gevent.monkey.patch_all()
+
+import tempfile
 
 from gunicorn.app.base import BaseApplication
 
 from app import app as application
+from app.helpers.dynamodb import close_db
+from app.helpers.dynamodb import init_db
+from app.helpers.metrics import clear_metrics_dir
+from app.helpers.metrics import close_metrics
+from app.helpers.metrics import init_metrics
+from app.helpers.processing_pool import close_processing_pool
+from app.helpers.processing_pool import init_processing_pool
+from app.helpers.s3 import close_storage
+from app.helpers.s3 import init_storage
 from app.helpers.utils import get_logging_cfg
 from app.settings import GUNICORN_KEEPALIVE
+from app.settings import GUNICORN_THREADS
+from app.settings import GUNICORN_WORKER_CLASS
+from app.settings import GUNICORN_WORKER_CONNECTIONS
+from app.settings import GUNICORN_WORKERS
+from app.settings import KML_METRICS_DIR
+from app.settings import KML_METRICS_WRITE_INTERVAL
+
+WORKER_TMP_DIR = os.getenv("GUNICORN_WORKER_TMP_DIR", "/tmp/gunicorn_workers")
+METRICS_DIR = KML_METRICS_DIR or os.path.join(WORKER_TMP_DIR or tempfile.gettempdir(), 'metrics')
+
+
+def on_starting(server):  # pylint: disable=unused-argument
+    # The metrics of the workers of a previous run must not be merged
+    clear_metrics_dir(METRICS_DIR)
+
+
+def post_worker_init(worker):  # pylint: disable=unused-argument
+    # The boto3 clients are created once per worker and shared by all its greenlets
+    init_storage()
+    init_db()
+    init_processing_pool()
+    init_metrics(METRICS_DIR, KML_METRICS_WRITE_INTERVAL)
+
+
+def worker_exit(server, worker):  # pylint: disable=unused-argument
+    close_metrics()
+    close_processing_pool()
+    close_db()
+    close_storage()
 
 
 class StandaloneApplication(BaseApplication):  # pylint: disable=abstract-method
@@ -30,8 +97,9 @@ class StandaloneApplication(BaseApplication):  # pylint: disable=abstract-method
 
     def load_config(self):
         config = {
-            key: value for key,
-            value in self.options.items() if key in self.cfg.settings and value is not None
+            key: value
+            for key, value in self.options.items()
+            if key in self.cfg.settings and value is not None
         }
         for key, value in config.items():
             self.cfg.set(key.lower(), value)
@@ -43,20 +111,24 @@ class StandaloneApplication(BaseApplication):  # pylint: disable=abstract-method
 # We use the port 5000 as default, otherwise we set the HTTP_PORT env variable within the container.
 if __name__ == '__main__':
     HTTP_PORT = str(os.environ.get('HTTP_PORT', "5000"))
-    worker_tmp_dir = os.getenv("GUNICORN_WORKER_TMP_DIR", "/tmp/gunicorn_workers")
     # Bind to 0.0.0.0 to let your app listen to all network interfaces.
     options = {
         'bind': f"0.0.0.0:{HTTP_PORT}",
-        'worker_class': 'gevent',
-        'workers': 2,  # scaling horizontally is left to Kubernetes
+        'worker_class': GUNICORN_WORKER_CLASS,
+        'workers': GUNICORN_WORKERS,  # scaling horizontally is left to Kubernetes
+        'threads': GUNICORN_THREADS,
+        'worker_connections': GUNICORN_WORKER_CONNECTIONS,
         'timeout': 60,
         'logconfig_dict': get_logging_cfg(),
         'forwarded_allow_ips': os.getenv('FORWARED_ALLOW_IPS', '*'),
         'keepalive': GUNICORN_KEEPALIVE,
-        'worker_tmp_dir': worker_tmp_dir if worker_tmp_dir != '' else None,
+        'worker_tmp_dir': WORKER_TMP_DIR if WORKER_TMP_DIR != '' else None,
         'secure_scheme_headers':
             {
                 os.getenv('FORWARDED_PROTO_HEADER_NAME', 'X-Forwarded-Proto').upper(): 'https'
-            }
+            },
+        'on_starting': on_starting,
+        'post_worker_init': post_worker_init,
+        'worker_exit': worker_exit,
     }
     StandaloneApplication(application, options).run()